@@ -0,0 +1,198 @@
+"""
+Truck allocation for orders.
+
+A truck is claimed with a conditional ``UPDATE ... WHERE status = 'idle'`` and
+is ``reserved`` from that moment until its dispatch starts, so concurrent order
+creation can never hand the same truck to two orders. Orders that find no idle
+truck stay pending without a dispatch (the backlog) and are assigned, oldest
+first, whenever a dispatch completes or is cancelled and frees its truck.
+
+Batches of orders (``create_orders``) are inserted and assigned in one pass:
+one query to plan against the idle trucks, one UPDATE to claim them and one
+INSERT for the dispatches.
+"""
+import bisect
+import threading
+from contextlib import contextmanager
+
+from django.db import connection, transaction
+from django.db.models import Exists, OuterRef
+from django.utils import timezone
+
+from .events import publish_changes
+from .models import Truck, Order, Dispatch, KPISnapshot, DailyOrderKPI, invalidate_cached_responses
+
+# Candidates tried per pass before concluding every idle truck was taken by
+# a concurrent request
+CLAIM_ATTEMPTS = 5
+
+_state = threading.local()
+
+
+class ClaimConflict(Exception):
+    """A planned truck was claimed by a concurrent request."""
+
+
+@contextmanager
+def deferred_allocation():
+    """Stop ``handle_order_creation`` assigning trucks to orders saved inside the block."""
+    previous = getattr(_state, 'deferred', False)
+    _state.deferred = True
+    try:
+        yield
+    finally:
+        _state.deferred = previous
+
+
+def allocation_deferred():
+    return getattr(_state, 'deferred', False)
+
+
+def claim_truck(quantity):
+    """Reserve the best-fitting idle truck for ``quantity`` and return its id.
+
+    The best fit is the smallest truck that can carry the whole quantity. If no
+    idle truck is big enough, the largest one is used and the order takes
+    several trips. Returns ``None`` when no truck is idle.
+    """
+    idle = Truck.objects.filter(status='idle')
+    passes = [
+        idle.filter(capacity__gte=quantity).order_by('capacity', 'id'),
+        idle.order_by('-capacity', 'id'),
+    ]
+    for candidates in passes:
+        for truck_id in candidates.values_list('id', flat=True)[:CLAIM_ATTEMPTS]:
+            claimed = Truck.objects.filter(pk=truck_id, status='idle').update(
+                status='reserved', updated_at=timezone.now()
+            )
+            if claimed:
+                invalidate_cached_responses(Truck)
+                publish_changes(Truck, [truck_id])
+                return truck_id
+    return None
+
+
+def assign_order(order):
+    """Create an ``assigned`` dispatch for ``order`` on a freshly claimed truck.
+
+    Returns the dispatch, or ``None`` if the order has to wait in the backlog.
+    """
+    with transaction.atomic():
+        truck_id = claim_truck(order.quantity)
+        if truck_id is None:
+            return None
+        return Dispatch.objects.create(truck_id=truck_id, order=order, status='assigned')
+
+
+def backlog():
+    """Pending orders that have no open dispatch, oldest first."""
+    open_dispatches = Dispatch.objects.filter(order=OuterRef('pk')).exclude(status='cancelled')
+    return Order.objects.filter(status='pending').filter(~Exists(open_dispatches)).order_by('created_at', 'id')
+
+
+def drain_backlog():
+    """Assign backlog orders to idle trucks until one of them runs out."""
+    idle_trucks = Truck.objects.filter(status='idle').count()
+    if not idle_trucks:
+        return []
+
+    assigned = []
+    for order_id in list(backlog().values_list('id', flat=True)[:idle_trucks]):
+        with transaction.atomic():
+            # Lock the order and re-check it, another worker may be draining too
+            order = backlog().select_for_update().filter(pk=order_id).first()
+            if order is None:
+                continue
+            dispatch = assign_order(order)
+        if dispatch is None:
+            break
+        assigned.append(dispatch)
+    return assigned
+
+
+def _insert(model, objs):
+    """INSERT ``objs`` in one statement and return True.
+
+    Backends that cannot return the ids of a multi-row INSERT (MySQL) get one
+    ``save()`` per row instead, and False is returned: the post_save handlers
+    have then already done the KPI and cache bookkeeping.
+    """
+    if connection.features.can_return_rows_from_bulk_insert:
+        model.objects.bulk_create(objs)
+        return True
+    for obj in objs:
+        obj.save()
+    return False
+
+
+def _plan(orders, idle_trucks):
+    """Pick a truck for each order from ``idle_trucks`` ((capacity, id) pairs, ascending)."""
+    pool = list(idle_trucks)
+    plan = []
+    for order in orders:
+        if not pool:
+            break
+        index = bisect.bisect_left(pool, (order.quantity,))
+        _, truck_id = pool.pop(index if index < len(pool) else -1)
+        plan.append((order, truck_id))
+    return plan
+
+
+def assign_orders(orders):
+    """Assign trucks to a batch of orders in one pass.
+
+    Orders are served in the given sequence with the same best-fit rule as
+    ``claim_truck``. Returns ``{order.pk: dispatch}`` for the orders that got
+    a truck; the rest stay in the backlog.
+    """
+    with transaction.atomic():
+        idle = Truck.objects.filter(status='idle').order_by('capacity', 'id')
+        if connection.features.has_select_for_update_skip_locked:
+            # Keep concurrent allocators away from the trucks being planned
+            idle = idle.select_for_update(skip_locked=True)
+        plan = _plan(orders, idle.values_list('capacity', 'id'))
+        if not plan:
+            return {}
+
+        try:
+            with transaction.atomic():
+                truck_ids = [truck_id for _, truck_id in plan]
+                claimed = Truck.objects.filter(pk__in=truck_ids, status='idle').update(
+                    status='reserved', updated_at=timezone.now()
+                )
+                if claimed != len(truck_ids):
+                    raise ClaimConflict
+        except ClaimConflict:
+            # Lost a race for one of the trucks: fall back to claiming one at a time
+            dispatches = (assign_order(order) for order in orders)
+            return {dispatch.order_id: dispatch for dispatch in dispatches if dispatch}
+        invalidate_cached_responses(Truck)
+        publish_changes(Truck, truck_ids)
+
+        dispatches = [Dispatch(truck_id=truck_id, order=order, status='assigned') for order, truck_id in plan]
+        if _insert(Dispatch, dispatches):
+            KPISnapshot.adjust(active_dispatches=len(dispatches))
+            invalidate_cached_responses(Dispatch)
+            publish_changes(Dispatch, [dispatch.pk for dispatch in dispatches])
+        return {dispatch.order_id: dispatch for dispatch in dispatches}
+
+
+def create_orders(validated_data):
+    """Insert a batch of orders and assign trucks to the pending ones in one pass.
+
+    ``validated_data`` is the output of ``OrderSerializer(many=True)``.
+    Returns the orders and the ``{order.pk: dispatch}`` mapping.
+    """
+    with transaction.atomic():
+        orders = [Order(**attrs) for attrs in validated_data]
+        with deferred_allocation():
+            bulk = _insert(Order, orders)
+        if bulk:
+            KPISnapshot.adjust(pending_orders=sum(order.status == 'pending' for order in orders))
+            for order in orders:
+                if order.status == 'completed':
+                    DailyOrderKPI.adjust(timezone.localdate(order.updated_at), 1)
+            invalidate_cached_responses(Order)
+            publish_changes(Order, [order.pk for order in orders])
+        dispatches = assign_orders([order for order in orders if order.status == 'pending'])
+    return orders, dispatches
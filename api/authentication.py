@@ -0,0 +1,149 @@
+"""
+JWT authentication without a database query per request.
+
+Tokens from ``issue_tokens`` (login, registration and refresh) carry the
+user's role and the user fields requests read as signed claims, plus
+``claims_version``: a digest of those values and ``is_active``.
+``ClaimsJWTAuthentication`` builds ``request.user`` from the claims, with its
+``userprofile`` attached, so the permission checks and operator filters read
+the role without a query. Other user fields are deferred: reading one loads
+it, and saving the user writes only the claimed fields.
+
+When a user's claimed fields, role or ``is_active`` change, the current digest
+no longer matches and their tokens get ``401 token_not_valid``; the client
+refreshes (``/api/auth/refresh/``), which re-reads the user. The current
+digest comes from the ``AUTH_CACHE_ALIAS`` cache, and from the database on a
+miss; the model signal handlers drop it on every change. With a per-process
+cache other workers notice a change within ``AUTH_CLAIMS_CACHE_SECONDS``.
+
+Bump ``CLAIMS_SCHEMA`` when the claims change shape, so every token is
+refreshed. Tokens without claims still authenticate, from the database.
+"""
+import hashlib
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.cache import caches
+from django.db import DEFAULT_DB_ALIAS, connection, transaction
+from rest_framework.exceptions import AuthenticationFailed
+from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework_simplejwt.exceptions import InvalidToken, TokenError
+from rest_framework_simplejwt.serializers import TokenRefreshSerializer
+from rest_framework_simplejwt.settings import api_settings
+from rest_framework_simplejwt.tokens import RefreshToken
+
+from .blacklist import expiry, token_blacklist
+from .models import UserProfile
+
+CLAIMS_SCHEMA = 1
+# User fields copied into tokens, read back into request.user
+USER_CLAIMS = ['username', 'first_name', 'last_name', 'is_staff', 'is_superuser']
+
+
+def _digest(values):
+    return hashlib.sha256(repr((CLAIMS_SCHEMA, *values)).encode()).hexdigest()[:16]
+
+
+def _cache_key(user_id):
+    return f'auth:claims:{user_id}'
+
+
+def user_role(user):
+    """The role in ``user``'s profile, or ``None``."""
+    return getattr(getattr(user, 'userprofile', None), 'role', None)
+
+
+class RevocableRefreshToken(RefreshToken):
+    """A refresh token checked against, and revoked into, the jti blacklist (api/blacklist.py)."""
+
+    def verify(self):
+        super().verify()
+        if token_blacklist.is_revoked(self[api_settings.JTI_CLAIM]):
+            raise TokenError('Token is blacklisted')
+
+    def blacklist(self):
+        """Revoke the token; ``False`` if it already was revoked."""
+        return token_blacklist.revoke(self[api_settings.JTI_CLAIM], expiry(self))
+
+
+def issue_tokens(user):
+    """A refresh token for ``user`` whose access token (``.access_token``) carries the claims too."""
+    refresh = RevocableRefreshToken.for_user(user)
+    role = user_role(user)
+    for name in USER_CLAIMS:
+        refresh[name] = getattr(user, name)
+    refresh['role'] = role
+    refresh['claims_version'] = _digest([*(getattr(user, name) for name in USER_CLAIMS), role, user.is_active])
+    return refresh
+
+
+def current_claims_version(user_id):
+    """The ``claims_version`` a token of the user must carry; ``''`` if the user is gone."""
+    cache = caches[settings.AUTH_CACHE_ALIAS]
+    version = cache.get(_cache_key(user_id))
+    if version is None:
+        row = User.objects.filter(pk=user_id).values_list(*USER_CLAIMS, 'userprofile__role', 'is_active').first()
+        version = _digest(row) if row else ''
+        cache.set(_cache_key(user_id), version, settings.AUTH_CLAIMS_CACHE_SECONDS)
+    return version
+
+
+def forget_claims_version(user_id):
+    """Drop the cached claims digest of ``user_id``, again on commit if in a transaction."""
+    cache = caches[settings.AUTH_CACHE_ALIAS]
+    cache.delete(_cache_key(user_id))
+    if connection.in_atomic_block:
+        # A request reading before the commit may have cached the old values
+        transaction.on_commit(lambda: cache.delete(_cache_key(user_id)))
+
+
+def _from_db(model, values):
+    names = [field.attname for field in model._meta.concrete_fields if field.attname in values]
+    return model.from_db(DEFAULT_DB_ALIAS, names, [values[name] for name in names])
+
+
+def user_from_claims(token):
+    """A ``User`` built from the token's claims, as if loaded with ``only()``."""
+    # Tokens hold the id as a string
+    user_id = User._meta.pk.to_python(token[api_settings.USER_ID_CLAIM])
+    user = _from_db(User, {'id': user_id, 'is_active': True, **{name: token[name] for name in USER_CLAIMS}})
+    if token['role'] is None:
+        # Cache the missing profile, so hasattr(user, 'userprofile') is free too
+        User.userprofile.related.set_cached_value(user, None)
+    else:
+        user.userprofile = _from_db(UserProfile, {'user_id': user_id, 'role': token['role']})
+    return user
+
+
+class ClaimsJWTAuthentication(JWTAuthentication):
+    """``JWTAuthentication`` that takes the user and role from the token's claims."""
+
+    def get_user(self, validated_token):
+        if 'claims_version' not in validated_token:
+            return super().get_user(validated_token)
+        if validated_token['claims_version'] != current_claims_version(validated_token[api_settings.USER_ID_CLAIM]):
+            raise InvalidToken('The account changed since this token was issued; refresh it')
+        return user_from_claims(validated_token)
+
+
+class ClaimsTokenRefreshSerializer(TokenRefreshSerializer):
+    """Refresh with claims re-read from the database rather than copied from the old token."""
+    token_class = RevocableRefreshToken
+
+    def validate(self, attrs):
+        refresh = self.token_class(attrs['refresh'])
+        user = User.objects.select_related('userprofile').filter(
+            pk=refresh.payload.get(api_settings.USER_ID_CLAIM), is_active=True
+        ).first()
+        if user is None:
+            raise AuthenticationFailed(self.error_messages['no_active_account'], 'no_active_account')
+
+        # Revoke first: of concurrent refreshes of one token, only the one
+        # that revoked it is issued new tokens
+        if api_settings.ROTATE_REFRESH_TOKENS and api_settings.BLACKLIST_AFTER_ROTATION and not refresh.blacklist():
+            raise TokenError('Token is blacklisted')
+        fresh = issue_tokens(user)
+        data = {'access': str(fresh.access_token)}
+        if api_settings.ROTATE_REFRESH_TOKENS:
+            data['refresh'] = str(fresh)
+        return data
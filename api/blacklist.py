@@ -0,0 +1,178 @@
+"""
+Refresh-token blacklist keyed by ``jti``.
+
+Logout and refresh-token rotation revoke the old refresh token: a
+``RevokedToken`` row kept only until the token would have expired anyway.
+Every refresh asks ``token_blacklist`` whether its token was revoked. The
+answer comes from an in-process Bloom filter of the revoked ids, so the usual
+"no" costs no query; a "maybe" is confirmed by a unique-index lookup. Either
+way the cost does not depend on how many tokens are revoked.
+
+The filter learns of revocations made by other processes by reading the rows
+created since it last looked (a ``created_at`` index range, usually empty).
+It looks when the blacklist generation in the ``AUTH_CACHE_ALIAS`` cache has
+moved, which is immediate with a shared cache, and at least every
+``TOKEN_BLACKLIST_SYNC_SECONDS`` otherwise. It is rebuilt from the unexpired
+rows when full or an hour old, which also sheds expired ids.
+
+Expired rows are deleted oldest expiry first, ``TOKEN_BLACKLIST_PRUNE_BATCH``
+at a time in short transactions: one batch after every
+``TOKEN_BLACKLIST_PRUNE_EVERY`` revocations, or all of them with
+``python manage.py compact_token_blacklist``.
+"""
+import hashlib
+import math
+import threading
+import time
+from datetime import datetime, timedelta, timezone as dt_timezone
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import IntegrityError, transaction
+from django.utils import timezone
+
+from .models import RevokedToken
+
+# Rows created this long before the last look are read again, for
+# transactions that committed after it and for clock skew between servers
+CATCH_UP_OVERLAP = timedelta(seconds=10)
+REBUILD_SECONDS = 3600
+FALSE_POSITIVE_RATE = 0.001
+GENERATION_KEY = 'auth:blacklist:generation'
+
+
+class BloomFilter:
+    """A set of strings that may report false positives but never false negatives."""
+
+    def __init__(self, capacity, error_rate=FALSE_POSITIVE_RATE):
+        self.capacity = capacity
+        self.size = max(64, math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+
+    def _positions(self, key):
+        # Double hashing: k positions from two 64-bit halves of one digest
+        digest = hashlib.blake2b(key.encode(), digest_size=16).digest()
+        first, second = int.from_bytes(digest[:8], 'little'), int.from_bytes(digest[8:], 'little') | 1
+        return [(first + i * second) % self.size for i in range(self.hashes)]
+
+    def add(self, key):
+        for position in self._positions(key):
+            self.bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def __contains__(self, key):
+        return all(self.bits[position >> 3] & (1 << (position & 7)) for position in self._positions(key))
+
+
+class TokenBlacklist:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._filter = None
+        self._built_at = 0
+        self._looked_at = None
+        self._looked_monotonic = 0
+        self._generation = None
+        self._revocations = 0
+
+    @property
+    def cache(self):
+        return caches[settings.AUTH_CACHE_ALIAS]
+
+    def revoke(self, jti, expires_at):
+        """Blacklist the token ``jti`` until ``expires_at``; ``False`` if it already was.
+
+        The insert decides, not ``is_revoked``: of two requests revoking the
+        same token at once, only one gets ``True``.
+        """
+        try:
+            with transaction.atomic():
+                RevokedToken.objects.create(jti=jti, expires_at=expires_at)
+        except IntegrityError:
+            return False
+        try:
+            generation = self.cache.incr(GENERATION_KEY)
+        except ValueError:
+            generation = None
+            self.cache.add(GENERATION_KEY, time.time_ns(), timeout=None)
+        with self._lock:
+            if self._filter is not None:
+                self._filter.add(jti)
+                if generation is not None and self._generation is not None and generation == self._generation + 1:
+                    # Only our own revocation since the last look: nothing to catch up on
+                    self._generation = generation
+            self._revocations += 1
+            prune = self._revocations % settings.TOKEN_BLACKLIST_PRUNE_EVERY == 0
+        if prune:
+            prune_expired(batches=1)
+        return True
+
+    def is_revoked(self, jti):
+        with self._lock:
+            self._refresh()
+            if jti not in self._filter:
+                return False
+        return RevokedToken.objects.filter(jti=jti).exists()
+
+    def reset(self):
+        """Drop the filter; the next check rebuilds it from the database."""
+        with self._lock:
+            self._filter = None
+
+    def _refresh(self):
+        full = self._filter is None or self._filter.count >= self._filter.capacity
+        if full or time.monotonic() - self._built_at > REBUILD_SECONDS:
+            self._rebuild()
+            return
+        generation = self.cache.get(GENERATION_KEY)
+        if (generation != self._generation
+                or time.monotonic() - self._looked_monotonic > settings.TOKEN_BLACKLIST_SYNC_SECONDS):
+            self._catch_up(generation)
+
+    def _rebuild(self):
+        generation, now = self.cache.get(GENERATION_KEY), timezone.now()
+        live = list(RevokedToken.objects.filter(expires_at__gt=now).values_list('jti', flat=True))
+        self._filter = BloomFilter(max(settings.TOKEN_BLACKLIST_BLOOM_CAPACITY, 2 * len(live)))
+        for jti in live:
+            self._filter.add(jti)
+        self._built_at = time.monotonic()
+        self._mark(generation, now)
+
+    def _catch_up(self, generation):
+        now = timezone.now()
+        for jti in RevokedToken.objects.filter(created_at__gte=self._looked_at - CATCH_UP_OVERLAP).values_list(
+                'jti', flat=True):
+            if jti not in self._filter:
+                self._filter.add(jti)
+        self._mark(generation, now)
+
+    def _mark(self, generation, now):
+        self._generation = generation
+        self._looked_at = now
+        self._looked_monotonic = time.monotonic()
+
+
+def prune_expired(batches=None):
+    """Delete expired rows, oldest expiry first, a batch per query. Returns how many."""
+    batch_size = settings.TOKEN_BLACKLIST_PRUNE_BATCH
+    now = timezone.now()
+    deleted = 0
+    while batches is None or batches > 0:
+        ids = list(RevokedToken.objects.filter(expires_at__lte=now).order_by('expires_at')
+                   .values_list('pk', flat=True)[:batch_size])
+        if ids:
+            deleted += RevokedToken.objects.filter(pk__in=ids).delete()[0]
+        if len(ids) < batch_size:
+            break
+        if batches is not None:
+            batches -= 1
+    return deleted
+
+
+def expiry(token):
+    """When ``token`` (a validated simplejwt token) expires."""
+    return datetime.fromtimestamp(token['exp'], tz=dt_timezone.utc)
+
+
+token_blacklist = TokenBlacklist()
@@ -0,0 +1,280 @@
+"""
+Versioned response cache for read-mostly endpoints.
+
+Cached payloads are keyed by scope (one per endpoint), a scope version and the
+request path with its query string. Writes never delete entries: the model
+signal handlers bump the version of every scope a model feeds, so stale entries
+simply stop being addressed and age out.
+
+Versions live in the database (``ResponseCacheScope``), read in one query and
+bumped with one atomic ``UPDATE``, so every worker addresses the same version
+and a write invalidates the entries of all of them. Inside a transaction the
+bump waits for the commit: the scopes a transaction touches are bumped
+together, and no version row stays locked while it runs.
+
+Entries are immutable once addressed by a version, so they may sit in
+per-process memory. Two layers are used:
+
+* a bounded in-process LRU, so hot entries cost no cache round trip, and
+* the Django cache named by ``RESPONSE_CACHE_ALIAS`` (local-memory by default,
+  or file-based to share entries between gunicorn workers). No Redis or
+  memcached is required.
+
+Both layers drop an entry after the backend's ``TIMEOUT``, since not every
+response depends only on rows: the entries of ``DAILY_SCOPES`` (today's KPI
+counts) are also keyed by the date.
+
+Hit/miss counts are kept per process and added to the scope rows every
+``STATS_FLUSH_SECONDS``, and whenever the stats are read.
+
+Scope versions double as HTTP validators: cached function views answer
+``If-None-Match``/``If-Modified-Since`` from the ETag stored with the entry,
+and viewsets mix the versions into theirs (``ConditionalGetMixin`` in
+api/views.py). Each bump also records when the scope last changed, for
+``Last-Modified``.
+"""
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from functools import wraps
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import connection, transaction
+from django.db.models import F
+from django.utils import timezone
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.utils.http import http_date
+from rest_framework.response import Response
+
+from .renderers import FastJSONRenderer
+
+# Longest a process keeps hit/miss counts before adding them to the scope rows
+STATS_FLUSH_SECONDS = 10
+# Scopes whose responses count "today", and so change at midnight
+DAILY_SCOPES = {'kpi'}
+
+
+class ResponseCache:
+    def __init__(self, alias, max_local_entries):
+        self.alias = alias
+        self.max_local_entries = max_local_entries
+        self._local = OrderedDict()
+        self._lock = threading.Lock()
+        self._pending_stats = {}
+        self._stats_flushed_at = time.monotonic()
+        # Scopes bumped by this thread's open transaction
+        self._thread = threading.local()
+
+    @property
+    def backend(self):
+        return caches[self.alias]
+
+    @property
+    def scopes(self):
+        from .models import ResponseCacheScope
+        return ResponseCacheScope.objects
+
+    def version(self, scope):
+        return self.state([scope])[0][0]
+
+    def bump(self, *scopes):
+        """Invalidate every cached response of the given scopes (once the transaction commits)."""
+        if not connection.in_atomic_block:
+            self._bump(scopes)
+            return
+        pending = getattr(self._thread, 'bumps', None)
+        if pending is None:
+            pending = self._thread.bumps = set()
+        pending.update(scopes)
+        # Registered each time: a callback may be dropped with a rolled-back
+        # savepoint. The first to run bumps them all.
+        transaction.on_commit(self._bump_pending)
+
+    def _bump_pending(self):
+        scopes, self._thread.bumps = getattr(self._thread, 'bumps', None), None
+        if scopes:
+            self._bump(sorted(scopes))
+
+    def _bump(self, scopes):
+        rows = self.scopes.filter(scope__in=scopes)
+        changes = {'version': F('version') + 1, 'changed_at': timezone.now()}
+        if rows.update(**changes) < len(scopes):
+            self.create_scopes(scopes)
+            # Also counts for rows created concurrently, before ours was ignored
+            rows.update(**changes)
+
+    def create_scopes(self, scopes):
+        """Make the rows of ``scopes`` that do not exist yet."""
+        from .models import ResponseCacheScope
+        # Seed versions from the clock rather than 1: if the rows are ever
+        # deleted, new versions can never address entries cached under the old
+        self.scopes.bulk_create([
+            ResponseCacheScope(scope=scope, version=time.time_ns(), changed_at=timezone.now()) for scope in scopes
+        ], ignore_conflicts=True)
+
+    def state(self, scopes):
+        """Return the versions of ``scopes`` and the timestamp of the latest change to any of them."""
+        rows = {scope: (version, changed) for scope, version, changed in
+                self.scopes.filter(scope__in=scopes).values_list('scope', 'version', 'changed_at')}
+        missing = [scope for scope in scopes if scope not in rows]
+        if missing:
+            # A scope never seen before counts as changed now
+            self.create_scopes(missing)
+            rows.update({scope: (version, changed) for scope, version, changed in
+                         self.scopes.filter(scope__in=missing).values_list('scope', 'version', 'changed_at')})
+        versions = [rows[scope][0] for scope in scopes]
+        changed = max((rows[scope][1].timestamp() for scope in scopes), default=0)
+        return versions, changed
+
+    def key(self, scope, request):
+        digest = hashlib.md5(request.get_full_path().encode()).hexdigest()
+        if scope in DAILY_SCOPES:
+            return f'response:{scope}:{self.version(scope)}:{timezone.localdate():%Y%m%d}:{digest}'
+        return f'response:{scope}:{self.version(scope)}:{digest}'
+
+    def get(self, scope, request):
+        key = self.key(scope, request)
+        with self._lock:
+            entry = self._local.get(key)
+            if entry is not None:
+                self._local.move_to_end(key)
+        if entry is None:
+            entry = self.backend.get(key)
+            if entry is not None:
+                self._remember(key, entry)
+        data = None
+        if entry is not None:
+            expires_at, data = entry
+            if expires_at is not None and time.time() >= expires_at:
+                data = None
+        self._count(scope, 'hits' if data is not None else 'misses')
+        return key, data
+
+    def set(self, key, data):
+        timeout = self.backend.default_timeout
+        # Stored with the entry, so the local copy of a shared entry expires with it
+        entry = (None if timeout is None else time.time() + timeout, data)
+        self.backend.set(key, entry)
+        self._remember(key, entry)
+
+    def _remember(self, key, entry):
+        with self._lock:
+            self._local[key] = entry
+            self._local.move_to_end(key)
+            while len(self._local) > self.max_local_entries:
+                self._local.popitem(last=False)
+
+    def clear(self):
+        """Drop every cached entry of this process and of the cache backend."""
+        with self._lock:
+            self._local.clear()
+        self.backend.clear()
+
+    def _count(self, scope, outcome):
+        with self._lock:
+            counts = self._pending_stats.setdefault(scope, {'hits': 0, 'misses': 0})
+            counts[outcome] += 1
+            due = time.monotonic() - self._stats_flushed_at >= STATS_FLUSH_SECONDS
+        if due:
+            self.flush_stats()
+
+    def flush_stats(self):
+        """Add this process's hit/miss counts to the scope rows."""
+        with self._lock:
+            pending, self._pending_stats = self._pending_stats, {}
+            self._stats_flushed_at = time.monotonic()
+        for scope, counts in pending.items():
+            self.scopes.filter(scope=scope).update(hits=F('hits') + counts['hits'], misses=F('misses') + counts['misses'])
+
+    def stats(self, scopes):
+        self.flush_stats()
+        counters = {row[0]: row[1:] for row in
+                    self.scopes.filter(scope__in=scopes).values_list('scope', 'hits', 'misses')}
+        result = {}
+        for scope in scopes:
+            hits, misses = counters.get(scope, (0, 0))
+            result[scope] = {
+                'hits': hits,
+                'misses': misses,
+                'hit_rate': round(hits / (hits + misses), 3) if hits + misses else None,
+            }
+        return result
+
+
+response_cache = ResponseCache(
+    alias=getattr(settings, 'RESPONSE_CACHE_ALIAS', 'default'),
+    max_local_entries=getattr(settings, 'RESPONSE_CACHE_LOCAL_ENTRIES', 256),
+)
+
+# Scopes used by the views, for reporting
+CACHE_SCOPES = ['kpi', 'operators', 'trucks', 'materials']
+
+
+def make_etag(*parts):
+    return '"%s"' % hashlib.md5(repr(parts).encode()).hexdigest()
+
+
+def conditional(request, etag, last_modified, respond):
+    """Return ``304 Not Modified`` if the client's copy matches, else ``respond()``.
+
+    Successful responses carry the validators and must be revalidated before
+    a client reuses them.
+    """
+    last_modified = int(last_modified)
+    response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+    if response is None:
+        response = respond()
+        if response.status_code != 200:
+            return response
+    response['ETag'] = etag
+    response['Last-Modified'] = http_date(last_modified)
+    patch_cache_control(response, private=True, no_cache=True)
+    return response
+
+
+def cached_response(scope):
+    """Cache the ``Response.data`` of a successful GET function view.
+
+    The entry also keeps a digest of the data and the time it was built, the
+    ETag and ``Last-Modified`` of the response, so a client holding the same
+    data gets ``304 Not Modified`` without the view running.
+
+    Apply below ``@api_view``/``@permission_classes`` so authentication and
+    permission checks still run on every request.
+    """
+    def decorator(view):
+        @wraps(view)
+        def wrapper(request, *args, **kwargs):
+            key, entry = response_cache.get(scope, request)
+            if entry is not None:
+                digest, built_at, data = entry
+                return conditional(request, make_etag(digest, request.accepted_media_type), built_at,
+                                   lambda: Response(data, headers={'X-Cache': 'HIT'}))
+            response = view(request, *args, **kwargs)
+            if response.status_code != 200:
+                return response
+            digest = hashlib.md5(FastJSONRenderer().render(response.data)).hexdigest()
+            built_at = time.time()
+            response_cache.set(key, (digest, built_at, response.data))
+            response['X-Cache'] = 'MISS'
+            return conditional(request, make_etag(digest, request.accepted_media_type), built_at,
+                               lambda: response)
+        return wrapper
+    return decorator
+
+
+class CachedListMixin:
+    """Serve ``list`` responses of a viewset from the response cache."""
+    cache_scope = None
+
+    def list(self, request, *args, **kwargs):
+        key, data = response_cache.get(self.cache_scope, request)
+        if data is not None:
+            return Response(data, headers={'X-Cache': 'HIT'})
+        response = super().list(request, *args, **kwargs)
+        if response.status_code == 200:
+            response_cache.set(key, response.data)
+            response['X-Cache'] = 'MISS'
+        return response
@@ -0,0 +1,258 @@
+"""
+Real-time change events for the Server-Sent Events stream (``/api/events/``).
+
+Saves and deletes of dispatches, orders, trucks and exceptions (the model
+signal handlers), and the queryset ``UPDATE``s of the workflow and allocation
+services, call ``publish_changes``/``publish_deleted``. Once the transaction
+commits, the changed rows are read in one query per model and handed to the
+in-process ``event_bus``, which encodes each event once and fans it out to the
+subscribed streams of this process. While nothing is subscribed the rows are
+not read at all.
+
+Admins receive every event; operators only events about dispatches assigned
+to them (and those dispatches' orders, trucks and exceptions).
+
+The bus keeps the last ``EVENT_REPLAY_SIZE`` events. Event ids carry a token
+of the process that issued them, so a client reconnecting with
+``Last-Event-ID`` gets the events it missed from the same process, and a
+``reset`` event (refetch over REST) if the id is from another process or has
+left the buffer. A subscriber that falls ``EVENT_QUEUE_SIZE`` events behind
+gets ``reset`` and is disconnected rather than buffered without bound.
+
+Only writes made by this process are published. Under several workers (see
+``Procfile``) a subscriber only receives the writes served by its own worker,
+and reconnecting to another worker gets ``reset``.
+"""
+import asyncio
+import secrets
+import threading
+from collections import deque
+
+from django.conf import settings
+from django.db import transaction
+
+from .models import Dispatch, ExceptionLog, Order, Truck
+from .renderers import FastJSONRenderer
+
+# Event name and payload fields of each published model
+EVENT_TYPES = {Dispatch: 'dispatch', Order: 'order', Truck: 'truck', ExceptionLog: 'exception'}
+EVENT_FIELDS = {
+    Dispatch: ['id', 'status', 'truck', 'order', 'operator', 'updated_at'],
+    Order: ['id', 'status', 'customer', 'material_type', 'quantity', 'updated_at'],
+    Truck: ['id', 'number_plate', 'status', 'updated_at'],
+    ExceptionLog: ['id', 'dispatch', 'exception_type', 'resolved', 'updated_at'],
+}
+# How to find the operators of a row's dispatches: (payload field, dispatch
+# lookup it matches, extra dispatch filters). Dispatch rows name theirs; a
+# truck belongs to the operators of its unfinished dispatches.
+AUDIENCE = {
+    Order: ('id', 'order_id', {}),
+    Truck: ('id', 'truck_id', {'status__in': [
+        status for status, _ in Dispatch.STATUS_CHOICES if status not in ('completed', 'cancelled')
+    ]}),
+    ExceptionLog: ('dispatch', 'pk', {}),
+}
+
+RESET = b'event: reset\ndata: {}\n\n'
+KEEP_ALIVE = b': keep-alive\n\n'
+
+
+def _audience(model, rows):
+    """Return ``{pk: operator ids}`` of the dispatches ``rows`` belong to."""
+    if model is Dispatch:
+        return {row['id']: {row['operator']} for row in rows}
+    field, lookup, filters = AUDIENCE[model]
+    keys = {row[field] for row in rows}
+    operators = {}
+    for key, operator_id in Dispatch.objects.filter(**{f'{lookup}__in': keys}, **filters).values_list(
+            lookup, 'operator_id'):
+        operators.setdefault(key, set()).add(operator_id)
+    return {row['id']: operators.get(row[field], set()) for row in rows}
+
+
+def _events(model, rows, action):
+    audience = _audience(model, rows)
+    return [(EVENT_TYPES[model], {'action': action, 'object': row}, frozenset(audience[row['id']] - {None}))
+            for row in rows]
+
+
+def _emit_changes(model, pks):
+    if not event_bus.subscriber_count():
+        event_bus.skip()
+        return
+    rows = list(model.objects.filter(pk__in=pks).values(*EVENT_FIELDS[model]))
+    if rows:
+        event_bus.emit(_events(model, rows, 'updated'))
+
+
+def publish_changes(model, pks):
+    """Publish the current state of rows ``pks`` of ``model`` once the transaction commits."""
+    pks = list(pks)
+    if pks:
+        transaction.on_commit(lambda: _emit_changes(model, pks), robust=True)
+
+
+def publish_deleted(instance):
+    """Publish the deletion of ``instance`` once the transaction commits."""
+    if not event_bus.subscriber_count():
+        event_bus.skip()
+        return
+    model = type(instance)
+    row = {name: getattr(instance, model._meta.get_field(name).attname) for name in EVENT_FIELDS[model]}
+    # Read now: the dispatches linking the row to operators may go with it
+    events = _events(model, [row], 'deleted')
+    transaction.on_commit(lambda: event_bus.emit(events), robust=True)
+
+
+class Subscription:
+    """One stream's queue of encoded events, fed from any thread."""
+
+    def __init__(self, bus, user_id, admin, last_event_id):
+        self.bus = bus
+        self.user_id = user_id
+        self.admin = admin
+        self.last_event_id = last_event_id
+        self.loop = None
+        self.queue = None
+        self.closed = False
+
+    def sees(self, operators):
+        return self.admin or self.user_id in operators
+
+    def deliver(self, events):
+        # Runs on the subscriber's event loop
+        for frame, operators in events:
+            if self.closed or not self.sees(operators):
+                continue
+            if self.queue.qsize() >= settings.EVENT_QUEUE_SIZE:
+                # Too far behind: make the client refetch instead of growing
+                self.closed = True
+                while not self.queue.empty():
+                    self.queue.get_nowait()
+                self.queue.put_nowait(RESET)
+                self.queue.put_nowait(None)
+                self.bus.unsubscribe(self)
+                return
+            self.queue.put_nowait(frame)
+
+    def keep_alive(self):
+        if self.queue.empty():
+            self.queue.put_nowait(KEEP_ALIVE)
+
+    async def frames(self):
+        """The encoded SSE frames of this stream, until the client goes away."""
+        self.loop = asyncio.get_running_loop()
+        self.queue = asyncio.Queue()
+        # Subscribed once iterated, on the loop that serves the response
+        replay = self.bus.subscribe(self)
+        try:
+            yield b'retry: %d\n\n' % (settings.EVENT_RETRY_SECONDS * 1000)
+            if replay is None:
+                yield RESET
+            else:
+                for frame, operators in replay:
+                    if self.sees(operators):
+                        yield frame
+            while True:
+                frame = await self.queue.get()
+                if frame is None:
+                    return
+                yield frame
+        finally:
+            self.bus.unsubscribe(self)
+
+
+class EventBus:
+    def __init__(self, replay_size):
+        # Identifies this process in event ids
+        self.token = secrets.token_hex(4)
+        self._last = 0
+        self._replay = deque(maxlen=replay_size)
+        self._subscribers = {}
+        self._keep_alive_timers = {}
+        self._lock = threading.Lock()
+        self._renderer = FastJSONRenderer()
+
+    def emit(self, events):
+        """Encode ``(event type, payload, operator ids)`` events and deliver them to every subscriber."""
+        with self._lock:
+            batch = []
+            for event_type, payload, operators in events:
+                self._last = sequence = self._last + 1
+                frame = b'id: %s-%d\nevent: %s\ndata: %s\n\n' % (
+                    self.token.encode(), sequence, event_type.encode(), self._renderer.render(payload)
+                )
+                batch.append((frame, operators))
+                self._replay.append((sequence, frame, operators))
+            # Inside the lock, so every loop gets the batches in id order;
+            # one wake-up per event loop, however many streams it serves
+            for loop, subscriptions in list(self._subscribers.items()):
+                try:
+                    loop.call_soon_threadsafe(_deliver, list(subscriptions), batch)
+                except RuntimeError:
+                    # The loop was closed under its streams
+                    del self._subscribers[loop]
+                    self._keep_alive_timers.pop(loop, None)
+
+    def skip(self):
+        """Record events left unpublished for lack of subscribers.
+
+        The gap leaves the replay buffer: a client reconnecting with an
+        earlier id gets ``reset`` rather than a silent hole.
+        """
+        with self._lock:
+            self._last += 1
+            self._replay.clear()
+
+    def subscribe(self, subscription):
+        """Register ``subscription`` and return the buffered events it missed.
+
+        ``None`` means the ones it missed are unknown: it should start over.
+        """
+        with self._lock:
+            self._subscribers.setdefault(subscription.loop, set()).add(subscription)
+            if subscription.loop not in self._keep_alive_timers:
+                # One timer per event loop rather than a timeout per stream
+                self._keep_alive_timers[subscription.loop] = subscription.loop.call_later(
+                    settings.EVENT_KEEPALIVE_SECONDS, self._keep_alive, subscription.loop
+                )
+            if not subscription.last_event_id:
+                return []
+            token, _, sequence = subscription.last_event_id.partition('-')
+            if token != self.token or not sequence.isdigit():
+                return None
+            sequence = int(sequence)
+            oldest = self._replay[0][0] if self._replay else self._last + 1
+            if sequence < oldest - 1:
+                return None
+            return [(frame, operators) for number, frame, operators in self._replay if number > sequence]
+
+    def _keep_alive(self, loop):
+        with self._lock:
+            subscriptions = list(self._subscribers.get(loop, ()))
+            if subscriptions:
+                self._keep_alive_timers[loop] = loop.call_later(settings.EVENT_KEEPALIVE_SECONDS, self._keep_alive, loop)
+            else:
+                del self._keep_alive_timers[loop]
+        for subscription in subscriptions:
+            subscription.keep_alive()
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            subscriptions = self._subscribers.get(subscription.loop)
+            if subscriptions is not None:
+                subscriptions.discard(subscription)
+                if not subscriptions:
+                    del self._subscribers[subscription.loop]
+
+    def subscriber_count(self):
+        with self._lock:
+            return sum(len(subscriptions) for subscriptions in self._subscribers.values())
+
+
+def _deliver(subscriptions, batch):
+    for subscription in subscriptions:
+        subscription.deliver(batch)
+
+
+event_bus = EventBus(replay_size=settings.EVENT_REPLAY_SIZE)
@@ -0,0 +1,129 @@
+"""
+Flat CSV / NDJSON exports of dispatch, order and exception history.
+
+``EXPORT_COLUMNS`` lists the columns of each export, joined columns included.
+Rows are read as tuples in primary-key order, ``EXPORT_BATCH_SIZE`` at a time.
+Each batch continues from the last key it saw (``pk > last``), so every query
+is a short index range scan whatever the offset. Memory stays constant on
+every backend, even where the database driver buffers a whole result set
+(MySQL), which rules out one ``iterator()`` over millions of rows.
+"""
+import csv
+from datetime import datetime
+
+from django.conf import settings
+from django.db.models import F
+from django.http import StreamingHttpResponse
+from django.utils import timezone
+from rest_framework import serializers
+
+from .models import Dispatch, ExceptionLog, Order
+from .renderers import FastJSONRenderer, streaming_content
+
+# (header, lookup or expression); the primary key comes first
+EXPORT_COLUMNS = {
+    Dispatch: [
+        ('id', 'id'),
+        ('status', 'status'),
+        ('truck_number_plate', 'truck__number_plate'),
+        ('truck_driver', 'truck__driver_name'),
+        ('order', 'order_id'),
+        ('customer', 'order__customer__name'),
+        ('material', 'order__material_type'),
+        ('quantity', 'order__quantity'),
+        ('operator', 'operator__username'),
+        ('departure_time', 'departure_time'),
+        ('start_journey_time', 'start_journey_time'),
+        ('weigh_in_time', 'weigh_in_time'),
+        ('gross_weight', 'gross_weight'),
+        ('unload_time', 'unload_time'),
+        ('weigh_out_time', 'weigh_out_time'),
+        ('tare_weight', 'tare_weight'),
+        ('net_weight', F('gross_weight') - F('tare_weight')),
+        ('arrival_time', 'arrival_time'),
+        ('completion_time', 'completion_time'),
+        ('created_at', 'created_at'),
+        ('updated_at', 'updated_at'),
+    ],
+    Order: [
+        ('id', 'id'),
+        ('customer_id', 'customer_id'),
+        ('customer', 'customer__name'),
+        ('material_type', 'material_type'),
+        ('quantity', 'quantity'),
+        ('status', 'status'),
+        ('created_at', 'created_at'),
+        ('updated_at', 'updated_at'),
+    ],
+    ExceptionLog: [
+        ('id', 'id'),
+        ('dispatch', 'dispatch_id'),
+        ('truck_number_plate', 'dispatch__truck__number_plate'),
+        ('order', 'dispatch__order_id'),
+        ('exception_type', 'exception_type'),
+        ('description', 'description'),
+        ('resolved', 'resolved'),
+        ('resolved_by', 'resolved_by__username'),
+        ('resolved_at', 'resolved_at'),
+        ('created_at', 'created_at'),
+        ('updated_at', 'updated_at'),
+    ],
+}
+
+EXPORT_FORMATS = {'csv': 'text/csv', 'ndjson': 'application/x-ndjson'}
+
+# Same timestamps as the API responses
+_datetime_field = serializers.DateTimeField()
+
+
+def export_rows(queryset, batch_size=None):
+    """Yield the export rows of ``queryset`` as tuples in ``EXPORT_COLUMNS`` order."""
+    columns = EXPORT_COLUMNS[queryset.model]
+    batch_size = batch_size or settings.EXPORT_BATCH_SIZE
+    annotations = {header: value for header, value in columns if not isinstance(value, str)}
+    lookups = [value if isinstance(value, str) else header for header, value in columns]
+    queryset = queryset.prefetch_related(None).annotate(**annotations).order_by('pk').values_list(*lookups)
+
+    last = None
+    while True:
+        batch = list((queryset if last is None else queryset.filter(pk__gt=last))[:batch_size])
+        for row in batch:
+            yield tuple(_datetime_field.to_representation(value) if isinstance(value, datetime) else value
+                        for value in row)
+        if len(batch) < batch_size:
+            return
+        last = batch[-1][0]
+
+
+class _Echo:
+    """A file-like object for ``csv.writer`` that hands each line back."""
+    def write(self, value):
+        return value
+
+
+def csv_lines(queryset, batch_size=None):
+    writer = csv.writer(_Echo())
+    yield writer.writerow([header for header, _ in EXPORT_COLUMNS[queryset.model]])
+    for row in export_rows(queryset, batch_size):
+        yield writer.writerow(row)
+
+
+def ndjson_lines(queryset, batch_size=None):
+    renderer = FastJSONRenderer()
+    headers = [header for header, _ in EXPORT_COLUMNS[queryset.model]]
+    for row in export_rows(queryset, batch_size):
+        yield renderer.render(dict(zip(headers, row))) + b'\n'
+
+
+def export_lines(queryset, export_format, batch_size=None):
+    """The lines of a ``csv`` or ``ndjson`` export (``str`` for CSV, ``bytes`` for NDJSON)."""
+    lines = csv_lines if export_format == 'csv' else ndjson_lines
+    return lines(queryset, batch_size)
+
+
+def export_response(request, queryset, export_format, name):
+    lines = streaming_content(request, export_lines(queryset, export_format), settings.EXPORT_BATCH_SIZE)
+    response = StreamingHttpResponse(lines, content_type=EXPORT_FORMATS[export_format])
+    filename = f'{name}-{timezone.localdate():%Y%m%d}.{export_format}'
+    response['Content-Disposition'] = f'attachment; filename="{filename}"'
+    return response
@@ -0,0 +1,58 @@
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.test.utils import CaptureQueriesContext
+from rest_framework.test import APIClient
+from rest_framework_simplejwt.tokens import RefreshToken
+from api.authentication import issue_tokens
+from api.models import UserProfile
+
+# (role, endpoint) pairs to measure
+REQUESTS = [
+    ('operator', '/api/dispatches/'),
+    ('operator', '/api/exceptions/'),
+    ('operator', '/api/sync/'),
+    ('admin', '/api/trucks/'),
+    ('admin', '/api/dashboard/kpi/'),
+    ('admin', '/api/dashboard/cache-stats/'),
+]
+
+
+class Rollback(Exception):
+    pass
+
+
+class Command(BaseCommand):
+    help = 'Count the queries per request with database-loaded and claims-carrying tokens (nothing is kept)'
+
+    def handle(self, *args, **options):
+        try:
+            with transaction.atomic():
+                self.compare()
+                raise Rollback
+        except Rollback:
+            pass
+
+    def compare(self):
+        users = {}
+        for role in ('admin', 'operator'):
+            users[role] = User.objects.create_user(f'benchmark_auth_{role}')
+            UserProfile.objects.create(user=users[role], role=role)
+        client = APIClient(SERVER_NAME=settings.ALLOWED_HOSTS[0])
+
+        self.stdout.write(f'{"Request":<44} {"Database user":>14} {"Token claims":>13}')
+        totals = [0, 0]
+        for role, url in REQUESTS:
+            counts = []
+            for token in (RefreshToken.for_user(users[role]), issue_tokens(users[role])):
+                client.credentials(HTTP_AUTHORIZATION=f'Bearer {token.access_token}')
+                client.get(url)  # Warm the response and claims caches
+                with CaptureQueriesContext(connection) as queries:
+                    status = client.get(url).status_code
+                counts.append(len(queries))
+            totals = [total + count for total, count in zip(totals, counts)]
+            self.stdout.write(f'{f"{role} GET {url} ({status})":<44} {counts[0]:>14} {counts[1]:>13}')
+        self.stdout.write(self.style.SUCCESS(
+            f'{"Total":<44} {totals[0]:>14} {totals[1]:>13}  ({totals[0] - totals[1]} fewer queries)'
+        ))
@@ -0,0 +1,84 @@
+import time
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from rest_framework.renderers import JSONRenderer
+from rest_framework.request import Request
+from rest_framework.test import APIRequestFactory
+from api.models import Customer, Dispatch, DispatchMedia, Material, Order, Truck
+from api.serializers import DispatchSerializer, OrderSerializer, Projection, shape_queryset
+
+
+class Rollback(Exception):
+    pass
+
+
+class Command(BaseCommand):
+    help = 'Compare serializer and values() projection rendering of the dispatch and order lists (nothing is kept)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dispatches', type=int, default=2000, help='Dispatches (and orders) to render')
+        parser.add_argument('--photos', type=int, default=2, help='Media rows per dispatch')
+        parser.add_argument('--repeat', type=int, default=3, help='Runs per path; the best one counts')
+
+    def handle(self, *args, **options):
+        rows = options['dispatches']
+        self.stdout.write(f'Rendering {rows} dispatches with {options["photos"]} photos each...\n')
+        try:
+            with transaction.atomic():
+                self.populate(rows, options['photos'])
+                for url, serializer_class in [('/api/dispatches/', DispatchSerializer), ('/api/orders/', OrderSerializer)]:
+                    self.compare(url, serializer_class, options['repeat'])
+                raise Rollback
+        except Rollback:
+            pass
+
+    def populate(self, rows, photos):
+        operator = User.objects.create_user('benchmark_operator', first_name='Bench', last_name='Mark')
+        Material.objects.get_or_create(name='Benchmark Coal', defaults={'stock_quantity': rows * 10})
+        customer = Customer.objects.create(name='Benchmark Customer', contact='0000000000')
+        Truck.objects.bulk_create(
+            Truck(number_plate=f'BENCH-{number}', capacity=20, driver_name='Benchmark') for number in range(rows)
+        )
+        for number in range(rows):
+            # Each order reserves one of the idle trucks
+            Order.objects.create(customer=customer, material_type='Benchmark Coal', quantity=5 + number % 10)
+        dispatches = Dispatch.objects.filter(order__customer=customer)
+        dispatches.update(operator=operator)
+        DispatchMedia.objects.bulk_create(
+            DispatchMedia(dispatch_id=pk, media_type='weigh_in', image=f'dispatch_media/bench/{pk}_{photo}.jpg',
+                          uploaded_by=operator)
+            for pk in dispatches.values_list('pk', flat=True) for photo in range(photos)
+        )
+
+    def compare(self, url, serializer_class, repeat):
+        request = Request(APIRequestFactory().get(url, HTTP_HOST=settings.ALLOWED_HOSTS[0]))
+        serializer = serializer_class(context={'request': request})
+        queryset = serializer_class.Meta.model.objects.order_by('-created_at', '-id')
+        projection = Projection.of(serializer)
+
+        def serialize():
+            return serializer_class(shape_queryset(queryset, serializer), many=True, context={'request': request}).data
+
+        def project():
+            return projection.render(projection.values(queryset))
+
+        results = {}
+        for label, path in [('Serializer', serialize), ('Projection', project)]:
+            best = None
+            for _ in range(repeat):
+                started = time.perf_counter()
+                data = path()
+                elapsed = time.perf_counter() - started
+                best = elapsed if best is None else min(best, elapsed)
+            results[label] = (best, JSONRenderer().render(data), len(data))
+
+        self.stdout.write(url)
+        for label, (seconds, payload, count) in results.items():
+            self.stdout.write(f'{label:>14}: {seconds:7.3f}s  {count / seconds:10.0f} rows/s  {len(payload):9d} bytes')
+        identical = results['Serializer'][1] == results['Projection'][1]
+        speed_up = results['Serializer'][0] / results['Projection'][0]
+        style = self.style.SUCCESS if identical else self.style.ERROR
+        self.stdout.write(style(f'Speed-up: {speed_up:.1f}x, output {"identical" if identical else "DIFFERS"}\n'))
@@ -0,0 +1,83 @@
+import os
+import tempfile
+import time
+from io import BytesIO
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.test.utils import override_settings
+from PIL import Image
+from rest_framework.test import APIClient
+from api.media import process, stage_upload
+from api.models import Customer, DispatchMedia, Order, Truck, UserProfile
+
+
+class Rollback(Exception):
+    pass
+
+
+class Command(BaseCommand):
+    help = 'Measure a dispatch list page with each image rendition: render time, JSON and image bytes (nothing is kept)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dispatches', type=int, default=20, help='Dispatches on the page')
+        parser.add_argument('--photos', type=int, default=3, help='Photos per dispatch')
+        parser.add_argument('--repeat', type=int, default=5, help='Renders per variant (the median is reported)')
+
+    def handle(self, *args, **options):
+        with tempfile.TemporaryDirectory() as media_root, override_settings(
+            MEDIA_ROOT=media_root, MEDIA_STAGING_ROOT=os.path.join(media_root, 'staging'), MEDIA_PROCESSING_WORKERS=0
+        ):
+            try:
+                with transaction.atomic():
+                    client = self.setup_page(options['dispatches'], options['photos'])
+                    self.stdout.write(
+                        f"Dispatch list page: {options['dispatches']} dispatches x {options['photos']} photos\n"
+                    )
+                    for variant in DispatchMedia.VARIANTS:
+                        self.report(client, variant, options['dispatches'], options['repeat'])
+                    raise Rollback
+            except Rollback:
+                pass
+
+    def setup_page(self, dispatches, photos):
+        admin = User.objects.create_user('benchmark_media_admin')
+        UserProfile.objects.create(user=admin, role='admin')
+        customer = Customer.objects.create(name='Benchmark Customer', contact='0000000000')
+        # A weighbridge-slip sized photo; noise keeps JPEG from compressing it away
+        buffer = BytesIO()
+        Image.effect_noise((3000, 2000), 40).convert('RGB').save(buffer, format='JPEG', quality=90)
+        photo = buffer.getvalue()
+
+        for number in range(dispatches):
+            Truck.objects.create(number_plate=f'BENCH-{number}', capacity=50, driver_name='Benchmark')
+            dispatch = Order.objects.create(customer=customer, material_type='Coal', quantity=10).dispatches.get()
+            for _ in range(photos):
+                media = stage_upload(SimpleUploadedFile('slip.jpg', photo), dispatch=dispatch, media_type='weigh_in')
+                process(media.pk)
+
+        client = APIClient()
+        client.force_authenticate(admin)
+        return client
+
+    def report(self, client, variant, dispatches, repeat):
+        url = f'/api/dispatches/?page_size={dispatches}&variant={variant}'
+        timings = []
+        for _ in range(repeat):
+            started = time.perf_counter()
+            response = client.get(url, HTTP_HOST=settings.ALLOWED_HOSTS[0])
+            timings.append(time.perf_counter() - started)
+        timings.sort()
+
+        image_bytes = 0
+        for dispatch in response.json()['results']:
+            for media in dispatch['media_files']:
+                relative = media['image_url'].split(settings.MEDIA_URL, 1)[1]
+                image_bytes += os.path.getsize(os.path.join(settings.MEDIA_ROOT, relative))
+        self.stdout.write(
+            f'{variant:>10}: render {timings[len(timings) // 2] * 1000:7.1f} ms  '
+            f'JSON {len(response.content) / 1024:7.1f} KiB  images {image_bytes / 1024 / 1024:8.2f} MiB'
+        )
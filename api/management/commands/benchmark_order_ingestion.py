@@ -0,0 +1,68 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.test.utils import CaptureQueriesContext
+from api.allocation import create_orders
+from api.models import Customer, Truck
+from api.serializers import OrderSerializer
+
+
+class Rollback(Exception):
+    pass
+
+
+class Command(BaseCommand):
+    help = 'Compare one-at-a-time order creation with the bulk ingestion path (nothing is kept)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rows', type=int, default=500, help='Orders per run')
+        parser.add_argument('--trucks', type=int, default=100, help='Idle trucks available to each run')
+
+    def handle(self, *args, **options):
+        rows, trucks = options['rows'], options['trucks']
+        self.stdout.write(f'Ingesting {rows} orders with {trucks} idle trucks...\n')
+        
+        single = self.run(self.one_at_a_time, rows, trucks)
+        bulk = self.run(self.bulk, rows, trucks)
+        
+        for label, (seconds, queries) in [('One at a time', single), ('Bulk', bulk)]:
+            self.stdout.write(
+                f'{label:>14}: {seconds:7.3f}s  {rows / seconds:9.1f} orders/s  {queries:6d} queries'
+            )
+        self.stdout.write(self.style.SUCCESS(f'Speed-up: {single[0] / bulk[0]:.1f}x'))
+
+    def run(self, path, rows, trucks):
+        """Time ``path`` inside a transaction that is always rolled back."""
+        try:
+            with transaction.atomic():
+                customer = Customer.objects.create(name='Benchmark Customer', contact='0000000000')
+                for number in range(trucks):
+                    Truck.objects.create(
+                        number_plate=f'BENCH-{number}', capacity=10 + number % 40, driver_name='Benchmark'
+                    )
+                data = [
+                    {'customer': customer.pk, 'material_type': 'Coal', 'quantity': 5 + number % 30}
+                    for number in range(rows)
+                ]
+                with CaptureQueriesContext(connection) as queries:
+                    started = time.perf_counter()
+                    path(data)
+                    elapsed = time.perf_counter() - started
+                raise Rollback
+        except Rollback:
+            pass
+        return elapsed, len(queries)
+
+    def one_at_a_time(self, data):
+        # What OrderViewSet.create does for each POST /api/orders/
+        for row in data:
+            serializer = OrderSerializer(data=row)
+            serializer.is_valid(raise_exception=True)
+            serializer.save()
+
+    def bulk(self, data):
+        # What POST /api/orders/bulk/ does for the whole sheet
+        serializer = OrderSerializer.for_bulk(data)
+        serializer.is_valid(raise_exception=True)
+        create_orders(serializer.validated_data)
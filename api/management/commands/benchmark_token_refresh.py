@@ -0,0 +1,65 @@
+import time
+import uuid
+from datetime import timedelta
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.utils import timezone
+from rest_framework.test import APIClient
+from api.authentication import issue_tokens
+from api.blacklist import token_blacklist
+from api.models import RevokedToken, UserProfile
+
+
+class Rollback(Exception):
+    pass
+
+
+class Command(BaseCommand):
+    help = 'Time token refreshes as the refresh-token blacklist grows (nothing is kept)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', type=int, nargs='+', default=[0, 10000, 100000, 500000],
+                            help='Blacklist sizes to measure at')
+        parser.add_argument('--refreshes', type=int, default=200, help='Refreshes timed at each size')
+
+    def handle(self, *args, **options):
+        try:
+            with transaction.atomic():
+                self.measure(options['sizes'], options['refreshes'])
+                raise Rollback
+        except Rollback:
+            pass
+        # The filter saw rows that were rolled back
+        token_blacklist.reset()
+
+    def measure(self, sizes, refreshes):
+        user = User.objects.create_user('benchmark_refresh')
+        UserProfile.objects.create(user=user, role='operator')
+        client = APIClient(SERVER_NAME=settings.ALLOWED_HOSTS[0])
+        revoked_at = timezone.now() - timedelta(hours=1)
+        expires_at = revoked_at + timedelta(days=7)
+        self.stdout.write(f'{"Blacklisted":>12} {"Median":>10} {"p99":>10}')
+        filled = 0
+        for size in sorted(sizes):
+            # Revoked a while ago, not during the last catch-up window
+            RevokedToken.objects.bulk_create(
+                (RevokedToken(jti=uuid.uuid4().hex, expires_at=expires_at, created_at=revoked_at)
+                 for _ in range(size - filled)),
+                batch_size=5000,
+            )
+            filled = size
+            token_blacklist.reset()  # Rebuilt by the first refresh, as after a restart
+            refresh = str(issue_tokens(user))
+            latencies = []
+            for _ in range(refreshes + 1):
+                started = time.perf_counter()
+                response = client.post('/api/auth/refresh/', {'refresh': refresh})
+                latencies.append(time.perf_counter() - started)
+                refresh = response.data['refresh']
+            # The first refresh includes the rebuild
+            latencies = sorted(latencies[1:])
+            self.stdout.write(f'{size:>12} {latencies[len(latencies) // 2] * 1000:>8.2f}ms '
+                              f'{latencies[int(len(latencies) * 0.99)] * 1000:>8.2f}ms')
@@ -0,0 +1,10 @@
+from django.core.management.base import BaseCommand
+from api.stock import checkpoint
+
+
+class Command(BaseCommand):
+    help = 'Record the current stock of every material, for fast point-in-time stock queries (run periodically)'
+
+    def handle(self, *args, **options):
+        checkpoints = checkpoint()
+        self.stdout.write(self.style.SUCCESS(f'Recorded {len(checkpoints)} stock checkpoints'))
@@ -0,0 +1,13 @@
+from django.core.management.base import BaseCommand
+from api.blacklist import prune_expired
+from api.models import RevokedToken
+
+
+class Command(BaseCommand):
+    help = 'Delete blacklisted refresh tokens that have expired (run daily)'
+
+    def handle(self, *args, **options):
+        deleted = prune_expired()
+        self.stdout.write(self.style.SUCCESS(
+            f'Deleted {deleted} expired tokens; {RevokedToken.objects.count()} still blacklisted'
+        ))
@@ -0,0 +1,40 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.test import RequestFactory
+from api.export import EXPORT_FORMATS, export_lines
+from api.views import DispatchViewSet, ExceptionLogViewSet, OrderViewSet
+
+VIEWSETS = {'dispatches': DispatchViewSet, 'orders': OrderViewSet, 'exceptions': ExceptionLogViewSet}
+
+
+class Command(BaseCommand):
+    help = 'Write the dispatch, order or exception history to a CSV or NDJSON file'
+
+    def add_arguments(self, parser):
+        parser.add_argument('resource', choices=sorted(VIEWSETS))
+        parser.add_argument('output', help='File to write')
+        parser.add_argument('--format', choices=sorted(EXPORT_FORMATS), default='csv')
+        parser.add_argument(
+            '--filter', action='append', default=[], metavar='NAME=VALUE',
+            help='A list endpoint filter, e.g. --filter status=completed (repeatable)',
+        )
+
+    def handle(self, *args, **options):
+        params = {}
+        for item in options['filter']:
+            name, sep, value = item.partition('=')
+            if not sep:
+                raise CommandError(f'Filters are NAME=VALUE, got "{item}"')
+            params[name] = value
+
+        # Build the queryset the list endpoint would, so the filters behave the same
+        view = VIEWSETS[options['resource']](action_map={'get': 'export'}, format_kwarg=None)
+        view.request = view.initialize_request(RequestFactory().get('/', params))
+        queryset = view.filter_queryset(view.get_queryset())
+
+        rows = -1 if options['format'] == 'csv' else 0  # Not counting the CSV header
+        mode, encoding = ('w', 'utf-8') if options['format'] == 'csv' else ('wb', None)
+        with open(options['output'], mode, encoding=encoding, newline='' if encoding else None) as output:
+            for line in export_lines(queryset, options['format']):
+                output.write(line)
+                rows += 1
+        self.stdout.write(self.style.SUCCESS(f"Wrote {rows} {options['resource']} to {options['output']}"))
@@ -0,0 +1,20 @@
+from django.core.management.base import BaseCommand
+from api.media import generate_variants
+from api.models import DispatchMedia
+
+
+class Command(BaseCommand):
+    help = 'Generate thumbnail and medium renditions for processed images that do not have them yet'
+
+    def handle(self, *args, **options):
+        missing = DispatchMedia.objects.filter(processing_state='ready', thumbnail='').exclude(image='')
+        generated = failed = 0
+        for media in missing.iterator():
+            try:
+                generate_variants(media)
+                generated += 1
+            except OSError as exc:
+                failed += 1
+                self.stdout.write(self.style.WARNING(f'Media #{media.pk}: {exc}'))
+
+        self.stdout.write(self.style.SUCCESS(f'Generated renditions for {generated} images ({failed} failed)'))
@@ -0,0 +1,132 @@
+import asyncio
+import resource
+import sys
+import threading
+import time
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from rest_framework_simplejwt.tokens import AccessToken
+from api.events import event_bus
+from api.models import UserProfile
+from backend.asgi import application
+
+
+class Subscriber:
+    """One idle /api/events/ client, talking ASGI straight to the application."""
+
+    def __init__(self, scope, fanout):
+        self.scope = scope
+        self.fanout = fanout
+        self.connected = asyncio.Event()
+        self.disconnect = asyncio.Event()
+        self.status = None
+        self._body_sent = False
+
+    async def receive(self):
+        if not self._body_sent:
+            self._body_sent = True
+            return {'type': 'http.request', 'body': b'', 'more_body': False}
+        await self.disconnect.wait()
+        return {'type': 'http.disconnect'}
+
+    async def send(self, message):
+        if message['type'] == 'http.response.start':
+            self.status = message['status']
+            if self.status != 200:
+                self.connected.set()
+        elif message['type'] == 'http.response.body':
+            body = message.get('body', b'')
+            if body.startswith(b'retry:'):
+                self.connected.set()
+            elif body.startswith(b'id:'):
+                self.fanout.received()
+
+    async def run(self):
+        await application(self.scope, self.receive, self.send)
+
+
+class Fanout:
+    """Counts the subscribers that got the current event."""
+
+    def __init__(self):
+        self.expected = 0
+        self.count = 0
+        self.done = asyncio.Event()
+
+    def start(self, expected):
+        self.expected, self.count = expected, 0
+        self.done.clear()
+
+    def received(self):
+        self.count += 1
+        if self.count == self.expected:
+            self.done.set()
+
+
+def peak_rss():
+    """Peak resident memory of this process, in bytes."""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+class Command(BaseCommand):
+    help = 'Open idle /api/events/ subscribers in this process and measure their cost and event fan-out'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--subscribers', type=int, default=2000, help='Concurrent idle streams to open')
+        parser.add_argument('--events', type=int, default=10, help='Events to fan out to every stream')
+
+    def handle(self, *args, **options):
+        user = User.objects.create_user('loadtest_event_stream')
+        try:
+            UserProfile.objects.create(user=user, role='admin')
+            token = str(AccessToken.for_user(user))
+            asyncio.run(self.measure(token, options['subscribers'], options['events']))
+        finally:
+            user.delete()
+
+    async def measure(self, token, count, events):
+        scope = {
+            'type': 'http', 'asgi': {'version': '3.0'}, 'http_version': '1.1', 'method': 'GET', 'scheme': 'http',
+            'path': '/api/events/', 'raw_path': b'/api/events/', 'query_string': f'token={token}'.encode(),
+            'headers': [(b'host', settings.ALLOWED_HOSTS[0].encode()), (b'accept', b'text/event-stream')],
+            'server': ('127.0.0.1', 8000), 'client': ('127.0.0.1', 40000),
+        }
+        fanout = Fanout()
+        subscribers = [Subscriber(scope, fanout) for _ in range(count)]
+        threads = threading.active_count()
+        baseline = peak_rss()
+
+        started = time.perf_counter()
+        tasks = [asyncio.create_task(subscriber.run()) for subscriber in subscribers]
+        await asyncio.gather(*(subscriber.connected.wait() for subscriber in subscribers))
+        connect_seconds = time.perf_counter() - started
+        failed = sum(subscriber.status != 200 for subscriber in subscribers)
+        held = peak_rss() - baseline
+
+        self.stdout.write(f'Subscribers:     {count - failed} connected, {failed} refused')
+        self.stdout.write(f'Connect time:    {connect_seconds:.2f}s ({count / connect_seconds:.0f}/s)')
+        self.stdout.write(f'Memory (RSS):    +{held / 2 ** 20:.1f} MiB ({held / count / 1024:.1f} KiB per subscriber)')
+        self.stdout.write(f'Threads:         {threading.active_count() - threads} more than before')
+        self.stdout.write(f'Bus subscribers: {event_bus.subscriber_count()}')
+
+        latencies = []
+        for number in range(events):
+            fanout.start(count - failed)
+            started = time.perf_counter()
+            event_bus.emit([('loadtest', {'action': 'updated', 'object': {'id': number}}, frozenset())])
+            await fanout.done.wait()
+            latencies.append(time.perf_counter() - started)
+        if latencies:
+            latencies.sort()
+            self.stdout.write(
+                f'Fan-out:         {latencies[len(latencies) // 2] * 1000:.1f} ms median, '
+                f'{latencies[-1] * 1000:.1f} ms worst to reach every subscriber'
+            )
+
+        for subscriber in subscribers:
+            subscriber.disconnect.set()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self.stdout.write(self.style.SUCCESS(f'Disconnected; bus subscribers left: {event_bus.subscriber_count()}'))
@@ -0,0 +1,13 @@
+from django.core.management.base import BaseCommand
+from api.stock import checkpoint, open_ledgers
+
+
+class Command(BaseCommand):
+    help = 'Write the opening stock balance of materials that predate the stock ledger (run once, then checkpoint)'
+
+    def handle(self, *args, **options):
+        opened = open_ledgers()
+        checkpoints = checkpoint()
+        self.stdout.write(self.style.SUCCESS(
+            f'Opened the ledger of {len(opened)} materials; recorded {len(checkpoints)} stock checkpoints'
+        ))
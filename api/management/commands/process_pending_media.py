@@ -0,0 +1,22 @@
+from django.core.management.base import BaseCommand
+from api.media import process_pending
+
+
+class Command(BaseCommand):
+    help = 'Process dispatch media uploads still waiting in the staging area (e.g. after a restart)'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--include-processing',
+            action='store_true',
+            help='Also retry uploads stuck in "processing" (only when no web process is running)',
+        )
+
+    def handle(self, *args, **options):
+        counts = process_pending(include_processing=options['include_processing'])
+        self.stdout.write(
+            self.style.SUCCESS(
+                f"Processed {sum(counts.values())} uploads: "
+                f"{counts.get('ready', 0)} ready, {counts.get('failed', 0)} failed"
+            )
+        )
@@ -0,0 +1,23 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from api.models import KPISnapshot, DailyOrderKPI
+
+
+class Command(BaseCommand):
+    help = 'Recompute the KPI dashboard counters from the raw tables'
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            snapshot = KPISnapshot.rebuild()
+            DailyOrderKPI.rebuild()
+
+        self.stdout.write(
+            self.style.SUCCESS(
+                'KPI counters rebuilt:\n'
+                f'  Trucks: {snapshot.total_trucks}\n'
+                f'  Active dispatches: {snapshot.active_dispatches}\n'
+                f'  Pending orders: {snapshot.pending_orders}\n'
+                f'  Exceptions: {snapshot.total_exceptions} ({snapshot.unresolved_exceptions} unresolved)\n'
+                f'  Completed deliveries: {snapshot.delivery_count}'
+            )
+        )
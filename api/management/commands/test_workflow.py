@@ -75,7 +75,7 @@ class Command(BaseCommand):
         else:
             self.stdout.write(self.style.ERROR('❌ No dispatch created automatically'))
         
-        # Check truck status (should still be idle until dispatch starts)
+        # Check truck status (should be reserved until dispatch starts)
         truck_after = Truck.objects.get(number_plate="TEST-001")
         self.stdout.write(f'Truck status after order: {truck_after.status}')
 
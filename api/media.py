@@ -0,0 +1,415 @@
+"""
+Background processing of uploaded dispatch images.
+
+An upload is streamed in chunks to ``MEDIA_STAGING_ROOT`` and recorded as a
+``pending`` ``DispatchMedia`` row, so the request returns without decoding the
+image. Once the transaction commits, a pool of ``MEDIA_PROCESSING_WORKERS``
+threads validates the image, applies and strips its EXIF data and re-encodes it
+into ``MEDIA_ROOT``; clients poll ``processing_state`` until it is ``ready`` or
+``failed``. ``python manage.py process_pending_media`` picks up uploads left
+behind by a restarted process.
+
+Each image is stored once in every size of ``VARIANT_SIZES`` next to the
+original, so lists can show previews without downloading full-size photos.
+
+Processed images are content-addressed: a ``MediaBlob`` holds the renditions of
+one distinct upload, keyed by the SHA-256 of its bytes, and counts the media
+rows that use it. Re-uploading the same slip (a retry, or the same ticket for
+weigh-in and weigh-out) only adds a reference; nothing is staged, decoded or
+written. Deleting the last media row of a blob deletes its files.
+
+Media URLs handed to clients are signed (``signed_media_url``) so that
+``<img>`` tags can load them without an Authorization header. The expiry is
+rounded to ``MEDIA_URL_MAX_AGE`` windows, so a URL stays the same, and stays
+cacheable, for at least one window.
+"""
+import hashlib
+import logging
+import mimetypes
+import os
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+
+from django.conf import settings
+from django.core import signing
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.db import IntegrityError, connection, transaction
+from django.db.models import F
+from django.http import FileResponse, Http404, HttpResponse, StreamingHttpResponse
+from django.utils import timezone
+from django.utils._os import safe_join
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.utils.crypto import constant_time_compare
+from django.utils.http import http_date, quote, urlencode
+from PIL import Image, ImageOps
+
+from .models import DispatchMedia, MediaBlob, invalidate_cached_responses
+
+logger = logging.getLogger(__name__)
+
+JPEG_QUALITY = 85
+# Longest edge, in pixels, of each stored rendition besides the original
+VARIANT_SIZES = {'thumbnail': 240, 'medium': 1024}
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def _media_signature(name, expires):
+    return signing.Signer(salt='api.media').signature(f'{name}:{expires}')
+
+
+def signed_media_url(name):
+    """URL of the stored file ``name`` that ``serve_media`` accepts without login."""
+    window = settings.MEDIA_URL_MAX_AGE
+    expires = (int(time.time()) // window + 2) * window
+    query = urlencode({'expires': expires, 'signature': _media_signature(name, expires)})
+    return f'{default_storage.url(name)}?{query}'
+
+
+def check_media_signature(name, expires, signature):
+    try:
+        expires = int(expires)
+    except (TypeError, ValueError):
+        return False
+    return (
+        expires > time.time()
+        and bool(signature)
+        and constant_time_compare(signature, _media_signature(name, expires))
+    )
+
+
+def media_response(request, name):
+    """Response for the stored file ``name``, once access has been checked.
+
+    The transfer is handed to the front proxy when ``MEDIA_X_ACCEL_REDIRECT`` or
+    ``MEDIA_X_SENDFILE`` is set. Otherwise the file is sent from here with
+    conditional GET (``ETag``/``Last-Modified``, 304) and single ``Range``
+    support.
+    """
+    path = safe_join(settings.MEDIA_ROOT, name)
+    try:
+        stat = os.stat(path)
+    except (FileNotFoundError, NotADirectoryError):
+        raise Http404('No such media file')
+    content_type = mimetypes.guess_type(path)[0] or 'application/octet-stream'
+    etag = f'"{stat.st_mtime_ns:x}-{stat.st_size:x}"'
+    last_modified = int(stat.st_mtime)
+
+    response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+    if response is None:
+        if settings.MEDIA_X_ACCEL_REDIRECT:
+            response = HttpResponse(content_type=content_type)
+            response['X-Accel-Redirect'] = f"{settings.MEDIA_X_ACCEL_REDIRECT.rstrip('/')}/{quote(name)}"
+        elif settings.MEDIA_X_SENDFILE:
+            response = HttpResponse(content_type=content_type)
+            response['X-Sendfile'] = path
+        else:
+            response = _file_response(request, path, stat.st_size, content_type, etag)
+    response['ETag'] = etag
+    response['Last-Modified'] = http_date(last_modified)
+    patch_cache_control(response, private=True, max_age=settings.MEDIA_CACHE_MAX_AGE, immutable=True)
+    return response
+
+
+def _file_response(request, path, size, content_type, etag):
+    byte_range = _requested_range(request, size, etag)
+    if byte_range is None:
+        response = FileResponse(open(path, 'rb'), content_type=content_type)
+    elif byte_range is False:
+        response = HttpResponse(status=416)
+        response['Content-Range'] = f'bytes */{size}'
+    else:
+        start, end = byte_range
+        response = StreamingHttpResponse(_read(path, start, end - start + 1), status=206, content_type=content_type)
+        response['Content-Length'] = end - start + 1
+        response['Content-Range'] = f'bytes {start}-{end}/{size}'
+    response['Accept-Ranges'] = 'bytes'
+    return response
+
+
+def _requested_range(request, size, etag):
+    """``(start, end)`` of a satisfiable single byte range, ``False`` if it is
+    unsatisfiable, or ``None`` to send the whole file (also for an invalid
+    range such as ``bytes=5-3``, which RFC 9110 says to ignore)."""
+    header = request.META.get('HTTP_RANGE', '')
+    if not header.startswith('bytes=') or ',' in header:
+        return None
+    if_range = request.META.get('HTTP_IF_RANGE')
+    if if_range and if_range != etag:
+        return None
+    first, _, last = header[len('bytes='):].strip().partition('-')
+    try:
+        if first:
+            start, end = int(first), int(last) if last else None
+        else:
+            start, end = max(size - int(last), 0), size - 1
+    except ValueError:
+        return None
+    if start < 0 or end is not None and end < start:
+        return None
+    if start >= size:
+        return False
+    end = size - 1 if end is None else min(end, size - 1)
+    return start, end
+
+
+def _read(path, start, length, chunk_size=64 * 1024):
+    with open(path, 'rb') as file:
+        file.seek(start)
+        while length > 0:
+            chunk = file.read(min(chunk_size, length))
+            if not chunk:
+                break
+            length -= len(chunk)
+            yield chunk
+
+
+def _pool():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(
+                max_workers=settings.MEDIA_PROCESSING_WORKERS, thread_name_prefix='media'
+            )
+        return _executor
+
+
+def stage_upload(upload, **fields):
+    """Write ``upload`` to the staging area and queue it for processing.
+
+    ``fields`` are the other ``DispatchMedia`` fields (dispatch, media_type,
+    uploaded_by, description). Returns the ``pending`` media row, or a
+    ``ready`` one if the same bytes have been uploaded before.
+    """
+    # Hash before staging: Django has already buffered the upload, and a
+    # duplicate then costs no write at all
+    digest = hashlib.sha256()
+    for chunk in upload.chunks():
+        digest.update(chunk)
+    digest = digest.hexdigest()
+
+    with transaction.atomic():
+        blob = acquire_blob(digest)
+        if blob:
+            return DispatchMedia.objects.create(
+                blob=blob, digest=digest, image=blob.image.name, thumbnail=blob.thumbnail.name,
+                medium=blob.medium.name, processing_state='ready', **fields
+            )
+
+    os.makedirs(settings.MEDIA_STAGING_ROOT, exist_ok=True)
+    extension = os.path.splitext(upload.name or '')[1].lower()[:10]
+    path = os.path.join(settings.MEDIA_STAGING_ROOT, f'{uuid.uuid4().hex}{extension}')
+    with open(path, 'wb') as staged:
+        for chunk in upload.chunks():
+            staged.write(chunk)
+
+    media = DispatchMedia.objects.create(processing_state='pending', staging_path=path, digest=digest, **fields)
+    transaction.on_commit(lambda: enqueue(media.pk))
+    return media
+
+
+def enqueue(media_id):
+    if settings.MEDIA_PROCESSING_WORKERS > 0:
+        _pool().submit(_process_in_worker, media_id)
+    else:
+        process(media_id)
+
+
+def _process_in_worker(media_id):
+    try:
+        process(media_id)
+    except Exception:
+        logger.exception('Processing dispatch media %s failed', media_id)
+    finally:
+        # Worker threads hold their own connection; do not leak it
+        connection.close()
+
+
+def process(media_id):
+    """Validate, strip and re-encode one staged upload. Returns the final state."""
+    claimed = DispatchMedia.objects.filter(pk=media_id, processing_state='pending').update(
+        processing_state='processing', updated_at=timezone.now()
+    )
+    if not claimed:
+        return None
+    invalidate_cached_responses(DispatchMedia)
+    media = DispatchMedia.objects.get(pk=media_id)
+
+    try:
+        state = _process_staged(media)
+    finally:
+        invalidate_cached_responses(DispatchMedia)
+        try:
+            os.remove(media.staging_path)
+        except OSError:
+            pass
+    return state
+
+
+def _process_staged(media):
+    try:
+        with Image.open(media.staging_path) as image:
+            image.verify()
+        with Image.open(media.staging_path) as image:
+            if image.width * image.height > settings.MEDIA_MAX_PIXELS:
+                raise ValueError(f'{image.width}x{image.height} exceeds the size limit')
+            # Bake the EXIF orientation into the pixels before dropping EXIF
+            renditions, extension = _renditions(ImageOps.exif_transpose(image))
+    except (OSError, SyntaxError, ValueError, Image.DecompressionBombError) as exc:
+        return _fail(media.pk, f'Invalid image: {exc}')
+
+    try:
+        blob = _store_blob(media.digest or _file_digest(media.staging_path), renditions, extension)
+        updated = DispatchMedia.objects.filter(pk=media.pk).update(
+            blob=blob, image=blob.image.name, thumbnail=blob.thumbnail.name, medium=blob.medium.name,
+            processing_state='ready', processing_error='', staging_path='', updated_at=timezone.now()
+        )
+    except Exception as exc:
+        # Storage or database trouble: fail now rather than stay in
+        # ``processing`` until the next restart
+        logger.exception('Storing dispatch media %s failed', media.pk)
+        return _fail(media.pk, f'Could not store image: {exc}')
+    if not updated:
+        # The media row was deleted while it was being processed
+        release_blob(blob.pk)
+    return 'ready'
+
+
+def _fail(media_id, error):
+    DispatchMedia.objects.filter(pk=media_id).update(
+        processing_state='failed', processing_error=error[:255], staging_path='', updated_at=timezone.now()
+    )
+    return 'failed'
+
+
+def _encode(image):
+    """Encode ``image`` without metadata; returns the bytes and the extension."""
+    buffer = BytesIO()
+    if image.mode in ('RGBA', 'LA', 'P'):
+        image.save(buffer, format='PNG', optimize=True)
+        return buffer.getvalue(), '.png'
+    image.convert('RGB').save(buffer, format='JPEG', quality=JPEG_QUALITY, optimize=True)
+    return buffer.getvalue(), '.jpg'
+
+
+def _renditions(image, include_original=True):
+    """Encode ``image`` in every variant size: ``({variant: bytes}, extension)``."""
+    renditions = {}
+    if include_original:
+        renditions['original'], extension = _encode(image)
+    for variant, size in VARIANT_SIZES.items():
+        resized = image.copy()
+        resized.thumbnail((size, size), Image.Resampling.LANCZOS)
+        renditions[variant], extension = _encode(resized)
+    return renditions, extension
+
+
+def _store(instance, base, renditions, extension):
+    """Save ``renditions`` into the image fields of a media row or blob."""
+    for variant, content in renditions.items():
+        field = instance.image if variant == 'original' else getattr(instance, variant)
+        suffix = '' if variant == 'original' else f'_{variant}'
+        field.save(f'{base}{suffix}{extension}', ContentFile(content), save=False)
+
+
+def _file_digest(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as file:
+        for chunk in iter(lambda: file.read(64 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def acquire_blob(digest):
+    """Take a reference to the blob stored for ``digest``; ``None`` if there is none."""
+    if not MediaBlob.objects.filter(digest=digest).update(ref_count=F('ref_count') + 1):
+        return None
+    return MediaBlob.objects.get(digest=digest)
+
+
+def _store_blob(digest, renditions, extension):
+    """Reference the blob for ``digest``, storing ``renditions`` if it is new."""
+    blob = acquire_blob(digest)
+    if blob:
+        return blob
+    blob = MediaBlob(digest=digest, ref_count=1, size=sum(len(content) for content in renditions.values()))
+    # Unique per blob, so a blob with this digest that was just deleted, and
+    # whose files are still being removed, cannot take the new files with it
+    try:
+        _store(blob, f'{digest[:2]}/{digest}-{uuid.uuid4().hex[:8]}', renditions, extension)
+    except Exception:
+        # Do not leave the renditions saved before the failure behind
+        _delete_files(blob)
+        raise
+    try:
+        with transaction.atomic():
+            blob.save()
+    except IntegrityError:
+        # The same content was processed concurrently; use that copy
+        _delete_files(blob)
+        return _store_blob(digest, renditions, extension)
+    return blob
+
+
+def release_blob(blob_id):
+    """Drop one reference to a blob; the last one deletes the blob and its files."""
+    MediaBlob.objects.filter(pk=blob_id).update(ref_count=F('ref_count') - 1)
+    blob = MediaBlob.objects.filter(pk=blob_id, ref_count=0).first()
+    if blob is None:
+        return
+    # One conditional statement: ``delete()`` selects the rows and then deletes
+    # them by id, and would take a blob acquired in between with it
+    opts = MediaBlob._meta
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f'DELETE FROM {connection.ops.quote_name(opts.db_table)} '
+            f'WHERE {connection.ops.quote_name(opts.pk.column)} = %s '
+            f"AND {connection.ops.quote_name(opts.get_field('ref_count').column)} = 0",
+            [blob_id],
+        )
+        deleted = cursor.rowcount
+    if deleted:
+        transaction.on_commit(lambda: _delete_files(blob))
+
+
+def _delete_files(blob):
+    for field in (blob.image, blob.thumbnail, blob.medium):
+        if field.name:
+            field.storage.delete(field.name)
+
+
+def generate_variants(media):
+    """Add the smaller renditions to an already processed image that lacks them."""
+    with media.image.open('rb') as original, Image.open(original) as image:
+        image.load()
+        renditions, extension = _renditions(image, include_original=False)
+    _store(media, uuid.uuid4().hex, renditions, extension)
+    DispatchMedia.objects.filter(pk=media.pk).update(
+        thumbnail=media.thumbnail.name, medium=media.medium.name, updated_at=timezone.now()
+    )
+    invalidate_cached_responses(DispatchMedia)
+
+
+def process_pending(include_processing=False):
+    """Process staged uploads inline, e.g. after a restart. Returns {state: count}.
+
+    ``include_processing`` also retries uploads left in ``processing`` by a
+    worker that died mid-way; only use it when no worker is running.
+    """
+    if include_processing:
+        DispatchMedia.objects.filter(processing_state='processing').update(
+            processing_state='pending', updated_at=timezone.now()
+        )
+        invalidate_cached_responses(DispatchMedia)
+    counts = {}
+    pending = DispatchMedia.objects.filter(processing_state='pending').order_by('created_at')
+    for media_id in pending.values_list('id', flat=True):
+        state = process(media_id)
+        if state:
+            counts[state] = counts.get(state, 0) + 1
+    return counts
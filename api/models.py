@@ -1,9 +1,12 @@
 from django.contrib.auth.models import User
-from django.db import models
+from django.db import models, transaction
 from django.core.validators import MinValueValidator
-from django.db.models.signals import post_save, post_delete
+from django.db.models import F, Q, Count, Sum, DurationField, ExpressionWrapper
+from django.db.models.functions import TruncDate
+from django.db.models.signals import post_init, post_migrate, post_save, post_delete
 from django.dispatch import receiver
 from django.utils import timezone
+from .cache import response_cache
 
 class UserProfile(models.Model):
     ROLE_CHOICES = (
@@ -19,6 +22,7 @@ class UserProfile(models.Model):
 class Truck(models.Model):
     STATUS_CHOICES = [
         ('idle', 'Idle'),
+        ('reserved', 'Reserved'),  # assigned to a dispatch that has not started yet
         ('in_transit', 'In Transit'),
     ]
     
@@ -34,6 +38,11 @@ class Truck(models.Model):
 
     class Meta:
         ordering = ['-created_at']
+        indexes = [
+            models.Index(fields=['status', '-created_at'], name='truck_status_created_idx'),
+            models.Index(fields=['status', 'capacity'], name='truck_status_capacity_idx'),
+            models.Index(fields=['-created_at', '-id'], name='truck_created_idx'),
+        ]
 
 class Customer(models.Model):
     name = models.CharField(max_length=100)
@@ -47,6 +56,9 @@ class Customer(models.Model):
 
     class Meta:
         ordering = ['name']
+        indexes = [
+            models.Index(fields=['name'], name='customer_name_idx'),
+        ]
 
 class Order(models.Model):
     STATUS_CHOICES = [
@@ -68,6 +80,12 @@ class Order(models.Model):
 
     class Meta:
         ordering = ['-created_at']
+        indexes = [
+            models.Index(fields=['-created_at', '-id'], name='order_created_idx'),
+            models.Index(fields=['status', '-created_at', '-id'], name='order_status_created_idx'),
+            models.Index(fields=['customer', 'status', '-created_at'], name='order_customer_status_idx'),
+            models.Index(fields=['status', 'updated_at'], name='order_status_updated_idx'),
+        ]
 
 class Dispatch(models.Model):
     STATUS_CHOICES = [
@@ -79,7 +97,20 @@ class Dispatch(models.Model):
         ('completed', 'Completed'),
         ('cancelled', 'Cancelled'),
     ]
-    
+    # Statuses counted as "active" on the KPI dashboard
+    ACTIVE_STATUSES = ['assigned', 'in_progress']
+    # Workflow state machine (applied by api/workflow.py). For each target
+    # status: the statuses it can be reached from, the timestamps stamped
+    # when it is first reached and the fields the request must supply.
+    TRANSITIONS = {
+        'in_transit': {'from': ['assigned'], 'stamps': ['start_journey_time', 'departure_time'], 'requires': []},
+        'weigh_in': {'from': ['in_transit'], 'stamps': ['weigh_in_time'], 'requires': ['gross_weight']},
+        'unload': {'from': ['weigh_in'], 'stamps': ['unload_time'], 'requires': []},
+        'weigh_out': {'from': ['unload'], 'stamps': ['weigh_out_time'], 'requires': ['tare_weight']},
+        'completed': {'from': ['weigh_out'], 'stamps': ['completion_time', 'arrival_time'], 'requires': []},
+        'cancelled': {'from': ['assigned', 'in_transit', 'weigh_in', 'unload', 'weigh_out'], 'stamps': [], 'requires': []},
+    }
+
     truck = models.ForeignKey(Truck, on_delete=models.CASCADE, related_name='dispatches')
     order = models.ForeignKey(Order, on_delete=models.CASCADE, related_name='dispatches')
     operator = models.ForeignKey(User, on_delete=models.SET_NULL, null=True, blank=True, 
@@ -108,6 +139,13 @@ class Dispatch(models.Model):
 
     class Meta:
         ordering = ['-created_at']
+        indexes = [
+            models.Index(fields=['-created_at', '-id'], name='dispatch_created_idx'),
+            models.Index(fields=['status', '-created_at', '-id'], name='dispatch_status_created_idx'),
+            models.Index(fields=['operator', 'status', '-created_at'], name='dispatch_operator_status_idx'),
+            models.Index(fields=['operator', 'updated_at'], name='dispatch_operator_updated_idx'),
+            models.Index(fields=['updated_at'], name='dispatch_updated_idx'),
+        ]
 
 class Material(models.Model):
     name = models.CharField(max_length=50, unique=True)
@@ -122,6 +160,73 @@ class Material(models.Model):
     class Meta:
         ordering = ['name']
 
+class StockMovement(models.Model):
+    """Append-only ledger of material stock changes.
+
+    ``quantity`` is signed (negative takes stock out). The movements of a
+    material always add up to its ``stock_quantity``: when a consumption is
+    clamped at zero, an adjustment row records the shortfall.
+    """
+    KIND_CHOICES = [
+        ('consumption', 'Consumption'),
+        ('receipt', 'Receipt'),
+        ('adjustment', 'Adjustment'),
+    ]
+
+    material = models.ForeignKey(Material, on_delete=models.CASCADE, related_name='movements')
+    kind = models.CharField(max_length=20, choices=KIND_CHOICES)
+    quantity = models.FloatField()
+    dispatch = models.ForeignKey(Dispatch, on_delete=models.SET_NULL, null=True, blank=True, related_name='stock_movements')
+    note = models.CharField(max_length=255, blank=True)
+    created_by = models.ForeignKey(User, on_delete=models.SET_NULL, null=True, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f"{self.material.name} {self.kind} {self.quantity:+}"
+
+    class Meta:
+        ordering = ['-created_at', '-id']
+        indexes = [
+            models.Index(fields=['material', 'id'], name='stock_move_material_idx'),
+        ]
+
+class StockCheckpoint(models.Model):
+    """Stock of a material up to and including ``last_movement_id``.
+
+    Point-in-time stock starts from the latest checkpoint instead of summing
+    the whole ledger. Taken by ``python manage.py checkpoint_stock``.
+    """
+    material = models.ForeignKey(Material, on_delete=models.CASCADE, related_name='checkpoints')
+    stock_quantity = models.FloatField()
+    last_movement_id = models.BigIntegerField(default=0)
+    taken_at = models.DateTimeField(default=timezone.now)
+
+    def __str__(self):
+        return f"{self.material.name}: {self.stock_quantity} at {self.taken_at}"
+
+    class Meta:
+        ordering = ['-taken_at']
+        indexes = [
+            models.Index(fields=['material', '-taken_at'], name='stock_checkpoint_idx'),
+        ]
+
+class MediaBlob(models.Model):
+    """A processed image, stored once however many media rows use it.
+
+    Keyed by the SHA-256 of the uploaded bytes; ``ref_count`` is the number of
+    ``DispatchMedia`` rows pointing at it (see api/media.py).
+    """
+    digest = models.CharField(max_length=64, unique=True)
+    image = models.ImageField(upload_to='media_blobs/', blank=True)
+    thumbnail = models.ImageField(upload_to='media_blobs/', blank=True)
+    medium = models.ImageField(upload_to='media_blobs/', blank=True)
+    size = models.PositiveIntegerField(default=0)  # Bytes over all renditions
+    ref_count = models.PositiveIntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f"Blob {self.digest[:12]} ({self.ref_count} refs)"
+
 class DispatchMedia(models.Model):
     MEDIA_TYPE_CHOICES = [
         ('weigh_in', 'Weigh In'),
@@ -131,19 +236,45 @@ class DispatchMedia(models.Model):
         ('exception', 'Exception'),
         ('other', 'Other'),
     ]
+    # Renditions an image can be served as, smallest first
+    VARIANTS = ['thumbnail', 'medium', 'original']
+    # Uploads are staged and processed in the background (see api/media.py)
+    PROCESSING_STATE_CHOICES = [
+        ('pending', 'Pending'),
+        ('processing', 'Processing'),
+        ('ready', 'Ready'),
+        ('failed', 'Failed'),
+    ]
     
     dispatch = models.ForeignKey(Dispatch, on_delete=models.CASCADE, related_name='media_files')
     media_type = models.CharField(max_length=20, choices=MEDIA_TYPE_CHOICES, default='other')
-    image = models.ImageField(upload_to='dispatch_media/%Y/%m/%d/')
+    image = models.ImageField(upload_to='dispatch_media/%Y/%m/%d/', blank=True)
+    # Smaller renditions of ``image``, generated once with it
+    thumbnail = models.ImageField(upload_to='dispatch_media/%Y/%m/%d/', blank=True)
+    medium = models.ImageField(upload_to='dispatch_media/%Y/%m/%d/', blank=True)
     description = models.TextField(blank=True, null=True)
     uploaded_by = models.ForeignKey(User, on_delete=models.SET_NULL, null=True, blank=True)
+    processing_state = models.CharField(max_length=20, choices=PROCESSING_STATE_CHOICES, default='ready')
+    processing_error = models.CharField(max_length=255, blank=True)
+    staging_path = models.CharField(max_length=255, blank=True)  # Staged upload awaiting processing
+    # The files above belong to ``blob``; uploads made before blobs have none
+    blob = models.ForeignKey(MediaBlob, on_delete=models.PROTECT, null=True, blank=True, related_name='media')
+    digest = models.CharField(max_length=64, blank=True)  # SHA-256 of the upload
     created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
 
     def __str__(self):
         return f"Media #{self.id} - {self.dispatch.truck.number_plate} ({self.media_type})"
 
     class Meta:
         ordering = ['-created_at']
+        indexes = [
+            models.Index(fields=['-created_at', '-id'], name='media_created_idx'),
+            models.Index(fields=['dispatch', 'media_type', '-created_at'], name='media_dispatch_type_idx'),
+            models.Index(fields=['media_type', '-created_at'], name='media_type_created_idx'),
+            models.Index(fields=['processing_state', 'created_at'], name='media_processing_idx'),
+            models.Index(fields=['updated_at'], name='media_updated_idx'),
+        ]
 
 class ExceptionLog(models.Model):
     dispatch = models.ForeignKey(Dispatch, on_delete=models.CASCADE, related_name='exceptions')
@@ -160,94 +291,455 @@ class ExceptionLog(models.Model):
 
     class Meta:
         ordering = ['-created_at']
+        indexes = [
+            models.Index(fields=['-created_at', '-id'], name='exception_created_idx'),
+            models.Index(fields=['resolved', '-created_at', '-id'], name='exception_resolved_idx'),
+            models.Index(fields=['dispatch', 'resolved'], name='exception_dispatch_idx'),
+            models.Index(fields=['updated_at'], name='exception_updated_idx'),
+        ]
+
+class SyncTombstone(models.Model):
+    """A dispatch, media or exception row gone from ``/api/sync/`` (see api/sync.py).
+
+    Written when the row is deleted, and for the previous operator when a
+    dispatch is reassigned. ``operator`` is the operator whose dispatch the row
+    belonged to; admins see every tombstone. Pruned after
+    ``SYNC_TOMBSTONE_DAYS`` by ``python manage.py prune_sync_tombstones``.
+    """
+    RESOURCE_CHOICES = [
+        ('dispatches', 'Dispatch'),
+        ('media', 'Dispatch Media'),
+        ('exceptions', 'Exception'),
+    ]
+
+    resource = models.CharField(max_length=20, choices=RESOURCE_CHOICES)
+    object_id = models.BigIntegerField()
+    operator = models.ForeignKey(User, on_delete=models.CASCADE, null=True, blank=True, related_name='+')
+    deleted_at = models.DateTimeField(default=timezone.now)
+
+    def __str__(self):
+        return f"{self.resource} #{self.object_id} removed at {self.deleted_at}"
+
+    class Meta:
+        ordering = ['deleted_at']
+        indexes = [
+            models.Index(fields=['deleted_at'], name='tombstone_deleted_idx'),
+            models.Index(fields=['operator', 'deleted_at'], name='tombstone_operator_idx'),
+        ]
+
+class RevokedToken(models.Model):
+    """A refresh token that may no longer be used, until it expires anyway (see api/blacklist.py)."""
+    jti = models.CharField(max_length=64, unique=True)
+    expires_at = models.DateTimeField()
+    created_at = models.DateTimeField(default=timezone.now)
+
+    def __str__(self):
+        return f"Token {self.jti} revoked until {self.expires_at}"
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['expires_at'], name='revoked_expires_idx'),
+            models.Index(fields=['created_at'], name='revoked_created_idx'),
+        ]
+
+class KPISnapshot(models.Model):
+    """Running dashboard counters, kept current by the signal handlers below.
+
+    There is a single row (``pk=1``). Every change is an atomic ``F()``
+    increment, so concurrent workers never overwrite each other. Run
+    ``python manage.py rebuild_kpis`` to recompute it if it ever drifts.
+    """
+    SINGLETON_PK = 1
+
+    total_trucks = models.IntegerField(default=0)
+    active_dispatches = models.IntegerField(default=0)
+    pending_orders = models.IntegerField(default=0)
+    total_exceptions = models.IntegerField(default=0)
+    unresolved_exceptions = models.IntegerField(default=0)
+    delivery_seconds_total = models.FloatField(default=0)
+    delivery_count = models.IntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"KPI snapshot ({self.updated_at})"
+
+    @property
+    def average_delivery_hours(self):
+        if not self.delivery_count:
+            return 0
+        return self.delivery_seconds_total / self.delivery_count / 3600
+
+    @classmethod
+    def current(cls):
+        return cls.objects.filter(pk=cls.SINGLETON_PK).first() or cls.rebuild()
+
+    @classmethod
+    def adjust(cls, **deltas):
+        """Atomically add ``deltas`` to the named counters."""
+        deltas = {field: delta for field, delta in deltas.items() if delta}
+        if not deltas:
+            return
+        updated = cls.objects.filter(pk=cls.SINGLETON_PK).update(
+            updated_at=timezone.now(),
+            **{field: F(field) + delta for field, delta in deltas.items()}
+        )
+        if not updated:
+            # First write ever: the raw tables already include this change.
+            cls.rebuild()
+
+    @classmethod
+    def record_delivery(cls, departure_time, arrival_time, sign=1):
+        if departure_time and arrival_time:
+            cls.adjust(
+                delivery_seconds_total=sign * (arrival_time - departure_time).total_seconds(),
+                delivery_count=sign,
+            )
+
+    @classmethod
+    def rebuild(cls):
+        """Recompute every counter from the raw tables."""
+        dispatch_stats = Dispatch.objects.aggregate(
+            active=Count('id', filter=Q(status__in=Dispatch.ACTIVE_STATUSES)),
+            delivery_total=Sum(
+                ExpressionWrapper(F('arrival_time') - F('departure_time'), output_field=DurationField()),
+                filter=Q(status='completed', departure_time__isnull=False, arrival_time__isnull=False),
+            ),
+            delivery_count=Count(
+                'id', filter=Q(status='completed', departure_time__isnull=False, arrival_time__isnull=False)
+            ),
+        )
+        exception_stats = ExceptionLog.objects.aggregate(
+            total=Count('id'),
+            unresolved=Count('id', filter=Q(resolved=False)),
+        )
+        delivery_total = dispatch_stats['delivery_total']
+        snapshot, _ = cls.objects.update_or_create(pk=cls.SINGLETON_PK, defaults={
+            'total_trucks': Truck.objects.count(),
+            'active_dispatches': dispatch_stats['active'],
+            'pending_orders': Order.objects.filter(status='pending').count(),
+            'total_exceptions': exception_stats['total'],
+            'unresolved_exceptions': exception_stats['unresolved'],
+            'delivery_seconds_total': delivery_total.total_seconds() if delivery_total else 0,
+            'delivery_count': dispatch_stats['delivery_count'],
+        })
+        return snapshot
+
+
+class DailyOrderKPI(models.Model):
+    """Number of orders completed on each day, maintained like ``KPISnapshot``."""
+    date = models.DateField(unique=True)
+    completed_orders = models.IntegerField(default=0)
+
+    def __str__(self):
+        return f"{self.date}: {self.completed_orders} completed"
+
+    class Meta:
+        ordering = ['-date']
+
+    @classmethod
+    def adjust(cls, date, delta):
+        if not delta or cls.objects.filter(date=date).update(completed_orders=F('completed_orders') + delta):
+            return
+        _, created = cls.objects.get_or_create(date=date, defaults={'completed_orders': delta})
+        if not created:
+            cls.objects.filter(date=date).update(completed_orders=F('completed_orders') + delta)
+
+    @classmethod
+    def completed_on(cls, date):
+        return cls.objects.filter(date=date).values_list('completed_orders', flat=True).first() or 0
+
+    @classmethod
+    def rebuild(cls):
+        days = (
+            Order.objects.filter(status='completed')
+            .annotate(day=TruncDate('updated_at'))
+            .values('day')
+            .annotate(completed=Count('id'))
+        )
+        cls.objects.all().delete()
+        cls.objects.bulk_create([cls(date=row['day'], completed_orders=row['completed']) for row in days])
+
+
+class ResponseCacheScope(models.Model):
+    """Version, last change and hit/miss counts of a response cache scope (see api/cache.py).
+
+    Kept in the database so that every worker addresses the same version: a
+    write made through one worker invalidates the cached responses of all.
+    """
+    scope = models.CharField(max_length=50, unique=True)
+    version = models.BigIntegerField()
+    changed_at = models.DateTimeField()
+    hits = models.BigIntegerField(default=0)
+    misses = models.BigIntegerField(default=0)
+
+    def __str__(self):
+        return f"{self.scope} v{self.version}"
+
+
+# Remember the status each instance was loaded with, so the post_save handlers
+# can tell which transition happened and adjust the KPI counters accordingly.
+@receiver(post_init, sender=Dispatch)
+@receiver(post_init, sender=Order)
+def remember_loaded_status(sender, instance, **kwargs):
+    # Read __dict__ directly so deferred fields are never fetched
+    instance._loaded_status = instance.__dict__.get('status') if instance.pk else None
+    instance._loaded_updated_at = instance.__dict__.get('updated_at')
+    if sender is Dispatch:
+        instance._loaded_operator_id = instance.__dict__.get('operator_id') if instance.pk else None
+
+
+@receiver(post_init, sender=ExceptionLog)
+def remember_loaded_resolved(sender, instance, **kwargs):
+    instance._loaded_resolved = instance.__dict__.get('resolved') if instance.pk else None
 
 
 # Signal handlers for automatic workflow
 @receiver(post_save, sender=Dispatch)
 def handle_dispatch_status_change(sender, instance, created, **kwargs):
-    """Handle dispatch status changes and update related entities"""
+    """Apply the workflow side effects of a status change (see ``api/workflow.py``)"""
     
-    if not created:  # Only handle updates, not creation
-        # When dispatch is completed, complete the order and update stock
-        if instance.status == 'completed':
-            # Complete the order
-            order = instance.order
-            if order.status != 'completed':
-                order.status = 'completed'
-                order.save()
-                
-                # Update material stock (reduce by order quantity)
-                try:
-                    material = Material.objects.get(name=order.material_type)
-                    material.stock_quantity -= order.quantity
-                    if material.stock_quantity < 0:
-                        material.stock_quantity = 0  # Prevent negative stock
-                    material.save()
-                except Material.DoesNotExist:
-                    # Create material if it doesn't exist
-                    Material.objects.create(
-                        name=order.material_type,
-                        stock_quantity=0,
-                        unit='tons'
-                    )
-            
-            # Return truck to idle
-            truck = instance.truck
-            truck.status = 'idle'
-            truck.save()
-            
-            # Set arrival time if not already set
-            if not instance.arrival_time:
-                instance.arrival_time = timezone.now()
-                instance.save()
-        
-        # When dispatch starts (in_transit), update truck status and order status
-        elif instance.status == 'in_transit':
-            # Update truck status to in_transit
-            truck = instance.truck
-            truck.status = 'in_transit'
-            truck.save()
-            
-            # Update order status to in_progress
-            order = instance.order
-            if order.status == 'pending':
-                order.status = 'in_progress'
-                order.save()
-            
-            # Set departure time if not already set
-            if not instance.departure_time:
-                instance.departure_time = timezone.now()
-                instance.save()
+    old_status = None if created else instance._loaded_status
+    instance._loaded_status = instance.status
+    if created or old_status == instance.status:
+        if created and instance.status in Dispatch.ACTIVE_STATUSES:
+            KPISnapshot.adjust(active_dispatches=1)
+        return
+    
+    from .workflow import apply_status_effects
+    apply_status_effects(instance, old_status)
 
 
 @receiver(post_save, sender=Order)
 def handle_order_creation(sender, instance, created, **kwargs):
-    """Automatically assign truck and create dispatch when order is created"""
+    """Automatically assign truck and create dispatch when order is created.
+
+    Also keeps the pending/completed order KPI counters in step with the status.
+    """
+    
+    old_status = None if created else instance._loaded_status
+    old_updated_at = instance._loaded_updated_at
+    instance._loaded_status = instance.status
+    instance._loaded_updated_at = instance.updated_at
+    if old_status != instance.status:
+        KPISnapshot.adjust(pending_orders=int(instance.status == 'pending') - int(old_status == 'pending'))
+        if instance.status == 'completed':
+            DailyOrderKPI.adjust(timezone.localdate(instance.updated_at), 1)
+        elif old_status == 'completed' and old_updated_at:
+            DailyOrderKPI.adjust(timezone.localdate(old_updated_at), -1)
     
     if created and instance.status == 'pending':
-        # Find an available truck (idle status)
-        available_truck = Truck.objects.filter(status='idle').first()
-        
-        if available_truck:
-            # Create dispatch automatically
-            Dispatch.objects.create(
-                truck=available_truck,
-                order=instance,
-                status='assigned'
-            )
+        # Reserve the best-fitting idle truck and create the dispatch; if none
+        # is idle the order waits in the backlog until a truck is freed.
+        from .allocation import assign_order, allocation_deferred
+        if not allocation_deferred():
+            assign_order(instance)
 
 
 @receiver(post_delete, sender=Dispatch)
 def handle_dispatch_deletion(sender, instance, **kwargs):
     """Return truck to idle when dispatch is deleted"""
     
-    # Return truck to idle status
-    truck = instance.truck
-    truck.status = 'idle'
-    truck.save()
+    if instance.status in Dispatch.ACTIVE_STATUSES:
+        KPISnapshot.adjust(active_dispatches=-1)
+    elif instance.status == 'completed':
+        KPISnapshot.record_delivery(instance.departure_time, instance.arrival_time, sign=-1)
+    
+    # Return truck to idle status, unless this dispatch had already released it
+    # (the truck may be reserved for another dispatch by now)
+    if instance.status not in ('completed', 'cancelled'):
+        truck = instance.truck
+        truck.status = 'idle'
+        truck.save()
+        # The freed truck may serve the backlog, this order included
+        from .allocation import drain_backlog
+        transaction.on_commit(drain_backlog)
     
     # Reset order status if it was in_progress
     order = instance.order
     if order.status == 'in_progress':
         order.status = 'pending'
         order.save()
+
+
+@receiver(post_delete, sender=Order)
+def handle_order_deletion(sender, instance, **kwargs):
+    """Keep the KPI counters in step when an order is deleted"""
+    
+    if instance.status == 'pending':
+        KPISnapshot.adjust(pending_orders=-1)
+    elif instance.status == 'completed':
+        DailyOrderKPI.adjust(timezone.localdate(instance.updated_at), -1)
+
+
+@receiver(post_save, sender=Material)
+def record_opening_stock(sender, instance, created, **kwargs):
+    """Start the stock ledger of a new material with its opening balance"""
+    
+    if created and instance.stock_quantity:
+        StockMovement.objects.create(
+            material=instance, kind='adjustment', quantity=instance.stock_quantity, note='Opening balance'
+        )
+
+
+@receiver(post_delete, sender=DispatchMedia)
+def release_media_blob(sender, instance, **kwargs):
+    """Drop the blob reference; the last one deletes the blob and its files"""
+    
+    if instance.blob_id:
+        from .media import release_blob
+        release_blob(instance.blob_id)
+
+
+@receiver(post_save, sender=Truck)
+def handle_truck_creation(sender, instance, created, **kwargs):
+    if created:
+        KPISnapshot.adjust(total_trucks=1)
+
+
+@receiver(post_delete, sender=Truck)
+def handle_truck_deletion(sender, instance, **kwargs):
+    KPISnapshot.adjust(total_trucks=-1)
+
+
+@receiver(post_save, sender=ExceptionLog)
+def handle_exception_change(sender, instance, created, **kwargs):
+    """Track total and unresolved exception counts"""
+    
+    if created:
+        KPISnapshot.adjust(total_exceptions=1, unresolved_exceptions=int(not instance.resolved))
+    elif instance._loaded_resolved is not None and instance._loaded_resolved != instance.resolved:
+        KPISnapshot.adjust(unresolved_exceptions=-1 if instance.resolved else 1)
+    instance._loaded_resolved = instance.resolved
+
+
+@receiver(post_delete, sender=ExceptionLog)
+def handle_exception_deletion(sender, instance, **kwargs):
+    KPISnapshot.adjust(total_exceptions=-1, unresolved_exceptions=-int(not instance.resolved))
+
+
+@receiver(post_save, sender=Truck)
+@receiver(post_save, sender=Order)
+@receiver(post_save, sender=Dispatch)
+@receiver(post_save, sender=ExceptionLog)
+def publish_saved(sender, instance, **kwargs):
+    """Stream the change to /api/events/ subscribers once committed"""
+    
+    from .events import publish_changes
+    publish_changes(sender, [instance.pk])
+
+
+@receiver(post_delete, sender=Truck)
+@receiver(post_delete, sender=Order)
+@receiver(post_delete, sender=Dispatch)
+@receiver(post_delete, sender=ExceptionLog)
+def publish_deletion(sender, instance, **kwargs):
+    from .events import publish_deleted
+    publish_deleted(instance)
+
+
+# Resource name of each model in /api/sync/ responses and tombstones
+SYNC_RESOURCES = {Dispatch: 'dispatches', DispatchMedia: 'media', ExceptionLog: 'exceptions'}
+
+
+@receiver(post_delete, sender=Dispatch)
+@receiver(post_delete, sender=DispatchMedia)
+@receiver(post_delete, sender=ExceptionLog)
+def record_sync_tombstone(sender, instance, **kwargs):
+    """Tell /api/sync/ clients holding the row that it is gone"""
+    
+    if sender is Dispatch:
+        operator_id = instance.operator_id
+    else:
+        # A cascade deletes media and exceptions before their dispatch
+        operator_id = Dispatch.objects.filter(pk=instance.dispatch_id).values_list('operator_id', flat=True).first()
+    SyncTombstone.objects.create(resource=SYNC_RESOURCES[sender], object_id=instance.pk, operator_id=operator_id)
+
+
+@receiver(post_save, sender=Dispatch)
+def handle_dispatch_reassignment(sender, instance, created, **kwargs):
+    """Move an assigned dispatch, with its media and exceptions, into its operator's sync set (and out of the last one's)"""
+    
+    old_operator_id = None if created else instance._loaded_operator_id
+    instance._loaded_operator_id = instance.operator_id
+    if created or old_operator_id == instance.operator_id:
+        return
+    
+    media_ids = list(instance.media_files.values_list('pk', flat=True))
+    exception_ids = list(instance.exceptions.values_list('pk', flat=True))
+    if old_operator_id is not None:
+        SyncTombstone.objects.bulk_create([
+            SyncTombstone(resource=resource, object_id=pk, operator_id=old_operator_id)
+            for resource, pks in [('dispatches', [instance.pk]), ('media', media_ids), ('exceptions', exception_ids)]
+            for pk in pks
+        ])
+    # Newer than the new operator's sync token, so their next sync fetches them
+    now = timezone.now()
+    DispatchMedia.objects.filter(pk__in=media_ids).update(updated_at=now)
+    ExceptionLog.objects.filter(pk__in=exception_ids).update(updated_at=now)
+    invalidate_cached_responses(DispatchMedia)
+    invalidate_cached_responses(ExceptionLog)
+
+
+# Cached response scopes (see api/cache.py) that each model feeds into.
+# Bumping a scope's version invalidates its cached responses.
+CACHED_RESPONSE_SCOPES = {
+    Truck: ['kpi', 'trucks'],
+    Customer: ['customers'],
+    Order: ['kpi', 'orders'],
+    Dispatch: ['kpi', 'dispatches'],
+    Material: ['kpi', 'materials'],
+    DispatchMedia: ['media'],
+    ExceptionLog: ['kpi', 'exceptions'],
+    User: ['operators', 'users'],
+    UserProfile: ['operators', 'users'],
+}
+
+# The scope holding each model's own rows. Conditional GET validators
+# (api/views.py) combine the versions of every model a response reads.
+MODEL_SCOPES = {
+    Truck: 'trucks',
+    Customer: 'customers',
+    Order: 'orders',
+    Dispatch: 'dispatches',
+    Material: 'materials',
+    DispatchMedia: 'media',
+    ExceptionLog: 'exceptions',
+    User: 'users',
+    UserProfile: 'users',
+}
+
+
+@receiver([post_save, post_delete], sender=User)
+@receiver([post_save, post_delete], sender=UserProfile)
+def expire_token_claims(sender, instance, update_fields=None, **kwargs):
+    """Make tokens carrying the user's old claims refresh (see api/authentication.py)"""
+    
+    if update_fields is not None and set(update_fields) <= {'last_login'}:
+        return
+    from .authentication import forget_claims_version
+    forget_claims_version(instance.pk if sender is User else instance.user_id)
+
+
+@receiver(post_migrate)
+def create_response_cache_scopes(sender, **kwargs):
+    """Make the version rows of the response cache scopes, so requests need not."""
+    if sender.name == 'api':
+        response_cache.create_scopes(sorted({scope for scopes in CACHED_RESPONSE_SCOPES.values() for scope in scopes}))
+
+
+@receiver([post_save, post_delete], sender=Truck)
+@receiver([post_save, post_delete], sender=Customer)
+@receiver([post_save, post_delete], sender=Order)
+@receiver([post_save, post_delete], sender=Dispatch)
+@receiver([post_save, post_delete], sender=Material)
+@receiver([post_save, post_delete], sender=DispatchMedia)
+@receiver([post_save, post_delete], sender=ExceptionLog)
+@receiver([post_save, post_delete], sender=User)
+@receiver([post_save, post_delete], sender=UserProfile)
+def invalidate_cached_responses(sender, **kwargs):
+    """Invalidate cached responses built from ``sender`` rows.
+
+    Also call this directly after queryset ``update()``/``bulk_create()``,
+    which do not send signals.
+    """
+    response_cache.bump(*CACHED_RESPONSE_SCOPES[sender])
@@ -0,0 +1,118 @@
+"""
+Opt-in pagination modes for list endpoints.
+
+List endpoints return a bare JSON array of every row unless the client asks for
+pages, so existing clients are unaffected. Asking means passing ``?page_size=``
+(or the mode's own page parameter, ``?cursor=`` / ``?page=``); the response is
+then ``{next, previous, results}``, with ``count`` for offset pages.
+"""
+from django.conf import settings
+from django.db.models import Q
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import Cursor, CursorPagination, PageNumberPagination, _reverse_ordering
+
+
+def keyset_after(ordering, values):
+    """A filter for the rows after ``values`` (one per field) in ``ordering``.
+
+    (a, b) comes after (x, y) when a comes after x, or a = x and b comes after y.
+    """
+    after = None
+    for field, value in reversed(list(zip(ordering, values))):
+        name = field.lstrip('-')
+        beyond = Q(**{f"{name}__{'lt' if field.startswith('-') else 'gt'}": value})
+        after = beyond if after is None else beyond | Q(**{name: value}) & after
+    return after
+
+
+class RequestedPaginationMixin:
+    """Paginate only requests that pass ``page_size_query_param`` or ``page_param``."""
+    page_param = None
+
+    def paginate_queryset(self, queryset, request, view=None):
+        if not {self.page_size_query_param, self.page_param} & set(request.query_params):
+            return None
+        return super().paginate_queryset(queryset, request, view)
+
+
+class KeysetCursorPagination(CursorPagination):
+    """``CursorPagination`` whose cursor holds every ordering field, not just the first.
+
+    DRF's cursor keeps the first field and an offset into the rows that share
+    it, so rows sharing a ``created_at`` could be repeated or skipped when rows
+    are added between two pages. Here the ordering ends with a unique field and
+    a page continues strictly after the row its cursor names; offsets are
+    never needed.
+    """
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        self.page_size = self.get_page_size(request)
+        if not self.page_size:
+            return None
+
+        self.base_url = request.build_absolute_uri()
+        self.ordering = self.get_ordering(request, queryset, view)
+        self.cursor = self.decode_cursor(request)
+        reverse, position = (False, None) if self.cursor is None else (self.cursor.reverse, self.cursor.position)
+
+        ordering = _reverse_ordering(self.ordering) if reverse else self.ordering
+        queryset = queryset.order_by(*ordering)
+        if position is not None:
+            queryset = queryset.filter(keyset_after(ordering, self._values_from_position(position)))
+
+        results = list(queryset[:self.page_size + 1])
+        self.page = results[:self.page_size]
+        more = len(results) > len(self.page)
+        if reverse:
+            self.page.reverse()
+        # Reading backwards, "more" lies before this page
+        self.has_next, self.has_previous = (position is not None, more) if reverse else (more, position is not None)
+        self.position = position
+
+        if (self.has_previous or self.has_next) and self.template is not None:
+            self.display_page_controls = True
+        return self.page
+
+    def get_next_link(self):
+        if not self.has_next:
+            return None
+        position = self._get_position_from_instance(self.page[-1], self.ordering) if self.page else self.position
+        return self.encode_cursor(Cursor(offset=0, reverse=False, position=position))
+
+    def get_previous_link(self):
+        if not self.has_previous:
+            return None
+        position = self._get_position_from_instance(self.page[0], self.ordering) if self.page else self.position
+        return self.encode_cursor(Cursor(offset=0, reverse=True, position=position))
+
+    def _get_position_from_instance(self, instance, ordering):
+        values = [instance[field.lstrip('-')] if isinstance(instance, dict) else getattr(instance, field.lstrip('-'))
+                  for field in ordering]
+        return '|'.join(value.isoformat() if hasattr(value, 'isoformat') else str(value) for value in values)
+
+    def _values_from_position(self, position):
+        values = position.split('|')
+        if len(values) != len(self.ordering):
+            raise NotFound(self.invalid_cursor_message)
+        return values
+
+
+class CreatedAtCursorPagination(RequestedPaginationMixin, KeysetCursorPagination):
+    """Keyset pagination over the default ``-created_at`` ordering.
+
+    ``id`` is used as a tie-breaker so rows created in the same instant are
+    never skipped or repeated between pages. No ``COUNT(*)`` is issued.
+    """
+    ordering = ('-created_at', '-id')
+    page_size = settings.API_PAGE_SIZE
+    page_size_query_param = 'page_size'
+    max_page_size = settings.API_MAX_PAGE_SIZE
+    page_param = 'cursor'
+
+
+class AdminTablePagination(RequestedPaginationMixin, PageNumberPagination):
+    """Offset pagination for small admin tables (trucks, customers, materials)."""
+    page_size = settings.API_PAGE_SIZE
+    page_size_query_param = 'page_size'
+    max_page_size = settings.API_MAX_PAGE_SIZE
+    page_param = 'page'
@@ -0,0 +1,27 @@
+import codecs
+import csv
+
+from django.conf import settings
+from rest_framework.exceptions import ParseError
+from rest_framework.parsers import BaseParser
+
+
+def read_csv_rows(stream, encoding=None):
+    """Read a CSV with a header line into a list of dicts, dropping blank cells."""
+    reader = csv.DictReader(codecs.getreader(encoding or settings.DEFAULT_CHARSET)(stream))
+    try:
+        return [
+            {key.strip(): value.strip() for key, value in row.items() if key and value not in (None, '')}
+            for row in reader
+        ]
+    except (csv.Error, UnicodeDecodeError) as exc:
+        raise ParseError(f'CSV parse error - {exc}')
+
+
+class CSVParser(BaseParser):
+    """Parse a ``text/csv`` request body into a list of row dicts."""
+    media_type = 'text/csv'
+
+    def parse(self, stream, media_type=None, parser_context=None):
+        encoding = (parser_context or {}).get('encoding')
+        return read_csv_rows(stream, encoding)
@@ -0,0 +1,113 @@
+"""
+JSON rendering for API responses.
+
+``FastJSONRenderer`` encodes with orjson when it is installed and otherwise
+(or when the client asks for indented output) falls back to DRF's
+``JSONRenderer``. Both produce the same bytes for API data: values orjson does
+not handle the way DRF does, such as datetimes and Decimals, go through DRF's
+encoder.
+
+``json_array_chunks`` streams a list as one JSON array, a chunk of rows at a
+time, so a worker never holds the whole response. ``streaming_content`` hands
+such a generator to Django in the form the server can stream: under ASGI
+Django would read a synchronous iterator to the end before sending anything.
+
+``CSVRenderer`` and ``NDJSONRenderer`` let export actions negotiate their
+format (``?format=csv`` / ``?format=ndjson``). Exports stream their own rows
+(api/export.py); these only render other responses, such as errors.
+"""
+import csv
+import io
+from itertools import islice
+
+from asgiref.sync import sync_to_async
+from django.core.handlers.asgi import ASGIRequest
+
+from rest_framework.renderers import BaseRenderer, JSONRenderer
+from rest_framework.utils import encoders
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+_drf_encoder = encoders.JSONEncoder()
+
+if orjson is not None:
+    _OPTIONS = orjson.OPT_NON_STR_KEYS | orjson.OPT_PASSTHROUGH_DATETIME
+
+
+class FastJSONRenderer(JSONRenderer):
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b''
+        if (orjson is None or self.ensure_ascii or not self.compact
+                or self.get_indent(accepted_media_type, renderer_context or {}) is not None):
+            return super().render(data, accepted_media_type, renderer_context)
+        ret = orjson.dumps(data, default=_drf_encoder.default, option=_OPTIONS)
+        # Escaped like JSONRenderer does, to stay a strict JavaScript subset
+        return ret.replace(b'\xe2\x80\xa8', b'\\u2028').replace(b'\xe2\x80\xa9', b'\\u2029')
+
+
+def json_array_chunks(chunks):
+    """Yield one JSON array holding the items of every list in ``chunks``."""
+    renderer = FastJSONRenderer()
+    separator = b''
+    yield b'['
+    for chunk in chunks:
+        if chunk:
+            # Each chunk is encoded as an array; drop its brackets
+            yield separator + renderer.render(chunk)[1:-1]
+            separator = b','
+    yield b']'
+
+
+def streaming_content(request, chunks, batch_size=1):
+    """``chunks`` as the content of a ``StreamingHttpResponse`` to ``request``.
+
+    Over ASGI this is an asynchronous iterator that pulls ``batch_size`` chunks
+    at a time through ``sync_to_async`` (on the request's thread, so with its
+    database connection) and sends them joined.
+    """
+    if not isinstance(getattr(request, '_request', request), ASGIRequest):
+        return chunks
+    return _async_chunks(iter(chunks), batch_size)
+
+
+async def _async_chunks(chunks, batch_size):
+    take = sync_to_async(lambda: list(islice(chunks, batch_size)))
+    while batch := await take():
+        # str (CSV) or bytes
+        yield batch[0][:0].join(batch)
+
+
+def _as_rows(data):
+    return data if isinstance(data, list) else [data]
+
+
+class CSVRenderer(BaseRenderer):
+    media_type = 'text/csv'
+    format = 'csv'
+    charset = 'utf-8'
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b''
+        rows = _as_rows(data)
+        buffer = io.StringIO()
+        writer = csv.DictWriter(buffer, fieldnames=list(rows[0]) if rows else [])
+        writer.writeheader()
+        writer.writerows(rows)
+        return buffer.getvalue().encode(self.charset)
+
+
+class NDJSONRenderer(BaseRenderer):
+    media_type = 'application/x-ndjson'
+    format = 'ndjson'
+    charset = None
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b''
+        renderer = FastJSONRenderer()
+        return b''.join(renderer.render(row) + b'\n' for row in _as_rows(data))
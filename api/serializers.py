@@ -1,7 +1,341 @@
+from collections import defaultdict
+
 from rest_framework import serializers
+from rest_framework.permissions import SAFE_METHODS
+from rest_framework.relations import PKOnlyObject
 from django.contrib.auth.password_validation import validate_password
 from django.contrib.auth.models import User
-from .models import UserProfile, Truck, Customer, Order, Dispatch, Material, ExceptionLog, DispatchMedia
+from django.core.exceptions import FieldDoesNotExist
+from django.db.models import FileField, Prefetch
+from .media import signed_media_url, stage_upload
+from .models import (
+    UserProfile, Truck, Customer, Order, Dispatch, Material, ExceptionLog, DispatchMedia, StockMovement
+)
+
+def _split(value):
+    return [name.strip() for name in (value or '').split(',') if name.strip()]
+
+def _nested(names, head):
+    prefix = f'{head}.'
+    return [name[len(prefix):] for name in names if name.startswith(prefix)]
+
+class ShapedModelSerializer(serializers.ModelSerializer):
+    """Model serializer whose output can be narrowed and expanded per request.
+
+    ``?fields=id,status`` keeps only the named fields; ``?expand=order.customer``
+    replaces a related id with the nested object (one level per dot) and adds
+    nested lists such as ``media_files``. Dotted ``fields`` (``order.id``)
+    narrow an expanded object. Only the top-level serializer of a read request
+    looks at the query string; nested ones are shaped by their parent.
+    """
+    # Related fields ``expand`` can nest, by name
+    expandable_fields = {}
+    # Model attributes read by each SerializerMethodField, for ``shape_queryset``
+    field_sources = {}
+
+    def __init__(self, *args, fields=None, expand=None, **kwargs):
+        self._requested = (fields, expand)
+        super().__init__(*args, **kwargs)
+
+    def _shape(self):
+        fields, expand = self._requested
+        if fields is not None or expand is not None:
+            return fields, expand or []
+        parent = self.parent
+        if isinstance(parent, serializers.ListSerializer):
+            parent = parent.parent
+        request = self.context.get('request')
+        if parent is not None or request is None or request.method not in SAFE_METHODS:
+            return None, []
+        return _split(request.query_params.get('fields')) or None, _split(request.query_params.get('expand'))
+
+    def get_fields(self):
+        fields = super().get_fields()
+        only, expand = self._shape()
+        if only is not None:
+            keep = {name.split('.')[0] for name in [*only, *expand]}
+            fields = {name: field for name, field in fields.items() if name in keep}
+        for head in dict.fromkeys(name.split('.')[0] for name in expand):
+            serializer_class = self.expandable_fields.get(head)
+            if serializer_class is None:
+                continue
+            current = fields.get(head)
+            many = isinstance(current, (serializers.ListSerializer, serializers.ManyRelatedField))
+            nested_only = _nested(only, head) or None if only is not None else None
+            fields[head] = serializer_class(
+                many=many, read_only=True, fields=nested_only, expand=_nested(expand, head)
+            )
+        return fields
+
+def _resolve(model, source, prefix):
+    """Return the ``only()`` path, ``select_related`` paths and model field of a dotted source, or ``None``."""
+    related = []
+    path = []
+    attrs = source.split('.')
+    for position, attr in enumerate(attrs):
+        try:
+            field = model._meta.get_field(attr)
+        except FieldDoesNotExist:
+            return None
+        path.append(attr)
+        if position == len(attrs) - 1:
+            break
+        if not (field.many_to_one or field.one_to_one):
+            return None
+        related.append(prefix + '__'.join(path))
+        model = field.related_model
+    if field.many_to_many or field.one_to_many:
+        return None
+    return prefix + '__'.join(path), related, field
+
+def _reads(serializer, prefix=''):
+    """Collect the columns, joins and prefetches needed to render ``serializer``.
+
+    Columns are ``None`` if some field reads something that is not a model field.
+    """
+    model = serializer.Meta.model
+    columns, related, prefetches = set(), set(), []
+    for name, field in serializer.fields.items():
+        if field.write_only:
+            continue
+        if isinstance(field, serializers.ListSerializer):
+            relation = model._meta.get_field(field.source)
+            queryset = shape_queryset(relation.related_model.objects.all(), field.child,
+                                      extra_columns=[relation.field.name])
+            prefetches.append(Prefetch(prefix + field.source, queryset=queryset))
+            continue
+        if isinstance(field, serializers.BaseSerializer):
+            resolved = _resolve(model, field.source, prefix)
+            if resolved is None:
+                columns = None
+                continue
+            path, joins, _ = resolved
+            related.update([*joins, path])
+            nested_columns, nested_related, nested_prefetches = _reads(field, path + '__')
+            if columns is not None:
+                columns.add(path)
+                columns = None if nested_columns is None else columns | nested_columns
+            related |= nested_related
+            prefetches += nested_prefetches
+            continue
+        if isinstance(field, serializers.SerializerMethodField):
+            sources = getattr(serializer, 'field_sources', {}).get(name)
+        else:
+            sources = None if field.source == '*' else [field.source]
+        for source in sources or [None]:
+            resolved = source and _resolve(model, source, prefix)
+            if resolved is None:
+                columns = None
+                continue
+            path, joins, _ = resolved
+            related.update(joins)
+            if columns is not None:
+                columns.add(path)
+    return columns, related, prefetches
+
+def shape_queryset(queryset, serializer, extra_columns=(), restrict=True):
+    """Fetch what ``serializer`` renders and nothing else.
+
+    Follows its relations with ``select_related``, prefetches its nested lists
+    and, if ``restrict`` is set, loads only the columns it reads plus
+    ``extra_columns`` (e.g. the pagination ordering).
+    """
+    columns, related, prefetches = _reads(serializer)
+    if related:
+        # Without arguments select_related() would follow every foreign key
+        queryset = queryset.select_related(*sorted(related))
+    queryset = queryset.prefetch_related(*prefetches)
+    if restrict and columns is not None:
+        queryset = queryset.only(*sorted(columns), *extra_columns)
+    return queryset
+
+def _source_models(model, source):
+    models = set()
+    # The last attribute is read from the row its path leads to
+    for attr in source.split('.')[:-1]:
+        try:
+            field = model._meta.get_field(attr)
+        except FieldDoesNotExist:
+            break
+        if not field.is_relation:
+            break
+        model = field.related_model
+        models.add(model)
+    return models
+
+def serializer_models(serializer):
+    """Return the models whose rows ``serializer`` renders, its own included."""
+    model = serializer.Meta.model
+    models = {model}
+    for name, field in serializer.fields.items():
+        if field.write_only:
+            continue
+        if isinstance(field, serializers.ListSerializer):
+            models |= serializer_models(field.child)
+            continue
+        if isinstance(field, serializers.BaseSerializer):
+            models |= serializer_models(field)
+            sources = [field.source]
+        elif isinstance(field, serializers.SerializerMethodField):
+            sources = getattr(serializer, 'field_sources', {}).get(name, [])
+        else:
+            sources = [] if field.source == '*' else [field.source]
+        for source in sources:
+            models |= _source_models(model, source)
+    return models
+
+class _NotProjectable(Exception):
+    pass
+
+class _Record:
+    """Stands in for a model instance when a SerializerMethodField reads a projected row."""
+
+def _record(spec, row):
+    record = _Record()
+    for attr, (kind, key, sub) in spec.items():
+        value = row[key]
+        if kind == 'relation':
+            value = None if value is None else _record(sub, row)
+        elif kind == 'file':
+            value = sub.attr_class(None, sub, value)
+        setattr(record, attr, value)
+    return record
+
+class Projection:
+    """Renders what a serializer would, straight from ``QuerySet.values()`` rows.
+
+    For large read-only lists: no model instance or per-row serializer is
+    built, and joined columns (``order__customer__name``) are read from the
+    row. Each value still goes through its field's ``to_representation``, so
+    the output is identical to the serializer's. Method fields get a plain
+    record holding their ``field_sources``; nested lists take one query per
+    relation. ``Projection.of()`` returns ``None`` when a field needs a model
+    instance.
+    """
+
+    def __init__(self, serializer, prefix=''):
+        self.model = serializer.Meta.model
+        self.prefix = prefix
+        self.pk = prefix + self.model._meta.pk.name
+        self.columns = set()
+        self.plan = []
+        for name, field in serializer.fields.items():
+            if not field.write_only:
+                self.plan.append((name, *self._plan(serializer, name, field)))
+
+    @classmethod
+    def of(cls, serializer):
+        try:
+            return cls(serializer)
+        except _NotProjectable:
+            return None
+
+    def _resolve(self, source):
+        resolved = _resolve(self.model, source, self.prefix) if source != '*' else None
+        if resolved is None:
+            raise _NotProjectable(source)
+        path, joins, model_field = resolved
+        return path, model_field
+
+    def _plan(self, serializer, name, field):
+        if isinstance(field, serializers.ListSerializer):
+            try:
+                relation = self.model._meta.get_field(field.source)
+            except FieldDoesNotExist:
+                raise _NotProjectable(field.source)
+            if not relation.one_to_many:
+                raise _NotProjectable(field.source)
+            child = Projection(field.child)
+            child.columns.update([child.pk, relation.field.name])
+            self.columns.add(self.pk)
+            return 'many', (child, relation.field.name)
+        if isinstance(field, serializers.BaseSerializer):
+            path, model_field = self._resolve(field.source)
+            if not model_field.is_relation:
+                raise _NotProjectable(field.source)
+            nested = Projection(field, path + '__')
+            self.columns |= nested.columns
+            self.columns.add(path)
+            return 'nested', (path, nested)
+        if isinstance(field, serializers.SerializerMethodField):
+            sources = getattr(serializer, 'field_sources', {}).get(name)
+            if sources is None:
+                raise _NotProjectable(name)
+            spec = {}
+            for source in sources:
+                self._add_source(spec, source)
+            return 'method', (field, spec)
+        path, model_field = self._resolve(field.source)
+        self.columns.add(path)
+        if isinstance(field, serializers.PrimaryKeyRelatedField):
+            return 'pk', (field, path)
+        if model_field.is_relation:
+            raise _NotProjectable(field.source)
+        if isinstance(model_field, FileField):
+            return 'file', (field, path, model_field)
+        return 'column', (field, path)
+
+    def _add_source(self, spec, source):
+        model = self.model
+        attrs = source.split('.')
+        for position, attr in enumerate(attrs):
+            try:
+                model_field = model._meta.get_field(attr)
+            except FieldDoesNotExist:
+                raise _NotProjectable(source)
+            key = self.prefix + '__'.join(attrs[:position + 1])
+            self.columns.add(key)
+            if position == len(attrs) - 1:
+                if model_field.is_relation:
+                    raise _NotProjectable(source)
+                spec[attr] = ('file', key, model_field) if isinstance(model_field, FileField) else ('value', key, None)
+            elif model_field.many_to_one or model_field.one_to_one:
+                spec = spec.setdefault(attr, ('relation', key, {}))[2]
+                model = model_field.related_model
+            else:
+                raise _NotProjectable(source)
+
+    def values(self, queryset, extra_columns=()):
+        """``queryset`` as the rows ``render`` takes (plus ``extra_columns``)."""
+        return queryset.prefetch_related(None).values(*sorted(self.columns | set(extra_columns)))
+
+    def render(self, rows):
+        pending = defaultdict(lambda: defaultdict(list))
+        data = [self._render(row, pending) for row in rows]
+        for (child, fk), targets in pending.items():
+            child_rows = list(child.values(child.model._default_manager.filter(**{f'{fk}__in': list(targets)})))
+            for row, item in zip(child_rows, child.render(child_rows)):
+                for target in targets[row[fk]]:
+                    target.append(item)
+        return data
+
+    def _render(self, row, pending):
+        data = {}
+        for name, kind, spec in self.plan:
+            if kind == 'column':
+                field, key = spec
+                value = row[key]
+                data[name] = None if value is None else field.to_representation(value)
+            elif kind == 'method':
+                field, sources = spec
+                data[name] = field.to_representation(_record(sources, row))
+            elif kind == 'pk':
+                field, key = spec
+                value = row[key]
+                data[name] = None if value is None else field.to_representation(PKOnlyObject(value))
+            elif kind == 'file':
+                field, key, model_field = spec
+                value = row[key]
+                data[name] = None if value is None else field.to_representation(
+                    model_field.attr_class(None, model_field, value)
+                )
+            elif kind == 'nested':
+                key, nested = spec
+                data[name] = None if row[key] is None else nested._render(row, pending)
+            else:
+                data[name] = []
+                pending[spec][row[self.pk]].append(data[name])
+        return data
 
 class UserProfileSerializer(serializers.ModelSerializer):
     class Meta:
@@ -41,57 +375,148 @@ class UserRegistrationSerializer(serializers.ModelSerializer):
             raise serializers.ValidationError("A user with this username already exists")
         return value
 
-class TruckSerializer(serializers.ModelSerializer):
+class TruckSerializer(ShapedModelSerializer):
     class Meta:
         model = Truck
         fields = ['id', 'number_plate', 'capacity', 'driver_name', 'status', 'created_at', 'updated_at']
         read_only_fields = ['id', 'created_at', 'updated_at']
 
-class CustomerSerializer(serializers.ModelSerializer):
+class CustomerSerializer(ShapedModelSerializer):
     class Meta:
         model = Customer
         fields = ['id', 'name', 'contact', 'email', 'created_at', 'updated_at']
         read_only_fields = ['id', 'created_at', 'updated_at']
 
-class OrderSerializer(serializers.ModelSerializer):
+class PreloadedPrimaryKeyRelatedField(serializers.PrimaryKeyRelatedField):
+    """Looks related objects up in ``context['preloaded'][model]`` before querying.
+
+    Lets ``many=True`` serializers resolve every row's reference with one query.
+    """
+    def to_internal_value(self, data):
+        preloaded = self.context.get('preloaded', {}).get(self.get_queryset().model)
+        if preloaded:
+            try:
+                return preloaded[int(data)]
+            except (KeyError, TypeError, ValueError):
+                pass  # let the default lookup produce the usual error
+        return super().to_internal_value(data)
+
+class OrderSerializer(ShapedModelSerializer):
+    customer = PreloadedPrimaryKeyRelatedField(queryset=Customer.objects.all())
     customer_name = serializers.CharField(source='customer.name', read_only=True)
     customer_contact = serializers.CharField(source='customer.contact', read_only=True)
+    expandable_fields = {'customer': CustomerSerializer}
     
     class Meta:
         model = Order
         fields = ['id', 'customer', 'customer_name', 'customer_contact', 'material_type', 'quantity', 'status', 'created_at', 'updated_at']
         read_only_fields = ['id', 'created_at', 'updated_at']
 
-class MaterialSerializer(serializers.ModelSerializer):
+    @classmethod
+    def for_bulk(cls, rows, context=None):
+        """Return a ``many=True`` serializer for ``rows`` with their customers preloaded."""
+        ids = {str(row.get('customer')) for row in rows if isinstance(row, dict)}
+        customers = Customer.objects.in_bulk([pk for pk in ids if pk.isdigit()])
+        return cls(data=rows, many=True, context={**(context or {}), 'preloaded': {Customer: customers}})
+
+class MaterialSerializer(ShapedModelSerializer):
     class Meta:
         model = Material
         fields = ['id', 'name', 'stock_quantity', 'unit', 'created_at', 'updated_at']
         read_only_fields = ['id', 'created_at', 'updated_at']
 
-class DispatchMediaSerializer(serializers.ModelSerializer):
+    def update(self, instance, validated_data):
+        # Write only the submitted columns, so a concurrent stock change made
+        # through the ledger (api/stock.py) is never overwritten
+        for attr, value in validated_data.items():
+            setattr(instance, attr, value)
+        instance.save(update_fields=[*validated_data, 'updated_at'])
+        return instance
+
+class StockMovementSerializer(serializers.ModelSerializer):
+    created_by_name = serializers.CharField(source='created_by.username', read_only=True, default=None)
+
+    class Meta:
+        model = StockMovement
+        fields = ['id', 'material', 'kind', 'quantity', 'dispatch', 'note', 'created_by', 'created_by_name', 'created_at']
+        read_only_fields = fields
+
+class StockReceiptSerializer(serializers.Serializer):
+    quantity = serializers.FloatField(min_value=0.1)
+    note = serializers.CharField(max_length=255, required=False, allow_blank=True, default='')
+
+class StockCountSerializer(serializers.Serializer):
+    stock_quantity = serializers.FloatField(min_value=0)
+    note = serializers.CharField(max_length=255, required=False, allow_blank=True, default='')
+
+class OperatorSerializer(ShapedModelSerializer):
+    full_name = serializers.SerializerMethodField()
+    field_sources = {'full_name': ['first_name', 'last_name', 'username']}
+    
+    class Meta:
+        model = User
+        fields = ['id', 'username', 'first_name', 'last_name', 'full_name']
+    
+    def get_full_name(self, obj):
+        return f"{obj.first_name} {obj.last_name}".strip() or obj.username
+
+class DispatchMediaSerializer(ShapedModelSerializer):
     uploaded_by_name = serializers.SerializerMethodField()
     image_url = serializers.SerializerMethodField()
+    image_urls = serializers.SerializerMethodField()
+    # Accept any file here: it is validated as an image in the background
+    image = serializers.FileField()
+    expandable_fields = {'uploaded_by': OperatorSerializer}
+    field_sources = {
+        'uploaded_by_name': ['uploaded_by.first_name', 'uploaded_by.last_name', 'uploaded_by.username'],
+        'image_url': ['image', 'thumbnail', 'medium', 'processing_state'],
+        'image_urls': ['image', 'thumbnail', 'medium', 'processing_state'],
+    }
     
     class Meta:
         model = DispatchMedia
-        fields = ['id', 'dispatch', 'media_type', 'image', 'image_url', 'description', 
-                 'uploaded_by', 'uploaded_by_name', 'created_at']
-        read_only_fields = ['id', 'created_at']
+        fields = ['id', 'dispatch', 'media_type', 'image', 'image_url', 'image_urls', 'description', 
+                 'uploaded_by', 'uploaded_by_name', 'processing_state', 'processing_error', 'created_at',
+                 'updated_at']
+        read_only_fields = ['id', 'created_at', 'updated_at', 'processing_state', 'processing_error']
+    
+    def create(self, validated_data):
+        return stage_upload(validated_data.pop('image'), **validated_data)
     
     def get_uploaded_by_name(self, obj):
         if obj.uploaded_by:
             return f"{obj.uploaded_by.first_name} {obj.uploaded_by.last_name}".strip() or obj.uploaded_by.username
         return None
     
+    def _file_url(self, name):
+        request = self.context.get('request')
+        url = signed_media_url(name)
+        return request.build_absolute_uri(url) if request else url
+    
+    def _variant_name(self, obj, variant):
+        # Images processed before renditions existed fall back to the original
+        return (obj.image if variant == 'original' else getattr(obj, variant) or obj.image).name
+    
+    def get_image_urls(self, obj):
+        """URL of every rendition."""
+        if not obj.image or obj.processing_state != 'ready':
+            return None
+        names = {variant: self._variant_name(obj, variant) for variant in DispatchMedia.VARIANTS}
+        # Sign each distinct file once
+        urls = {name: self._file_url(name) for name in set(names.values())}
+        return {variant: urls[name] for variant, name in names.items()}
+    
     def get_image_url(self, obj):
-        if obj.image:
-            request = self.context.get('request')
-            if request:
-                return request.build_absolute_uri(obj.image.url)
-            return obj.image.url
-        return None
+        """The rendition picked by ``?variant=`` (default: original)."""
+        if not obj.image or obj.processing_state != 'ready':
+            return None
+        request = self.context.get('request')
+        variant = request.query_params.get('variant') if request else None
+        if variant not in DispatchMedia.VARIANTS:
+            variant = 'original'
+        return self._file_url(self._variant_name(obj, variant))
 
-class DispatchSerializer(serializers.ModelSerializer):
+class DispatchSerializer(ShapedModelSerializer):
     truck_number_plate = serializers.CharField(source='truck.number_plate', read_only=True)
     truck_driver = serializers.CharField(source='truck.driver_name', read_only=True)
     order_customer = serializers.CharField(source='order.customer.name', read_only=True)
@@ -99,6 +524,11 @@ class DispatchSerializer(serializers.ModelSerializer):
     order_quantity = serializers.FloatField(source='order.quantity', read_only=True)
     operator_name = serializers.SerializerMethodField()
     media_files = DispatchMediaSerializer(many=True, read_only=True)
+    expandable_fields = {
+        'truck': TruckSerializer, 'order': OrderSerializer, 'operator': OperatorSerializer,
+        'media_files': DispatchMediaSerializer,
+    }
+    field_sources = {'operator_name': ['operator.first_name', 'operator.last_name', 'operator.username']}
     
     class Meta:
         model = Dispatch
@@ -115,10 +545,12 @@ class DispatchSerializer(serializers.ModelSerializer):
             return f"{obj.operator.first_name} {obj.operator.last_name}".strip() or obj.operator.username
         return None
 
-class ExceptionLogSerializer(serializers.ModelSerializer):
+class ExceptionLogSerializer(ShapedModelSerializer):
     dispatch_truck = serializers.CharField(source='dispatch.truck.number_plate', read_only=True)
     dispatch_order = serializers.CharField(source='dispatch.order.id', read_only=True)
     resolved_by_name = serializers.SerializerMethodField()
+    expandable_fields = {'dispatch': DispatchSerializer, 'resolved_by': OperatorSerializer}
+    field_sources = {'resolved_by_name': ['resolved_by.first_name', 'resolved_by.last_name', 'resolved_by.username']}
     
     class Meta:
         model = ExceptionLog
@@ -132,16 +564,6 @@ class ExceptionLogSerializer(serializers.ModelSerializer):
             return f"{obj.resolved_by.first_name} {obj.resolved_by.last_name}".strip() or obj.resolved_by.username
         return None
 
-class OperatorSerializer(serializers.ModelSerializer):
-    full_name = serializers.SerializerMethodField()
-    
-    class Meta:
-        model = User
-        fields = ['id', 'username', 'first_name', 'last_name', 'full_name']
-    
-    def get_full_name(self, obj):
-        return f"{obj.first_name} {obj.last_name}".strip() or obj.username
-
 class WorkflowStepSerializer(serializers.Serializer):
     step = serializers.CharField()
     data = serializers.DictField(required=False)
@@ -0,0 +1,150 @@
+"""
+Material stock changes, recorded in the ``StockMovement`` ledger.
+
+``Material.stock_quantity`` is only ever changed by an atomic ``UPDATE`` on the
+material row, in the same transaction as the ledger rows it explains. Because
+that UPDATE takes the row lock first, ``checkpoint`` can lock the materials and
+know every movement up to the current highest id has committed.
+"""
+from collections import defaultdict
+
+from django.db import transaction
+from django.db.models import F, Max, Sum, Value, FloatField
+from django.db.models.functions import Greatest
+from django.utils import timezone
+
+from .models import Material, StockMovement, StockCheckpoint, invalidate_cached_responses
+
+
+def consume(consumptions, now=None):
+    """Take completed orders out of stock.
+
+    ``consumptions`` is a list of ``(material_name, quantity, dispatch_id)``.
+    Each material gets one conditional ``UPDATE``; stock never goes below zero.
+    One consumption row is written per dispatch, plus one adjustment row per
+    material whose stock ran short.
+    """
+    now = now or timezone.now()
+    by_material = defaultdict(list)
+    for name, quantity, dispatch_id in consumptions:
+        by_material[name].append((quantity, dispatch_id))
+
+    movements = []
+    with transaction.atomic():
+        material_ids = dict(Material.objects.filter(name__in=by_material).values_list('name', 'id'))
+        for name, items in by_material.items():
+            total = sum(quantity for quantity, _ in items)
+            material_id = material_ids.get(name)
+            if material_id is None:
+                material_id = Material.objects.create(name=name, stock_quantity=0, unit='tons').pk
+
+            # Fast path: enough stock, a single conditional UPDATE
+            shortfall = 0
+            covered = Material.objects.filter(pk=material_id, stock_quantity__gte=total).update(
+                stock_quantity=F('stock_quantity') - total, updated_at=now
+            )
+            if not covered:
+                current = Material.objects.select_for_update().values_list('stock_quantity', flat=True).get(
+                    pk=material_id
+                )
+                shortfall = total - current
+                Material.objects.filter(pk=material_id).update(
+                    stock_quantity=Greatest(F('stock_quantity') - total, Value(0.0), output_field=FloatField()),
+                    updated_at=now,
+                )
+
+            movements.extend(
+                StockMovement(material_id=material_id, kind='consumption', quantity=-quantity, dispatch_id=dispatch_id)
+                for quantity, dispatch_id in items
+            )
+            if shortfall > 0:
+                movements.append(StockMovement(
+                    material_id=material_id, kind='adjustment', quantity=shortfall,
+                    note=f'Stock ran out: {shortfall:g} short of {total:g} consumed',
+                ))
+        StockMovement.objects.bulk_create(movements)
+    invalidate_cached_responses(Material)
+    return movements
+
+
+def receive(material, quantity, user=None, note=''):
+    """Add a delivery of ``quantity`` to stock."""
+    with transaction.atomic():
+        Material.objects.filter(pk=material.pk).update(
+            stock_quantity=F('stock_quantity') + quantity, updated_at=timezone.now()
+        )
+        StockMovement.objects.create(material=material, kind='receipt', quantity=quantity, created_by=user, note=note)
+    invalidate_cached_responses(Material)
+    material.refresh_from_db(fields=['stock_quantity', 'updated_at'])
+    return material
+
+
+def set_stock(material, stock_quantity, user=None, note=''):
+    """Correct stock to a counted ``stock_quantity``, recording the difference."""
+    with transaction.atomic():
+        current = Material.objects.select_for_update().values_list('stock_quantity', flat=True).get(pk=material.pk)
+        delta = stock_quantity - current
+        if delta:
+            Material.objects.filter(pk=material.pk).update(stock_quantity=stock_quantity, updated_at=timezone.now())
+            StockMovement.objects.create(
+                material=material, kind='adjustment', quantity=delta, created_by=user, note=note
+            )
+    if delta:
+        invalidate_cached_responses(Material)
+    material.refresh_from_db(fields=['stock_quantity', 'updated_at'])
+    return material
+
+
+def stock_at(material, at):
+    """Stock of ``material`` at time ``at``, from the latest checkpoint before it."""
+    checkpoint = (
+        StockCheckpoint.objects.filter(material=material, taken_at__lte=at)
+        .order_by('-taken_at').values('stock_quantity', 'last_movement_id').first()
+    ) or {'stock_quantity': 0, 'last_movement_id': 0}
+    since = StockMovement.objects.filter(
+        material=material, id__gt=checkpoint['last_movement_id'], created_at__lte=at
+    ).aggregate(total=Sum('quantity'))['total']
+    return checkpoint['stock_quantity'] + (since or 0)
+
+
+def open_ledgers():
+    """Write the missing opening balance of materials whose ledger does not add up to their stock.
+
+    For materials that predate the ledger. The difference is recorded as an
+    adjustment dated at the material's creation, since the stock before the
+    ledger is not known any better, and the checkpoints of those materials,
+    taken without it, are dropped. Returns the ids of the materials opened.
+    """
+    opened = []
+    with transaction.atomic():
+        materials = list(Material.objects.select_for_update().order_by('pk').values_list('pk', 'stock_quantity', 'created_at'))
+        totals = dict(
+            StockMovement.objects.values('material').annotate(total=Sum('quantity')).values_list('material', 'total')
+        )
+        for pk, quantity, created_at in materials:
+            missing = quantity - (totals.get(pk) or 0)
+            if abs(missing) < 1e-6:
+                continue
+            movement = StockMovement.objects.create(
+                material_id=pk, kind='adjustment', quantity=missing, note='Opening balance'
+            )
+            # Before the movements it explains
+            StockMovement.objects.filter(pk=movement.pk).update(created_at=created_at)
+            opened.append(pk)
+        StockCheckpoint.objects.filter(material_id__in=opened).delete()
+    return opened
+
+
+def checkpoint():
+    """Record the current stock of every material as a checkpoint."""
+    with transaction.atomic():
+        # Wait for in-flight stock changes: their ledger rows must be visible
+        materials = list(Material.objects.select_for_update().order_by('pk').values_list('pk', 'stock_quantity'))
+        last_ids = dict(
+            StockMovement.objects.values('material').annotate(last=Max('id')).values_list('material', 'last')
+        )
+        now = timezone.now()
+        return StockCheckpoint.objects.bulk_create([
+            StockCheckpoint(material_id=pk, stock_quantity=quantity, last_movement_id=last_ids.get(pk, 0), taken_at=now)
+            for pk, quantity in materials
+        ])
@@ -1,3 +1,1685 @@
-from django.test import TestCase
+import asyncio
+import csv
+import json
+import os
+import re
+import shutil
+import tempfile
+import time
+import warnings
+from datetime import timedelta
+from decimal import Decimal
+from io import BytesIO, StringIO
+from unittest import mock
+from urllib.parse import parse_qsl, urlsplit
 
-# Create your tests here.
+from asgiref.sync import async_to_sync, sync_to_async
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.cache import caches
+from django.core.management import call_command
+from django.db import connection
+from django.core.files.storage import FileSystemStorage, default_storage
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.test import AsyncClient, SimpleTestCase, TestCase, override_settings, skipUnlessDBFeature
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from django.utils.translation import gettext_lazy
+from PIL import Image
+from rest_framework.exceptions import ErrorDetail
+from rest_framework.renderers import JSONRenderer
+from rest_framework.request import Request
+from rest_framework.test import APIClient, APIRequestFactory, APITestCase
+from rest_framework_simplejwt.tokens import RefreshToken
+
+from .authentication import issue_tokens
+from .cache import ResponseCache, response_cache
+from .events import EventBus
+from .media import acquire_blob, signed_media_url
+from .pagination import CreatedAtCursorPagination
+from .renderers import FastJSONRenderer
+from .serializers import (
+    DispatchMediaSerializer, DispatchSerializer, ExceptionLogSerializer, OrderSerializer, Projection, TruckSerializer,
+    shape_queryset
+)
+from .models import (
+    UserProfile, Truck, Customer, Order, Dispatch, Material, ExceptionLog, KPISnapshot, DailyOrderKPI,
+    DispatchMedia, MediaBlob, ResponseCacheScope, SyncTombstone, RevokedToken
+)
+from .blacklist import GENERATION_KEY, BloomFilter, token_blacklist
+from backend.asgi import application as asgi_application
+from backend.middleware import QueryBudgetExceeded
+from . import renderers, views
+from . import stock
+from .workflow import TransitionConflict, TransitionError, bulk_transition, transition
+
+
+@skipUnlessDBFeature('supports_explaining_query_execution')
+class QueryPlanTests(TestCase):
+    """EXPLAIN the queries behind each list endpoint and fail on full table scans.
+
+    Not covered: free-text search (``CustomerViewSet`` ``?search=``), since a
+    leading-wildcard ``LIKE`` cannot use a B-tree index, and ``Material``, a
+    reference table of a few dozen rows. On SQLite, Django compiles
+    ``resolved=False`` to ``WHERE NOT resolved``, which SQLite cannot seek
+    on, so boolean filters are only checked on other backends.
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.admin = User.objects.create_user('plan_admin', password='x')
+        UserProfile.objects.create(user=cls.admin, role='admin')
+        cls.operator = User.objects.create_user('plan_operator', password='x')
+        UserProfile.objects.create(user=cls.operator, role='operator')
+
+    def setUp(self):
+        if connection.vendor == 'postgresql':
+            # Tiny test tables are always cheaper to scan sequentially.
+            with connection.cursor() as cursor:
+                cursor.execute('SET LOCAL enable_seqscan = off')
+        elif connection.vendor != 'sqlite':
+            self.skipTest(f'No full-scan detector for {connection.vendor}')
+
+    def list_queryset(self, viewset_class, user, params=None):
+        """Return the queryset a list request would paginate, with its final ordering."""
+        view = viewset_class(action_map={'get': 'list'}, format_kwarg=None)
+        request = view.initialize_request(APIRequestFactory().get('/', params or {}))
+        request.user = user
+        view.request = request
+        queryset = view.get_queryset()
+        ordering = getattr(view.paginator, 'ordering', None)
+        if ordering:
+            queryset = queryset.order_by(*ordering)
+        return queryset
+
+    def full_scans(self, queryset):
+        """Return the plan lines that read the whole base table, plus the full plan.
+
+        Walking an index in ORDER BY order is fine for an unfiltered list (the
+        paginator adds a LIMIT), but a filtered query must seek into an index.
+        """
+        plan = queryset.explain()
+        table = re.escape(queryset.model._meta.db_table)
+        filtered = bool(queryset.query.where)
+        if connection.vendor == 'sqlite':
+            pattern = rf'SCAN {table}\b' if filtered else rf'SCAN {table}\b(?! USING)'
+        else:
+            pattern = rf'Seq Scan on {table}\b'
+        return re.findall(pattern, plan), plan
+
+    def assertNoFullScan(self, queryset):
+        scans, plan = self.full_scans(queryset)
+        self.assertFalse(scans, f'Full scan of {queryset.model._meta.db_table}:\n{plan}')
+
+    def test_viewset_list_queries(self):
+        cases = [
+            (views.TruckViewSet, self.admin, {}),
+            (views.TruckViewSet, self.admin, {'status': 'idle'}),
+            (views.CustomerViewSet, self.admin, {}),
+            (views.OrderViewSet, self.admin, {}),
+            (views.OrderViewSet, self.admin, {'status': 'pending'}),
+            (views.OrderViewSet, self.admin, {'customer': 1}),
+            (views.OrderViewSet, self.admin, {'status': 'pending', 'customer': 1}),
+            (views.DispatchViewSet, self.admin, {}),
+            (views.DispatchViewSet, self.admin, {'status': 'assigned'}),
+            (views.DispatchViewSet, self.admin, {'operator': self.operator.pk}),
+            (views.DispatchViewSet, self.operator, {}),
+            (views.DispatchViewSet, self.operator, {'status': 'in_transit'}),
+            (views.DispatchMediaViewSet, self.admin, {}),
+            (views.DispatchMediaViewSet, self.admin, {'dispatch': 1}),
+            (views.DispatchMediaViewSet, self.admin, {'media_type': 'weigh_in'}),
+            (views.ExceptionLogViewSet, self.admin, {}),
+            (views.ExceptionLogViewSet, self.admin, {'dispatch': 1}),
+        ]
+        if connection.vendor != 'sqlite':
+            cases.append((views.ExceptionLogViewSet, self.admin, {'resolved': 'false'}))
+        for viewset_class, user, params in cases:
+            with self.subTest(viewset=viewset_class.__name__, user=user.username, params=params):
+                self.assertNoFullScan(self.list_queryset(viewset_class, user, params))
+
+    def test_truck_allocation_queries(self):
+        idle = Truck.objects.filter(status='idle')
+        self.assertNoFullScan(idle.filter(capacity__gte=10).order_by('capacity', 'id')[:5])
+        self.assertNoFullScan(idle.order_by('-capacity', 'id')[:5])
+
+    def test_sync_queries(self):
+        since = timezone.now()
+        for model, lookup in [(Dispatch, 'operator'), (DispatchMedia, 'dispatch__operator'),
+                              (ExceptionLog, 'dispatch__operator')]:
+            changed = model.objects.order_by().filter(updated_at__gt=since)
+            self.assertNoFullScan(changed)
+            self.assertNoFullScan(changed.filter(**{lookup: self.operator}))
+        self.assertNoFullScan(SyncTombstone.objects.filter(deleted_at__gt=since))
+        self.assertNoFullScan(SyncTombstone.objects.filter(deleted_at__gt=since, operator=self.operator))
+
+    def test_kpi_dashboard_queries(self):
+        today_start = timezone.localtime().replace(hour=0, minute=0, second=0, microsecond=0)
+        self.assertNoFullScan(Order.objects.filter(
+            status='completed', updated_at__gte=today_start, updated_at__lt=today_start + timedelta(days=1)
+        ))
+        self.assertNoFullScan(Order.objects.filter(status='pending'))
+        self.assertNoFullScan(Dispatch.objects.filter(status__in=['assigned', 'in_progress']))
+        if connection.vendor != 'sqlite':
+            self.assertNoFullScan(ExceptionLog.objects.filter(resolved=False))
+
+
+class KPIDashboardTests(APITestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.admin = User.objects.create_user('kpi_admin', password='x')
+        UserProfile.objects.create(user=cls.admin, role='admin')
+        cls.customer = Customer.objects.create(name='Acme', contact='123')
+        Material.objects.create(name='Coal', stock_quantity=500)
+        Material.objects.create(name='Sand', stock_quantity=5)
+
+    def setUp(self):
+        self.client.force_authenticate(self.admin)
+        # Versions bumped by earlier tests were rolled back with them
+        response_cache.clear()
+
+    def create_history(self, count):
+        # Committed, so the response cache is invalidated
+        with self.captureOnCommitCallbacks(execute=True):
+            self._create_history(count)
+
+    def _create_history(self, count):
+        now = timezone.now()
+        for i in range(count):
+            Truck.objects.create(number_plate=f'KPI-{Truck.objects.count()}', capacity=20, driver_name='D')
+            order = Order.objects.create(customer=self.customer, material_type='Coal', quantity=1)
+            dispatch = order.dispatches.get()
+            dispatch.status = 'in_transit'
+            dispatch.departure_time = now - timedelta(hours=2)
+            dispatch.save()
+            dispatch.status = 'completed'
+            dispatch.arrival_time = now
+            dispatch.save()
+            ExceptionLog.objects.create(dispatch=dispatch, description='Late', resolved=bool(i % 2))
+        Order.objects.create(customer=self.customer, material_type='Sand', quantity=1)
+
+    def test_query_count_does_not_depend_on_history(self):
+        self.create_history(2)
+        with self.assertNumQueries(4):
+            small = self.client.get('/api/dashboard/kpi/')
+        self.create_history(10)
+        with self.assertNumQueries(4):
+            large = self.client.get('/api/dashboard/kpi/')
+
+        self.assertEqual(small.status_code, 200)
+        self.assertEqual(large.data['total_trucks'], 12)
+        self.assertEqual(large.data['completed_orders_today'], 12)
+        self.assertEqual(large.data['pending_orders'], 2)
+        self.assertEqual(large.data['active_dispatches'], 2)
+        self.assertEqual(large.data['total_exceptions'], 12)
+        self.assertEqual(large.data['unresolved_exceptions'], 6)
+        self.assertEqual(large.data['average_delivery_time'], 2.0)
+        self.assertEqual(large.data['material_stock_summary']['Sand'], {'quantity': 5.0, 'unit': 'tons', 'low_stock': True})
+
+    def test_incremental_counters_match_rebuild(self):
+        self.create_history(3)
+        exception = ExceptionLog.objects.filter(resolved=False).first()
+        exception.resolved = True
+        exception.save()
+        Dispatch.objects.first().delete()
+
+        incremental = KPISnapshot.current()
+        rebuilt = KPISnapshot.rebuild()
+        for field in ['total_trucks', 'active_dispatches', 'pending_orders', 'total_exceptions',
+                      'unresolved_exceptions', 'delivery_count']:
+            self.assertEqual(getattr(incremental, field), getattr(rebuilt, field), field)
+        self.assertAlmostEqual(incremental.delivery_seconds_total, rebuilt.delivery_seconds_total)
+
+    def test_rebuild_command_recounts_completed_orders(self):
+        self.create_history(3)
+        scopes = list(ResponseCacheScope.objects.order_by('scope').values_list('scope', flat=True))
+        DailyOrderKPI.objects.update(completed_orders=99)
+        DailyOrderKPI.objects.create(date=timezone.localdate() - timedelta(days=1), completed_orders=4)
+
+        call_command('rebuild_kpis', stdout=StringIO())
+
+        self.assertEqual(list(DailyOrderKPI.objects.values_list('date', 'completed_orders')),
+                         [(timezone.localdate(), 3)])
+        # Cache versions are not KPI rows
+        self.assertEqual(list(ResponseCacheScope.objects.order_by('scope').values_list('scope', flat=True)), scopes)
+
+
+class ResponseCacheTests(APITestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.admin = User.objects.create_user('cache_admin', password='x')
+        UserProfile.objects.create(user=cls.admin, role='admin')
+        Truck.objects.create(number_plate='CACHE-1', capacity=20, driver_name='D')
+
+    def setUp(self):
+        self.client.force_authenticate(self.admin)
+        response_cache.clear()
+
+    def test_hit_miss_and_invalidation_after_write(self):
+        self.assertEqual(self.client.get('/api/trucks/')['X-Cache'], 'MISS')
+        self.assertEqual(self.client.get('/api/trucks/')['X-Cache'], 'HIT')
+        # Another query string is another entry
+        self.assertEqual(self.client.get('/api/trucks/', {'status': 'idle'})['X-Cache'], 'MISS')
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post('/api/trucks/', {'number_plate': 'CACHE-2', 'capacity': 10, 'driver_name': 'E'})
+        response = self.client.get('/api/trucks/')
+        self.assertEqual(response['X-Cache'], 'MISS')
+        self.assertEqual(len(response.data), 2)
+
+    def test_bump_waits_for_commit_and_reaches_other_processes(self):
+        other = ResponseCache(settings.RESPONSE_CACHE_ALIAS, 10)
+        before = other.version('trucks')
+        with self.captureOnCommitCallbacks() as callbacks:
+            Truck.objects.create(number_plate='CACHE-2', capacity=10, driver_name='E')
+            Truck.objects.create(number_plate='CACHE-3', capacity=10, driver_name='E')
+        self.assertEqual(other.version('trucks'), before)
+
+        with CaptureQueriesContext(connection) as ctx:
+            for callback in callbacks:
+                callback()
+        # One bump for the whole transaction, seen by every process
+        self.assertEqual(len([query for query in ctx.captured_queries
+                              if 'UPDATE "api_responsecachescope"' in query['sql']]), 1)
+        self.assertEqual(other.version('trucks'), before + 1)
+
+    def test_local_entries_are_bounded(self):
+        cache = ResponseCache(settings.RESPONSE_CACHE_ALIAS, 2)
+        for key in ['a', 'b', 'c']:
+            cache.set(key, key)
+        self.assertEqual(list(cache._local), ['b', 'c'])
+
+        factory = APIRequestFactory()
+        cache.get('trucks', factory.get('/api/trucks/'))
+        cache.set(cache.key('trucks', factory.get('/api/trucks/')), 'cached')
+        self.assertEqual(len(cache._local), 2)
+
+    def test_entries_expire_with_the_backend_timeout(self):
+        self.assertEqual(self.client.get('/api/trucks/')['X-Cache'], 'MISS')
+        timeout = caches[settings.RESPONSE_CACHE_ALIAS].default_timeout
+        with mock.patch('api.cache.time.time', return_value=time.time() + timeout + 1):
+            self.assertEqual(self.client.get('/api/trucks/')['X-Cache'], 'MISS')
+
+    def test_kpi_entries_do_not_outlive_the_day(self):
+        self.assertEqual(self.client.get('/api/dashboard/kpi/')['X-Cache'], 'MISS')
+        self.assertEqual(self.client.get('/api/dashboard/kpi/')['X-Cache'], 'HIT')
+        tomorrow = timezone.localdate() + timedelta(days=1)
+        with mock.patch('api.cache.timezone.localdate', return_value=tomorrow):
+            self.assertEqual(self.client.get('/api/dashboard/kpi/')['X-Cache'], 'MISS')
+
+    def test_stats_endpoint(self):
+        before = self.client.get('/api/dashboard/cache-stats/').data['trucks']
+        for _ in range(3):
+            self.client.get('/api/trucks/')
+        response = self.client.get('/api/dashboard/cache-stats/')
+        self.assertEqual(response.status_code, 200)
+        stats = response.data['trucks']
+        self.assertEqual((stats['hits'] - before['hits'], stats['misses'] - before['misses']), (2, 1))
+
+        operator = User.objects.create_user('cache_operator', password='x')
+        UserProfile.objects.create(user=operator, role='operator')
+        self.client.force_authenticate(operator)
+        self.assertEqual(self.client.get('/api/dashboard/cache-stats/').status_code, 403)
+
+
+class TruckAllocationTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.customer = Customer.objects.create(name='Acme', contact='123')
+
+    def create_truck(self, plate, capacity):
+        return Truck.objects.create(number_plate=plate, capacity=capacity, driver_name='D')
+
+    def test_new_order_reserves_best_fitting_truck(self):
+        self.create_truck('SMALL', 10)
+        medium = self.create_truck('MEDIUM', 25)
+        self.create_truck('LARGE', 60)
+
+        order = Order.objects.create(customer=self.customer, material_type='Coal', quantity=20)
+
+        dispatch = order.dispatches.get()
+        self.assertEqual(dispatch.truck, medium)
+        medium.refresh_from_db()
+        self.assertEqual(medium.status, 'reserved')
+
+    def test_oversized_order_falls_back_to_largest_truck(self):
+        self.create_truck('SMALL', 10)
+        large = self.create_truck('LARGE', 30)
+
+        order = Order.objects.create(customer=self.customer, material_type='Coal', quantity=100)
+
+        self.assertEqual(order.dispatches.get().truck, large)
+
+    def test_backlog_is_drained_when_a_truck_is_freed(self):
+        truck = self.create_truck('ONLY', 30)
+        first = Order.objects.create(customer=self.customer, material_type='Coal', quantity=10)
+        waiting = Order.objects.create(customer=self.customer, material_type='Coal', quantity=10)
+        self.assertFalse(waiting.dispatches.exists())
+
+        dispatch = first.dispatches.get()
+        for status in ['in_transit', 'completed']:
+            dispatch.status = status
+            dispatch.save()
+
+        self.assertEqual(waiting.dispatches.get().truck, truck)
+        truck.refresh_from_db()
+        self.assertEqual(truck.status, 'reserved')
+
+    def test_cancelled_dispatch_is_not_dispatched_again(self):
+        truck = self.create_truck('ONLY', 30)
+        order = Order.objects.create(customer=self.customer, material_type='Coal', quantity=10)
+        waiting = Order.objects.create(customer=self.customer, material_type='Coal', quantity=10)
+        pending = KPISnapshot.current().pending_orders
+
+        transition(order.dispatches.get(), 'cancelled')
+
+        self.assertEqual(order.dispatches.count(), 1)
+        order.refresh_from_db()
+        self.assertEqual(order.status, 'cancelled')
+        self.assertEqual(KPISnapshot.current().pending_orders, pending - 1)
+        # The freed truck goes to the next order instead
+        self.assertEqual(waiting.dispatches.get().truck, truck)
+
+        bulk_transition([waiting.dispatches.get().pk], 'cancelled')
+        self.assertEqual(Dispatch.objects.count(), 2)
+        self.assertEqual(Order.objects.filter(status='cancelled').count(), 2)
+
+    def test_backlog_is_drained_when_a_dispatch_is_deleted(self):
+        truck = self.create_truck('ONLY', 30)
+        first = Order.objects.create(customer=self.customer, material_type='Coal', quantity=10)
+        waiting = Order.objects.create(customer=self.customer, material_type='Coal', quantity=10)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            first.delete()
+
+        self.assertEqual(waiting.dispatches.get().truck, truck)
+
+
+class OrderBulkTests(APITestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.admin = User.objects.create_user('bulk_admin', password='x')
+        UserProfile.objects.create(user=cls.admin, role='admin')
+        Material.objects.create(name='Coal', stock_quantity=100)
+        cls.customer = Customer.objects.create(name='Acme', contact='123')
+        for plate, capacity in [('BULK-10', 10), ('BULK-30', 30)]:
+            Truck.objects.create(number_plate=plate, capacity=capacity, driver_name='D')
+
+    def setUp(self):
+        self.client.force_authenticate(self.admin)
+
+    def rows(self, *quantities):
+        return [{'customer': self.customer.pk, 'material_type': 'Coal', 'quantity': quantity}
+                for quantity in quantities]
+
+    def assert_assigned(self, response, plates):
+        self.assertEqual(response.status_code, 201, response.data)
+        self.assertEqual(response.data['created'], len(plates))
+        trucks = dict(Truck.objects.values_list('pk', 'number_plate'))
+        self.assertEqual([trucks.get(result['truck']) for result in response.data['results']], plates)
+        for result in response.data['results']:
+            if result['truck']:
+                self.assertEqual(Dispatch.objects.get(pk=result['dispatch']).truck_id, result['truck'])
+
+    def test_json_rows_get_best_fitting_trucks_and_the_rest_wait(self):
+        response = self.client.post('/api/orders/bulk/', self.rows(25, 5, 8), format='json')
+        # Served in order: 25 takes the 30, 5 the 10, and 8 finds no idle truck
+        self.assert_assigned(response, ['BULK-30', 'BULK-10', None])
+        self.assertEqual(Order.objects.filter(status='pending').count(), 3)
+        self.assertEqual(Truck.objects.filter(status='reserved').count(), 2)
+
+    def test_csv_body_and_file(self):
+        body = f'customer,material_type,quantity\n{self.customer.pk},Coal,5\n'
+        response = self.client.post('/api/orders/bulk/', body, content_type='text/csv')
+        self.assert_assigned(response, ['BULK-10'])
+
+        upload = SimpleUploadedFile('orders.csv', body.encode(), content_type='text/csv')
+        response = self.client.post('/api/orders/bulk/', {'file': upload}, format='multipart')
+        self.assert_assigned(response, ['BULK-30'])
+
+    def test_row_errors_reject_the_whole_batch(self):
+        rows = self.rows(5, 5)
+        rows[1]['customer'] = 0
+        response = self.client.post('/api/orders/bulk/', rows, format='json')
+
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.data['created'], 0)
+        self.assertEqual([result['status'] for result in response.data['results']], ['valid', 'invalid'])
+        self.assertIn('customer', response.data['results'][1]['errors'])
+        self.assertFalse(Order.objects.exists())
+
+    def test_failure_after_insert_rolls_back(self):
+        with mock.patch('api.allocation.assign_orders', side_effect=RuntimeError), \
+                self.assertRaises(RuntimeError):
+            self.client.post('/api/orders/bulk/', self.rows(5, 5), format='json')
+        self.assertFalse(Order.objects.exists())
+        self.assertFalse(Truck.objects.exclude(status='idle').exists())
+
+    def test_row_limit_and_empty_body(self):
+        with mock.patch.object(views.OrderViewSet, 'max_bulk_rows', 2):
+            response = self.client.post('/api/orders/bulk/', self.rows(1, 1, 1), format='json')
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('At most 2', response.data['error'])
+        self.assertEqual(self.client.post('/api/orders/bulk/', [], format='json').status_code, 400)
+        self.assertFalse(Order.objects.exists())
+
+    def test_backends_without_bulk_returning(self):
+        # MySQL: one save() per row, with the same outcome
+        with mock.patch.object(type(connection.features), 'can_return_rows_from_bulk_insert', False):
+            response = self.client.post('/api/orders/bulk/', self.rows(25, 5), format='json')
+        self.assert_assigned(response, ['BULK-30', 'BULK-10'])
+        self.assertEqual(KPISnapshot.current().pending_orders, 2)
+        self.assertEqual(KPISnapshot.current().active_dispatches, 2)
+
+
+class BulkDispatchTransitionTests(APITestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.admin = User.objects.create_user('bulk_admin', password='x')
+        UserProfile.objects.create(user=cls.admin, role='admin')
+        cls.customer = Customer.objects.create(name='Acme', contact='123')
+
+    def setUp(self):
+        self.client.force_authenticate(self.admin)
+
+    def create_dispatches(self, prefix, count):
+        Material.objects.create(name=f'{prefix}-Coal', stock_quantity=100)
+        dispatches = []
+        for i in range(count):
+            Truck.objects.create(number_plate=f'{prefix}-{i}', capacity=20, driver_name='D')
+            order = Order.objects.create(customer=self.customer, material_type=f'{prefix}-Coal', quantity=15)
+            dispatches.append(order.dispatches.get())
+        return dispatches
+
+    def snapshot(self, dispatches):
+        rows = []
+        for dispatch in dispatches:
+            dispatch.refresh_from_db()
+            rows.append((dispatch.status, dispatch.departure_time is not None, dispatch.arrival_time is not None,
+                         dispatch.order.status, dispatch.truck.status))
+        stock = Material.objects.get(name=dispatches[0].order.material_type).stock_quantity
+        return rows, stock
+
+    def test_bulk_transitions_match_per_row_path(self):
+        per_row = self.create_dispatches('ROW', 4)
+        bulk = self.create_dispatches('BULK', 4)
+        steps = [
+            ('in_transit', {}), ('weigh_in', {'gross_weight': 30}), ('unload', {}),
+            ('weigh_out', {'tare_weight': 15}), ('completed', {}),
+        ]
+
+        for step, fields in steps:
+            for dispatch in per_row:
+                response = self.client.post(f'/api/dispatches/{dispatch.pk}/update_status/', {'status': step, **fields})
+                self.assertEqual(response.status_code, 200)
+            if fields:
+                # Steps that need a weight per dispatch cannot be applied in bulk
+                for dispatch in bulk:
+                    self.client.post(f'/api/dispatches/{dispatch.pk}/update_status/', {'status': step, **fields})
+            else:
+                response = self.client.post('/api/dispatches/bulk_status/',
+                                            {'ids': [d.pk for d in bulk], 'status': step}, format='json')
+                self.assertEqual(response.data, {'updated': 4, 'status': step})
+            self.assertEqual(self.snapshot(per_row), self.snapshot(bulk), step)
+
+        rows, stock = self.snapshot(bulk)
+        self.assertEqual(stock, 40)
+        self.assertEqual(rows[0], ('completed', True, True, 'completed', 'idle'))
+
+        incremental = KPISnapshot.current()
+        rebuilt = KPISnapshot.rebuild()
+        for field in ['active_dispatches', 'pending_orders', 'delivery_count']:
+            self.assertEqual(getattr(incremental, field), getattr(rebuilt, field), field)
+
+    def test_invalid_transition_rejects_whole_batch(self):
+        first, second = self.create_dispatches('BAD', 2)
+        self.client.post(f'/api/dispatches/{first.pk}/update_status/', {'status': 'in_transit'})
+
+        response = self.client.post('/api/dispatches/bulk_status/',
+                                    {'ids': [first.pk, second.pk, 999999], 'status': 'in_transit'}, format='json')
+
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(set(response.data['errors']), {first.pk, 999999})
+        second.refresh_from_db()
+        self.assertEqual(second.status, 'assigned')
+
+    def test_booleans_are_not_ids(self):
+        dispatch, = self.create_dispatches('BOOL', 1)
+        response = self.client.post('/api/dispatches/bulk_status/',
+                                    {'ids': [True], 'status': 'cancelled'}, format='json')
+        self.assertEqual(response.status_code, 400)
+        with self.assertRaises(TransitionError):
+            bulk_transition([True], 'cancelled')
+        dispatch.refresh_from_db()
+        self.assertEqual(dispatch.status, 'assigned')
+
+
+
+class SparseFieldsetTests(APITestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.admin = User.objects.create_user('shape_admin', password='x', first_name='Ada')
+        UserProfile.objects.create(user=cls.admin, role='admin')
+        Material.objects.create(name='Coal', stock_quantity=100)
+
+    def setUp(self):
+        self.client.force_authenticate(self.admin)
+
+    def create_dispatches(self, count):
+        for i in range(count):
+            customer = Customer.objects.create(name=f'Customer {i}', contact='123')
+            Truck.objects.create(number_plate=f'SHAPE-{Truck.objects.count()}', capacity=20, driver_name='D')
+            order = Order.objects.create(customer=customer, material_type='Coal', quantity=5)
+            order.dispatches.update(operator=self.admin)
+
+    def list_queries(self, params):
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.client.get('/api/dispatches/', params)
+        self.assertEqual(response.status_code, 200)
+        # The first two queries work out the conditional GET validators
+        return response.data, [query['sql'] for query in ctx.captured_queries[2:]]
+
+    def test_default_shape_is_unchanged_and_query_count_is_flat(self):
+        self.create_dispatches(1)
+        rows, one = self.list_queries({})
+        self.create_dispatches(3)
+        rows, four = self.list_queries({})
+
+        self.assertEqual(len(one), len(four))
+        self.assertEqual(list(rows[0]), DispatchSerializer.Meta.fields)
+        self.assertEqual(rows[0]['operator_name'], 'Ada')
+        self.assertTrue(rows[0]['order_customer'].startswith('Customer'))
+
+    def test_fields_narrow_columns_and_joins(self):
+        self.create_dispatches(2)
+        rows, queries = self.list_queries({'fields': 'id,status,truck_number_plate'})
+
+        self.assertEqual(list(rows[0]), ['id', 'truck_number_plate', 'status'])
+        select = next(sql for sql in queries if 'FROM "api_dispatch"' in sql)
+        self.assertIn('"api_truck"."number_plate"', select)
+        self.assertNotIn('"api_dispatch"."gross_weight"', select)
+        self.assertNotIn('"api_order"', select)
+        self.assertFalse(any('"api_dispatchmedia"' in sql for sql in queries))
+
+        rows, queries = self.list_queries({'fields': 'id,status'})
+        self.assertEqual(len(queries), 1)
+        self.assertNotIn('JOIN', queries[0])
+
+    def test_expand_nests_related_objects(self):
+        self.create_dispatches(2)
+        rows, one = self.list_queries({'fields': 'id,order.id,order.customer', 'expand': 'order.customer,media_files'})
+        self.assertEqual(list(rows[0]), ['id', 'order', 'media_files'])
+        self.assertEqual(list(rows[0]['order']), ['id', 'customer'])
+        self.assertTrue(rows[0]['order']['customer']['name'].startswith('Customer'))
+
+        self.create_dispatches(2)
+        rows, four = self.list_queries({'fields': 'id,order.id,order.customer', 'expand': 'order.customer,media_files'})
+        self.assertEqual(len(one), len(four))
+
+        ExceptionLog.objects.create(dispatch=Dispatch.objects.first(), description='Flat tyre')
+        response = self.client.get('/api/exceptions/', {'fields': 'id,dispatch.truck', 'expand': 'dispatch.truck'})
+        self.assertEqual(response.data[0]['dispatch'], {
+            'truck': TruckSerializer(Dispatch.objects.first().truck).data
+        })
+
+
+class PaginationTests(APITestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.admin = User.objects.create_user('pagination_admin', password='x')
+        UserProfile.objects.create(user=cls.admin, role='admin')
+        customer = Customer.objects.create(name='Acme', contact='123')
+        for i in range(5):
+            Truck.objects.create(number_plate=f'PAGE-{i}', capacity=20, driver_name='D')
+            Order.objects.create(customer=customer, material_type='Coal', quantity=5)
+
+    def setUp(self):
+        self.client.force_authenticate(self.admin)
+        response_cache.clear()
+
+    def test_lists_are_unpaginated_unless_asked(self):
+        for url in ['/api/orders/', '/api/trucks/']:
+            with self.subTest(url=url):
+                response = self.client.get(url)
+                self.assertIsInstance(response.data, list)
+                self.assertEqual(len(response.data), 5)
+
+    def test_cursor_pages_are_stable_when_rows_share_created_at(self):
+        Order.objects.update(created_at=timezone.now())
+        expected = list(Order.objects.order_by('-id').values_list('id', flat=True))
+
+        seen, params = [], {'page_size': 2}
+        while True:
+            response = self.client.get('/api/orders/', params)
+            self.assertNotIn('count', response.data)
+            seen += [row['id'] for row in response.data['results']]
+            if not response.data['next']:
+                break
+            params = dict(parse_qsl(urlsplit(response.data['next']).query))
+            # A row created meanwhile does not shift the pages already handed out
+            Order.objects.create(customer=Customer.objects.get(), material_type='Coal', quantity=5)
+        self.assertEqual(seen, expected)
+
+        # And back from the last page, now with the rows created meanwhile
+        back = [row['id'] for row in response.data['results']]
+        while response.data['previous']:
+            response = self.client.get('/api/orders/', dict(parse_qsl(urlsplit(response.data['previous']).query)))
+            back[:0] = [row['id'] for row in response.data['results']]
+        self.assertEqual(back, list(Order.objects.order_by('-created_at', '-id').values_list('id', flat=True)))
+
+    def test_page_size_is_capped(self):
+        with mock.patch.object(CreatedAtCursorPagination, 'max_page_size', 3):
+            response = self.client.get('/api/orders/', {'page_size': 100})
+        self.assertEqual(len(response.data['results']), 3)
+
+    def test_admin_tables_keep_offset_pages(self):
+        response = self.client.get('/api/trucks/', {'page_size': 2, 'page': 3})
+        self.assertEqual(response.data['count'], 5)
+        self.assertEqual(len(response.data['results']), 1)
+        self.assertIsNone(response.data['next'])
+        self.assertIn('page=2', response.data['previous'])
+
+
+class ProjectionTests(APITestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.admin = User.objects.create_user('projection_admin', password='x', last_name='Lovelace')
+        UserProfile.objects.create(user=cls.admin, role='admin')
+        Material.objects.create(name='Coal', stock_quantity=100)
+        for i in range(3):
+            customer = Customer.objects.create(name=f'Customer {i}', contact='123')
+            Truck.objects.create(number_plate=f'PROJ-{i}', capacity=20, driver_name='D')
+            Order.objects.create(customer=customer, material_type='Coal', quantity=5 + i)
+        first, second, _ = Dispatch.objects.order_by('id')
+        Dispatch.objects.filter(pk=first.pk).update(operator=cls.admin, gross_weight=31.5)
+        DispatchMedia.objects.create(dispatch=first, media_type='weigh_in', image='dispatch_media/a.jpg',
+                                     thumbnail='dispatch_media/a_thumbnail.jpg', uploaded_by=cls.admin)
+        DispatchMedia.objects.create(dispatch=first, media_type='unload', image='dispatch_media/b.jpg')
+        DispatchMedia.objects.create(dispatch=second, media_type='other', image='dispatch_media/c.jpg',
+                                     processing_state='pending')
+        ExceptionLog.objects.create(dispatch=first, description='Flat tyre', resolved_by=cls.admin)
+        Order.objects.create(customer=customer, material_type='Coal', quantity=50)  # Waits for a truck
+
+    def setUp(self):
+        self.client.force_authenticate(self.admin)
+
+    def test_list_output_matches_serializer(self):
+        cases = [
+            ('/api/dispatches/', DispatchSerializer, {}),
+            ('/api/dispatches/', DispatchSerializer, {'variant': 'thumbnail'}),
+            ('/api/dispatches/', DispatchSerializer, {'expand': 'order.customer,operator,truck'}),
+            ('/api/dispatches/', DispatchSerializer, {'fields': 'id,gross_weight,operator_name'}),
+            ('/api/orders/', OrderSerializer, {}),
+            ('/api/orders/', OrderSerializer, {'expand': 'customer'}),
+            ('/api/exceptions/', ExceptionLogSerializer, {'expand': 'dispatch.media_files,resolved_by'}),
+            ('/api/dispatch-media/', DispatchMediaSerializer, {}),
+        ]
+        renderer = JSONRenderer()
+        for url, serializer_class, params in cases:
+            with self.subTest(url=url, params=params):
+                request = Request(APIRequestFactory().get(url, params))
+                serializer = serializer_class(context={'request': request})
+                self.assertIsNotNone(Projection.of(serializer))
+
+                response = self.client.get(url, params)
+                queryset = serializer_class.Meta.model.objects.order_by('-created_at', '-id')
+                expected = serializer_class(shape_queryset(queryset, serializer), many=True,
+                                            context={'request': request})
+                self.assertEqual(renderer.render(response.data), renderer.render(expected.data))
+
+    @override_settings(API_STREAM_CHUNK_SIZE=2)
+    def test_streamed_list_matches_paginated_list(self):
+        for url, params in [('/api/dispatches/', {}), ('/api/orders/', {'expand': 'customer'}),
+                            ('/api/exceptions/', {'fields': 'id,description'})]:
+            with self.subTest(url=url, params=params):
+                response = self.client.get(url, {**params, 'stream': 'true'})
+                self.assertTrue(response.streaming)
+                streamed = json.loads(b''.join(response.streaming_content))
+                self.assertEqual(streamed, json.loads(self.client.get(url, {**params, 'page_size': 50}).content)['results'])
+
+    @override_settings(API_STREAM_CHUNK_SIZE=3)
+    def test_streamed_chunks_continue_after_the_last_row(self):
+        # Ties on created_at are broken by id, not skipped or repeated
+        Order.objects.update(created_at=timezone.now())
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.client.get('/api/orders/', {'stream': 'true', 'fields': 'id'})
+            streamed = json.loads(b''.join(response.streaming_content))
+        self.assertEqual([row['id'] for row in streamed], list(Order.objects.order_by('-id').values_list('id', flat=True)))
+        reads = [query['sql'] for query in ctx.captured_queries if query['sql'].startswith('SELECT "api_order"."')]
+        self.assertEqual(len(reads), 2)
+        self.assertTrue(all('LIMIT 3' in sql for sql in reads))
+
+    def test_projected_list_queries(self):
+        with CaptureQueriesContext(connection) as ctx:
+            self.client.get('/api/dispatches/')
+        # The validators (row summary and scope versions), the dispatch rows
+        # with their joins, then every page's media in one go
+        self.assertEqual(len(ctx.captured_queries), 4)
+
+
+
+@override_settings(EXPORT_BATCH_SIZE=2)
+class ExportTests(APITestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.admin = User.objects.create_user('export_admin', password='x')
+        UserProfile.objects.create(user=cls.admin, role='admin')
+        cls.operator = User.objects.create_user('export_operator', password='x')
+        UserProfile.objects.create(user=cls.operator, role='operator')
+        Material.objects.create(name='Coal', stock_quantity=100)
+        customer = Customer.objects.create(name='Acme, Ltd', contact='123')
+        for i in range(5):
+            Truck.objects.create(number_plate=f'EXP-{i}', capacity=20, driver_name='D')
+            Order.objects.create(customer=customer, material_type='Coal', quantity=5)
+        Dispatch.objects.filter(pk__in=Dispatch.objects.order_by('id')[:3].values('id')).update(
+            operator=cls.operator, gross_weight=30.5, tare_weight=12
+        )
+
+    def export(self, url, params=None):
+        response = self.client.get(url, params or {})
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.streaming)
+        return b''.join(response.streaming_content).decode()
+
+    def test_csv_export_has_every_row_and_net_weight(self):
+        self.client.force_authenticate(self.admin)
+        rows = list(csv.DictReader(StringIO(self.export('/api/dispatches/export/'))))
+        self.assertEqual([int(row['id']) for row in rows], list(Dispatch.objects.order_by('id').values_list('id', flat=True)))
+        self.assertEqual(rows[0]['net_weight'], '18.5')
+        self.assertEqual(rows[0]['customer'], 'Acme, Ltd')
+        self.assertEqual(rows[-1]['net_weight'], '')
+
+        Order.objects.filter(pk=Order.objects.order_by('id')[0].pk).update(status='completed')
+        rows = list(csv.DictReader(StringIO(self.export('/api/orders/export/', {'status': 'completed'}))))
+        self.assertEqual([row['status'] for row in rows], ['completed'])
+
+    def test_ndjson_export_uses_list_filters(self):
+        self.client.force_authenticate(self.operator)
+        lines = self.export('/api/dispatches/export/', {'format': 'ndjson'}).splitlines()
+        rows = [json.loads(line) for line in lines]
+        self.assertEqual(len(rows), 3)
+        self.assertEqual({row['operator'] for row in rows}, {'export_operator'})
+        self.assertEqual(rows[0]['net_weight'], 18.5)
+
+        ExceptionLog.objects.create(dispatch_id=rows[0]['id'], description='Late')
+        lines = self.export('/api/exceptions/export/', {'format': 'ndjson', 'resolved': 'false'}).splitlines()
+        self.assertEqual(json.loads(lines[0])['truck_number_plate'], rows[0]['truck_number_plate'])
+
+    async def asgi_get(self, path, query_string):
+        """Serve a GET through ``backend.asgi``, as uvicorn does; returns the messages sent."""
+        token = await sync_to_async(lambda: str(issue_tokens(self.admin).access_token))()
+        scope = {
+            'type': 'http', 'asgi': {'version': '3.0'}, 'http_version': '1.1', 'method': 'GET', 'scheme': 'http',
+            'path': path, 'raw_path': path.encode(), 'query_string': query_string.encode(), 'root_path': '',
+            'headers': [(b'host', settings.ALLOWED_HOSTS[0].encode()), (b'authorization', f'Bearer {token}'.encode())],
+            'client': ('127.0.0.1', 50000), 'server': ('127.0.0.1', 8000),
+        }
+        requests = [{'type': 'http.request', 'body': b'', 'more_body': False}]
+        messages = []
+
+        async def receive():
+            if requests:
+                return requests.pop()
+            await asyncio.Future()  # The client never disconnects
+
+        async def send(message):
+            messages.append(message)
+
+        await asgi_application(scope, receive, send)
+        return messages
+
+    @override_settings(EXPORT_BATCH_SIZE=2, API_STREAM_CHUNK_SIZE=2)
+    def test_asgi_streams_without_buffering(self):
+        for path, query_string in [('/api/dispatches/export/', ''), ('/api/orders/export/', 'format=ndjson'),
+                                   ('/api/orders/', 'stream=true')]:
+            with self.subTest(path=path, query_string=query_string), warnings.catch_warnings(record=True) as caught:
+                warnings.simplefilter('always')
+                messages = async_to_sync(self.asgi_get)(path, query_string)
+            # Django warns when it has to read a synchronous iterator to the end first
+            self.assertEqual([str(warning.message) for warning in caught
+                              if 'StreamingHttpResponse' in str(warning.message)], [])
+            self.assertEqual(messages[0]['status'], 200)
+            bodies = [message['body'] for message in messages[1:] if message.get('body')]
+            self.assertGreater(len(bodies), 2)
+            if path.endswith('export/'):
+                # Five rows, and a header line in CSV
+                self.assertEqual(len(b''.join(bodies).splitlines()), 5 if 'ndjson' in query_string else 6)
+            else:
+                self.assertEqual(len(json.loads(b''.join(bodies))), 5)
+
+    def test_management_command_writes_file(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'dispatches.csv')
+            call_command('export_history', 'dispatches', path, '--filter', f'operator={self.operator.pk}',
+                         stdout=StringIO())
+            with open(path, newline='') as file:
+                self.assertEqual(len(list(csv.DictReader(file))), 3)
+
+class ConditionalGetTests(APITestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.admin = User.objects.create_user('conditional_admin', password='x')
+        UserProfile.objects.create(user=cls.admin, role='admin')
+        Material.objects.create(name='Coal', stock_quantity=100)
+        cls.customer = Customer.objects.create(name='Acme', contact='123')
+        for i in range(2):
+            Truck.objects.create(number_plate=f'COND-{i}', capacity=20, driver_name='D')
+            Order.objects.create(customer=cls.customer, material_type='Coal', quantity=5)
+
+    def setUp(self):
+        self.client.force_authenticate(self.admin)
+        response_cache.clear()
+
+    def revalidate(self, url, response, **headers):
+        return self.client.get(url, HTTP_IF_NONE_MATCH=response['ETag'], **headers)
+
+    def test_unchanged_list_is_not_serialized_again(self):
+        first = self.client.get('/api/dispatches/')
+        self.assertEqual(first.status_code, 200)
+        self.assertIn('no-cache', first['Cache-Control'])
+
+        # The row summary and the scope versions
+        with self.assertNumQueries(2):
+            second = self.revalidate('/api/dispatches/', first)
+        self.assertEqual(second.status_code, 304)
+        self.assertEqual(second['ETag'], first['ETag'])
+        self.assertEqual(second.content, b'')
+
+        # Another query string is another representation
+        self.assertEqual(self.client.get('/api/dispatches/', {'fields': 'id'},
+                                          HTTP_IF_NONE_MATCH=first['ETag']).status_code, 200)
+
+    def test_changes_to_rows_and_related_rows_invalidate(self):
+        first = self.client.get('/api/orders/')
+        with self.captureOnCommitCallbacks(execute=True):
+            self.customer.name = 'Acme Renamed'
+            self.customer.save()
+        second = self.revalidate('/api/orders/', first)
+        self.assertEqual(second.status_code, 200)
+        self.assertEqual(second.data[0]['customer_name'], 'Acme Renamed')
+
+        with self.captureOnCommitCallbacks(execute=True):
+            Order.objects.order_by('id').first().delete()
+        self.assertEqual(self.revalidate('/api/orders/', second).status_code, 200)
+
+    def test_detail_and_if_modified_since(self):
+        order = Order.objects.order_by('id').first()
+        url = f'/api/orders/{order.pk}/'
+        first = self.client.get(url)
+        self.assertEqual(self.revalidate(url, first).status_code, 304)
+        self.assertEqual(self.client.get(url, HTTP_IF_MODIFIED_SINCE=first['Last-Modified']).status_code, 304)
+        self.assertEqual(self.client.get('/api/orders/0/', HTTP_IF_NONE_MATCH=first['ETag']).status_code, 404)
+
+    def test_cached_function_view(self):
+        first = self.client.get('/api/dashboard/kpi/')
+        self.assertEqual(self.revalidate('/api/dashboard/kpi/', first).status_code, 304)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            Truck.objects.create(number_plate='COND-NEW', capacity=20, driver_name='D')
+        second = self.revalidate('/api/dashboard/kpi/', first)
+        self.assertEqual(second.status_code, 200)
+        self.assertEqual(second.data['total_trucks'], 3)
+
+
+class EventStreamTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.admin = User.objects.create_user('events_admin', password='x')
+        UserProfile.objects.create(user=cls.admin, role='admin')
+        cls.operator = User.objects.create_user('events_operator', password='x')
+        UserProfile.objects.create(user=cls.operator, role='operator')
+        Material.objects.create(name='Coal', stock_quantity=100)
+        customer = Customer.objects.create(name='Acme', contact='123')
+        for i in range(2):
+            Truck.objects.create(number_plate=f'EVT-{i}', capacity=20, driver_name='D')
+            Order.objects.create(customer=customer, material_type='Coal', quantity=5)
+        cls.own, cls.other = Dispatch.objects.order_by('id')
+        Dispatch.objects.filter(pk=cls.own.pk).update(operator=cls.operator)
+        cls.tokens = {user: str(RefreshToken.for_user(user).access_token) for user in (cls.admin, cls.operator)}
+
+    def start_journey(self, dispatch):
+        with self.captureOnCommitCallbacks(execute=True):
+            transition(Dispatch.objects.get(pk=dispatch.pk), 'in_transit')
+
+    async def frames(self, stream, count):
+        frames = [await asyncio.wait_for(anext(stream), 5) for _ in range(count)]
+        return [dict(line.split(': ', 1) for line in frame.decode().strip().split('\n')) for frame in frames]
+
+    async def open(self, user, **headers):
+        response = await self.async_client.get('/api/events/', {'token': self.tokens[user]}, headers=headers)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'text/event-stream')
+        stream = aiter(response.streaming_content)
+        self.assertEqual(await anext(stream), b'retry: 3000\n\n')
+        return stream
+
+    async def test_operators_only_see_their_dispatches(self):
+        admin_stream = await self.open(self.admin)
+        operator_stream = await self.open(self.operator)
+        try:
+            await sync_to_async(self.start_journey)(self.other)
+            await sync_to_async(self.start_journey)(self.own)
+
+            # The dispatch, then its truck and order, for each transition
+            seen = await self.frames(admin_stream, 6)
+            self.assertEqual([frame['event'] for frame in seen], ['dispatch', 'truck', 'order'] * 2)
+            operator_seen = await self.frames(operator_stream, 3)
+            self.assertEqual([frame['id'] for frame in operator_seen], [frame['id'] for frame in seen[3:]])
+            payload = json.loads(operator_seen[0]['data'])
+            self.assertEqual(payload['action'], 'updated')
+            self.assertEqual(payload['object']['id'], self.own.pk)
+            self.assertEqual(payload['object']['status'], 'in_transit')
+        finally:
+            await admin_stream.aclose()
+            await operator_stream.aclose()
+
+    async def test_reconnect_resumes_from_last_event_id(self):
+        stream = await self.open(self.admin)
+        try:
+            await sync_to_async(self.start_journey)(self.own)
+            first, *missed = await self.frames(stream, 3)
+        finally:
+            await stream.aclose()
+
+        resumed = await self.open(self.admin, **{'Last-Event-ID': first['id']})
+        try:
+            self.assertEqual(await self.frames(resumed, 2), missed)
+        finally:
+            await resumed.aclose()
+
+        unknown = await self.open(self.admin, **{'Last-Event-ID': 'elsewhere-12'})
+        try:
+            self.assertEqual((await self.frames(unknown, 1))[0]['event'], 'reset')
+        finally:
+            await unknown.aclose()
+
+    async def test_writes_without_subscribers_are_not_read(self):
+        bus = EventBus(replay_size=10)
+        bus.emit([('order', {'action': 'updated', 'object': {}}, frozenset())])
+        with mock.patch('api.events.event_bus', bus), mock.patch('api.views.event_bus', bus):
+            with mock.patch('api.events._events') as events:
+                await sync_to_async(self.start_journey)(self.own)
+            events.assert_not_called()
+
+            # The skipped events cannot be replayed: the client starts over
+            stream = await self.open(self.admin, **{'Last-Event-ID': f'{bus.token}-1'})
+            try:
+                self.assertEqual((await self.frames(stream, 1))[0]['event'], 'reset')
+            finally:
+                await stream.aclose()
+
+    def test_needs_a_token_and_an_asgi_server(self):
+        self.assertEqual(async_to_sync(self.async_client.get)('/api/events/').status_code, 401)
+        self.assertEqual(self.client.get('/api/events/', {'token': self.tokens[self.admin]}).status_code, 501)
+
+
+class ClaimsAuthenticationTests(APITestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user('claims_user', email='claims@example.com', password='secret-pass')
+        UserProfile.objects.create(user=cls.user, role='operator')
+        Material.objects.create(name='Coal', stock_quantity=100)
+        Truck.objects.create(number_plate='CLAIM-1', capacity=20, driver_name='D')
+        Order.objects.create(customer=Customer.objects.create(name='Acme', contact='123'),
+                             material_type='Coal', quantity=5)
+        cls.dispatch = Dispatch.objects.get()
+        Dispatch.objects.filter(pk=cls.dispatch.pk).update(operator=cls.user)
+
+    def setUp(self):
+        # Digests cached by earlier tests describe rows rolled back since
+        caches[settings.AUTH_CACHE_ALIAS].clear()
+
+    def login(self):
+        response = self.client.post('/api/auth/login/', {'username': 'claims_user', 'password': 'secret-pass'})
+        self.assertEqual(response.status_code, 200)
+        return response.data['tokens']
+
+    def get(self, url, access):
+        return self.client.get(url, HTTP_AUTHORIZATION=f'Bearer {access}')
+
+    def test_role_checks_need_no_query(self):
+        access = self.login()['access']
+        self.assertEqual(self.get('/api/dashboard/cache-stats/', access).status_code, 403)
+        # The claims digest is cached now: authentication and permissions are free
+        with self.assertNumQueries(0):
+            self.assertEqual(self.get('/api/dashboard/cache-stats/', access).status_code, 403)
+        legacy = str(RefreshToken.for_user(self.user).access_token)
+        with self.assertNumQueries(2):
+            self.assertEqual(self.get('/api/dashboard/cache-stats/', legacy).status_code, 403)
+
+        # Operators still get only their dispatches, and writes use the claims user
+        self.assertEqual([row['id'] for row in self.get('/api/dispatches/', access).data],
+                         [self.dispatch.pk])
+        exception = ExceptionLog.objects.create(dispatch=self.dispatch, description='Flat tyre')
+        response = self.client.post(f'/api/exceptions/{exception.pk}/resolve/', HTTP_AUTHORIZATION=f'Bearer {access}')
+        self.assertEqual(response.data['resolved_by'], self.user.pk)
+        self.assertEqual(self.get('/api/auth/profile/', access).data['email'], 'claims@example.com')
+
+    def test_role_change_forces_refresh(self):
+        tokens = self.login()
+        self.assertEqual(self.get('/api/dashboard/cache-stats/', tokens['access']).status_code, 403)
+
+        profile = UserProfile.objects.get(user=self.user)
+        profile.role = 'admin'
+        profile.save()
+        stale = self.get('/api/dashboard/cache-stats/', tokens['access'])
+        self.assertEqual(stale.status_code, 401)
+        self.assertEqual(stale.data['code'], 'token_not_valid')
+
+        refreshed = self.client.post('/api/auth/refresh/', {'refresh': tokens['refresh']})
+        self.assertEqual(refreshed.status_code, 200)
+        self.assertEqual(self.get('/api/dashboard/cache-stats/', refreshed.data['access']).status_code, 200)
+
+    def test_deactivated_user_cannot_refresh(self):
+        tokens = self.login()
+        self.user.is_active = False
+        self.user.save()
+        self.assertEqual(self.get('/api/dispatches/', tokens['access']).status_code, 401)
+        self.assertEqual(self.client.post('/api/auth/refresh/', {'refresh': tokens['refresh']}).status_code, 401)
+
+
+class TokenBlacklistTests(APITestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user('blacklist_user', password='secret-pass')
+        UserProfile.objects.create(user=cls.user, role='operator')
+
+    def setUp(self):
+        # The filter may hold ids of rows rolled back since
+        token_blacklist.reset()
+
+    def login(self):
+        return self.client.post('/api/auth/login/', {'username': 'blacklist_user', 'password': 'secret-pass'}).data
+
+    def refresh(self, token):
+        return self.client.post('/api/auth/refresh/', {'refresh': token})
+
+    def test_bloom_filter_has_no_false_negatives(self):
+        bloom = BloomFilter(1000)
+        keys = [f'jti-{number}' for number in range(1000)]
+        for key in keys:
+            bloom.add(key)
+        self.assertTrue(all(key in bloom for key in keys))
+        false_positives = sum(f'other-{number}' in bloom for number in range(10000))
+        self.assertLess(false_positives, 50)
+
+    def test_rotated_and_logged_out_tokens_are_rejected(self):
+        tokens = self.login()['tokens']
+        rotated = self.refresh(tokens['refresh'])
+        self.assertEqual(rotated.status_code, 200)
+        self.assertEqual(self.refresh(tokens['refresh']).status_code, 401)
+
+        self.client.credentials(HTTP_AUTHORIZATION=f"Bearer {rotated.data['access']}")
+        response = self.client.post('/api/auth/logout/', {'refresh_token': rotated.data['refresh']})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.refresh(rotated.data['refresh']).status_code, 401)
+        self.assertEqual(RevokedToken.objects.count(), 2)
+
+    def test_concurrent_refreshes_rotate_once(self):
+        refresh = self.login()['tokens']['refresh']
+        # Both requests pass the blacklist check before either revokes
+        with mock.patch.object(token_blacklist, 'is_revoked', return_value=False):
+            first, second = self.refresh(refresh), self.refresh(refresh)
+        self.assertEqual(first.status_code, 200)
+        self.assertEqual(second.status_code, 401)
+        self.assertNotIn('refresh', second.data)
+        self.assertEqual(RevokedToken.objects.count(), 1)
+
+    def test_revocations_by_other_processes_are_seen(self):
+        jti = 'revoked-elsewhere'
+        self.assertFalse(token_blacklist.is_revoked(jti))
+        RevokedToken.objects.create(jti=jti, expires_at=timezone.now() + timedelta(days=1))
+        # Another process bumps the shared generation with its revocation
+        token_blacklist.cache.set(GENERATION_KEY, (token_blacklist.cache.get(GENERATION_KEY) or 0) + 1, None)
+        with self.assertNumQueries(2):
+            self.assertTrue(token_blacklist.is_revoked(jti))
+        # Known ids and clean ones cost no catch-up; clean ones no query at all
+        with self.assertNumQueries(0):
+            self.assertFalse(token_blacklist.is_revoked('never-revoked'))
+
+    def test_compaction_deletes_expired_tokens(self):
+        now = timezone.now()
+        RevokedToken.objects.bulk_create([
+            RevokedToken(jti='expired', expires_at=now - timedelta(minutes=1)),
+            RevokedToken(jti='live', expires_at=now + timedelta(days=1)),
+        ])
+        call_command('compact_token_blacklist', stdout=StringIO())
+        self.assertEqual(list(RevokedToken.objects.values_list('jti', flat=True)), ['live'])
+
+
+@override_settings(SYNC_OVERLAP_SECONDS=0)
+class SyncTests(APITestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.admin = User.objects.create_user('sync_admin', password='x')
+        UserProfile.objects.create(user=cls.admin, role='admin')
+        cls.operator, cls.colleague = [User.objects.create_user(f'sync_operator_{i}', password='x') for i in range(2)]
+        for user in (cls.operator, cls.colleague):
+            UserProfile.objects.create(user=user, role='operator')
+        Material.objects.create(name='Coal', stock_quantity=100)
+        customer = Customer.objects.create(name='Acme', contact='123')
+        for i in range(2):
+            Truck.objects.create(number_plate=f'SYNC-{i}', capacity=20, driver_name='D')
+            Order.objects.create(customer=customer, material_type='Coal', quantity=5)
+        cls.own, cls.other = Dispatch.objects.order_by('id')
+        Dispatch.objects.filter(pk=cls.own.pk).update(operator=cls.operator)
+        cls.exception = ExceptionLog.objects.create(dispatch=cls.own, description='Flat tyre')
+        ExceptionLog.objects.create(dispatch=cls.other, description='Late')
+
+    def sync(self, user, since=None):
+        self.client.force_authenticate(user)
+        response = self.client.get('/api/sync/', {'since': since} if since else {})
+        self.assertEqual(response.status_code, 200)
+        return response.data
+
+    def test_full_sync_then_only_changes(self):
+        full = self.sync(self.operator)
+        self.assertTrue(full['reset'])
+        self.assertEqual([row['id'] for row in full['dispatches']], [self.own.pk])
+        self.assertNotIn('media_files', full['dispatches'][0])
+        self.assertEqual([row['id'] for row in full['exceptions']], [self.exception.pk])
+
+        unchanged = self.sync(self.operator, full['token'])
+        self.assertFalse(unchanged['reset'])
+        self.assertEqual([unchanged[name] for name in ('dispatches', 'media', 'exceptions')], [[], [], []])
+        self.assertEqual(unchanged['deleted'], {'dispatches': [], 'media': [], 'exceptions': []})
+
+        transition(Dispatch.objects.get(pk=self.own.pk), 'in_transit')
+        transition(Dispatch.objects.get(pk=self.other.pk), 'in_transit')
+        exception_id = self.exception.pk
+        self.exception.delete()
+        delta = self.sync(self.operator, unchanged['token'])
+        self.assertEqual([(row['id'], row['status']) for row in delta['dispatches']], [(self.own.pk, 'in_transit')])
+        self.assertEqual(delta['exceptions'], [])
+        self.assertEqual(delta['deleted']['exceptions'], [exception_id])
+
+        # Admins see every change
+        admin_delta = self.sync(self.admin, unchanged['token'])
+        self.assertEqual({row['id'] for row in admin_delta['dispatches']}, {self.own.pk, self.other.pk})
+
+    def test_reassigned_dispatch_moves_between_operators(self):
+        token = self.sync(self.operator)['token']
+        colleague_token = self.sync(self.colleague)['token']
+
+        self.client.force_authenticate(self.admin)
+        response = self.client.post(f'/api/dispatches/{self.own.pk}/assign_operator/',
+                                    {'operator_id': self.colleague.pk}, format='json')
+        self.assertEqual(response.status_code, 200)
+
+        previous = self.sync(self.operator, token)
+        self.assertEqual(previous['dispatches'], [])
+        self.assertEqual(previous['deleted']['dispatches'], [self.own.pk])
+        self.assertEqual(previous['deleted']['exceptions'], [self.exception.pk])
+        # The exception is older than the colleague's token but new to them
+        new = self.sync(self.colleague, colleague_token)
+        self.assertEqual([row['id'] for row in new['dispatches']], [self.own.pk])
+        self.assertEqual([row['id'] for row in new['exceptions']], [self.exception.pk])
+        self.assertEqual(new['deleted']['dispatches'], [])
+
+    def test_first_assignment_brings_existing_exceptions(self):
+        token = self.sync(self.operator)['token']
+        late = self.other.exceptions.get()
+
+        self.client.force_authenticate(self.admin)
+        response = self.client.post(f'/api/dispatches/{self.other.pk}/assign_operator/',
+                                    {'operator_id': self.operator.pk}, format='json')
+        self.assertEqual(response.status_code, 200)
+
+        delta = self.sync(self.operator, token)
+        self.assertEqual([row['id'] for row in delta['dispatches']], [self.other.pk])
+        self.assertEqual([row['id'] for row in delta['exceptions']], [late.pk])
+        # Nobody had the dispatch before
+        self.assertFalse(SyncTombstone.objects.exists())
+
+    def test_bad_and_expired_tokens(self):
+        self.client.force_authenticate(self.operator)
+        self.assertEqual(self.client.get('/api/sync/', {'since': 'forged'}).status_code, 400)
+
+        token = self.sync(self.operator)['token']
+        with override_settings(SYNC_TOMBSTONE_DAYS=0):
+            self.assertTrue(self.sync(self.operator, token)['reset'])
+
+    def test_prune_tombstones(self):
+        self.exception.delete()
+        SyncTombstone.objects.update(deleted_at=timezone.now() - timedelta(days=31))
+        call_command('prune_sync_tombstones', stdout=StringIO())
+        self.assertFalse(SyncTombstone.objects.exists())
+
+
+class FastJSONRendererTests(SimpleTestCase):
+    def test_fast_renderer_matches_drf(self):
+        data = {
+            'text': 'caf\u00e9 \u2028 "quoted"', 'number': 1.5, 'integer': 3, 'none': None, 'flag': True,
+            'decimal': Decimal('12.50'), 'when': timezone.now(), 'lazy': gettext_lazy('Weigh In'),
+            'error': ErrorDetail('Required', code='required'), 'nested': [{1: 'int key'}],
+        }
+        self.assertEqual(FastJSONRenderer().render(data), JSONRenderer().render(data))
+        self.assertEqual(FastJSONRenderer().render(data, 'application/json; indent=2'),
+                         JSONRenderer().render(data, 'application/json; indent=2'))
+        with mock.patch.object(renderers, 'orjson', None):
+            self.assertEqual(FastJSONRenderer().render(data), JSONRenderer().render(data))
+
+
+class WorkflowServiceTests(TestCase):
+    # Statements per transition, not counting savepoints: the dispatch UPDATE,
+    # then one targeted statement per side effect
+    EXPECTED_QUERIES = {
+        'in_transit': 5,   # + lock order, truck, order, KPI counters
+        'weigh_in': 1,
+        'unload': 1,
+        'weigh_out': 1,
+        'completed': 11,   # + lock order, truck, order, stock (3), daily KPI, KPI counters, backlog check (2)
+    }
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.customer = Customer.objects.create(name='Acme', contact='123')
+        Material.objects.create(name='Coal', stock_quantity=100)
+        cls.truck = Truck.objects.create(number_plate='FLOW-1', capacity=20, driver_name='D')
+
+    def setUp(self):
+        KPISnapshot.rebuild()
+        DailyOrderKPI.objects.get_or_create(date=timezone.localdate())
+
+    def count_queries(self, func, *args, **kwargs):
+        with CaptureQueriesContext(connection) as context:
+            func(*args, **kwargs)
+        return len([q for q in context.captured_queries if 'SAVEPOINT' not in q['sql']])
+
+    def test_side_effect_queries_are_pinned(self):
+        order = Order.objects.create(customer=self.customer, material_type='Coal', quantity=15)
+        dispatch = order.dispatches.get()
+        fields = {'weigh_in': {'gross_weight': 30}, 'weigh_out': {'tare_weight': 15}}
+        for new_status, expected in self.EXPECTED_QUERIES.items():
+            with self.subTest(status=new_status):
+                queries = self.count_queries(transition, dispatch, new_status, **fields.get(new_status, {}))
+                self.assertEqual(queries, expected)
+
+        dispatch.refresh_from_db()
+        order.refresh_from_db()
+        self.truck.refresh_from_db()
+        self.assertIsNotNone(dispatch.departure_time)
+        self.assertIsNotNone(dispatch.arrival_time)
+        self.assertEqual(order.status, 'completed')
+        self.assertEqual(self.truck.status, 'idle')
+        self.assertEqual(Material.objects.get(name='Coal').stock_quantity, 85)
+        self.assertEqual(KPISnapshot.current().delivery_count, 1)
+
+    def test_plain_save_runs_side_effects_once(self):
+        order = Order.objects.create(customer=self.customer, material_type='Coal', quantity=15)
+        dispatch = order.dispatches.get()
+        dispatch.status = 'in_transit'
+        dispatch.save()
+        dispatch.status = 'completed'
+        dispatch.save()
+        # Saving again in the same status must not take stock out twice
+        dispatch.save()
+
+        self.assertEqual(Material.objects.get(name='Coal').stock_quantity, 85)
+        incremental = KPISnapshot.current()
+        rebuilt = KPISnapshot.rebuild()
+        for field in ['active_dispatches', 'pending_orders', 'delivery_count']:
+            self.assertEqual(getattr(incremental, field), getattr(rebuilt, field), field)
+
+
+    def test_stale_transition_is_rejected_with_conflict(self):
+        order = Order.objects.create(customer=self.customer, material_type='Coal', quantity=15)
+        first_read = order.dispatches.get()
+        second_read = order.dispatches.get()
+
+        transition(first_read, 'in_transit')
+        with self.assertRaises(TransitionConflict) as raised:
+            transition(second_read, 'in_transit')
+        self.assertEqual(raised.exception.current_status, 'in_transit')
+        self.assertEqual(KPISnapshot.current().pending_orders, KPISnapshot.rebuild().pending_orders)
+
+    def test_step_action_returns_conflict_for_wrong_status(self):
+        admin = User.objects.create_user('flow_admin', password='x')
+        UserProfile.objects.create(user=admin, role='admin')
+        client = APIClient()
+        client.force_authenticate(admin)
+        order = Order.objects.create(customer=self.customer, material_type='Coal', quantity=15)
+        dispatch = order.dispatches.get()
+
+        response = client.post(f'/api/dispatches/{dispatch.pk}/weigh_out/', {'tare_weight': 10})
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(response.data['status'], 'assigned')
+        self.assertEqual(client.post(f'/api/dispatches/{dispatch.pk}/start_journey/').status_code, 200)
+        response = client.post(f'/api/dispatches/{dispatch.pk}/weigh_in/', {})
+        self.assertEqual(response.data, {'error': 'Gross weight is required'})
+
+class StockLedgerTests(APITestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.admin = User.objects.create_user('stock_admin', password='x')
+        UserProfile.objects.create(user=cls.admin, role='admin')
+
+    def setUp(self):
+        self.client.force_authenticate(self.admin)
+        self.material = Material.objects.create(name='Gravel', stock_quantity=50)
+
+    def ledger_total(self):
+        return sum(self.material.movements.values_list('quantity', flat=True))
+
+    def test_consumption_is_clamped_and_ledger_adds_up(self):
+        stock.consume([('Gravel', 30, None), ('Gravel', 15, None)])
+        stock.consume([('Gravel', 20, None)])
+
+        self.material.refresh_from_db()
+        self.assertEqual(self.material.stock_quantity, 0)
+        self.assertEqual(self.ledger_total(), 0)
+        self.assertEqual(self.material.movements.filter(kind='consumption').count(), 3)
+        self.assertEqual(self.material.movements.get(kind='adjustment', quantity=15).note,
+                         'Stock ran out: 15 short of 20 consumed')
+
+    def test_receive_adjust_and_edit_go_through_ledger(self):
+        url = f'/api/materials/{self.material.pk}/'
+        self.assertEqual(self.client.post(f'{url}receive/', {'quantity': 25}).data['stock_quantity'], 75)
+        self.assertEqual(self.client.post(f'{url}adjust/', {'stock_quantity': 70}).data['stock_quantity'], 70)
+        self.assertEqual(self.client.patch(url, {'stock_quantity': 60, 'unit': 'm3'}).data['stock_quantity'], 60)
+
+        self.material.refresh_from_db()
+        self.assertEqual(self.material.unit, 'm3')
+        self.assertEqual(self.ledger_total(), 60)
+        kinds = list(self.material.movements.order_by('id').values_list('kind', flat=True))
+        self.assertEqual(kinds, ['adjustment', 'receipt', 'adjustment', 'adjustment'])
+
+    def test_point_in_time_stock_uses_checkpoints(self):
+        before = timezone.now()
+        stock.receive(self.material, 10)
+        stock.checkpoint()
+        middle = timezone.now()
+        stock.consume([('Gravel', 40, None)])
+
+        self.assertEqual(stock.stock_at(self.material, before), 50)
+        with self.assertNumQueries(2):
+            self.assertEqual(stock.stock_at(self.material, middle), 60)
+        response = self.client.get(f'/api/materials/{self.material.pk}/stock/')
+        self.assertEqual(response.data['stock_quantity'], 20)
+
+    def test_materials_from_before_the_ledger_get_an_opening_balance(self):
+        # bulk_create sends no post_save: no opening row, as before the ledger
+        old, = Material.objects.bulk_create([Material(name='Old Sand', stock_quantity=40)])
+        created = timezone.now()
+        stock.receive(old, 10)
+        self.assertEqual(stock.stock_at(old, timezone.now()), 10)
+
+        out = StringIO()
+        call_command('open_stock_ledgers', stdout=out)
+        self.assertIn('Opened the ledger of 1 materials', out.getvalue())
+        self.assertEqual(sum(old.movements.values_list('quantity', flat=True)), 50)
+        self.assertEqual(stock.stock_at(old, created), 40)
+        self.assertEqual(stock.stock_at(old, timezone.now()), 50)
+        # Gravel's ledger already added up; a second run has nothing to do
+        self.assertEqual(stock.open_ledgers(), [])
+
+
+class MediaProcessingTests(APITestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.operator = User.objects.create_user('media_operator', password='x')
+        UserProfile.objects.create(user=cls.operator, role='operator')
+        customer = Customer.objects.create(name='Acme', contact='123')
+        Truck.objects.create(number_plate='MEDIA-1', capacity=20, driver_name='D')
+        cls.dispatch = Order.objects.create(customer=customer, material_type='Coal', quantity=5).dispatches.get()
+        Dispatch.objects.filter(pk=cls.dispatch.pk).update(operator=cls.operator)
+
+    def setUp(self):
+        self.client.force_authenticate(self.operator)
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root)
+        overrides = override_settings(
+            MEDIA_ROOT=media_root, MEDIA_STAGING_ROOT=os.path.join(media_root, 'staging'), MEDIA_PROCESSING_WORKERS=0
+        )
+        overrides.enable()
+        self.addCleanup(overrides.disable)
+
+    def photo(self):
+        exif = Image.Exif()
+        exif[0x0112] = 6  # Orientation: rotate 90
+        exif[0x010F] = 'PhoneCam'  # Make
+        buffer = BytesIO()
+        Image.new('RGB', (40, 20), 'red').save(buffer, format='JPEG', exif=exif.tobytes())
+        return SimpleUploadedFile('slip.jpg', buffer.getvalue(), content_type='image/jpeg')
+
+    def upload(self, upload):
+        with self.captureOnCommitCallbacks(execute=False) as callbacks:
+            response = self.client.post(f'/api/dispatches/{self.dispatch.pk}/upload_images/',
+                                        {'images': [upload], 'media_type': 'weigh_in'})
+        return response, callbacks
+
+    def test_upload_is_acknowledged_before_processing(self):
+        response, callbacks = self.upload(self.photo())
+
+        self.assertEqual(response.status_code, 201)
+        acknowledged = response.data['images'][0]
+        self.assertEqual(acknowledged['processing_state'], 'pending')
+        self.assertIsNone(acknowledged['image_url'])
+        media = DispatchMedia.objects.get(pk=acknowledged['id'])
+        staged = media.staging_path
+        self.assertTrue(os.path.exists(staged))
+
+        for callback in callbacks:
+            callback()
+
+        response = self.client.get(f'/api/dispatch-media/{media.pk}/')
+        self.assertEqual(response.data['processing_state'], 'ready')
+        self.assertTrue(response.data['image_url'])
+        media.refresh_from_db()
+        self.assertFalse(os.path.exists(staged))
+        with Image.open(media.image.path) as processed:
+            self.assertEqual(processed.size, (20, 40))
+            self.assertFalse(processed.getexif())
+
+    def test_invalid_image_is_marked_failed(self):
+        response, callbacks = self.upload(SimpleUploadedFile('slip.jpg', b'not an image'))
+        for callback in callbacks:
+            callback()
+
+        media = DispatchMedia.objects.get(pk=response.data['images'][0]['id'])
+        self.assertEqual(media.processing_state, 'failed')
+        self.assertTrue(media.processing_error.startswith('Invalid image'))
+
+    def test_storage_errors_mark_the_upload_failed(self):
+        response, callbacks = self.upload(self.photo())
+        media = DispatchMedia.objects.get(pk=response.data['images'][0]['id'])
+        staged = media.staging_path
+        saved = []
+
+        def save(storage, name, content, **kwargs):
+            if saved:
+                raise OSError('No space left on device')
+            saved.append(original_save(storage, name, content, **kwargs))
+            return saved[-1]
+
+        original_save = FileSystemStorage.save
+        with mock.patch.object(FileSystemStorage, 'save', save), self.assertLogs('api.media', 'ERROR'):
+            for callback in callbacks:
+                callback()
+
+        media.refresh_from_db()
+        self.assertEqual(media.processing_state, 'failed')
+        self.assertEqual(media.processing_error, 'Could not store image: No space left on device')
+        self.assertFalse(os.path.exists(staged))
+        self.assertFalse(default_storage.exists(saved[0]))
+        self.assertFalse(MediaBlob.objects.exists())
+
+    def test_renditions_are_generated_and_selectable(self):
+        response, callbacks = self.upload(self.photo())
+        for callback in callbacks:
+            callback()
+        media = DispatchMedia.objects.get(pk=response.data['images'][0]['id'])
+
+        with Image.open(media.thumbnail.path) as thumbnail:
+            self.assertLessEqual(max(thumbnail.size), 240)
+        urls = self.client.get(f'/api/dispatch-media/{media.pk}/').data['image_urls']
+        self.assertEqual(set(urls), {'thumbnail', 'medium', 'original'})
+        self.assertEqual(urlsplit(urls['thumbnail']).path, media.thumbnail.url)
+
+        response = self.client.get(f'/api/dispatches/{self.dispatch.pk}/', {'variant': 'thumbnail'})
+        self.assertEqual(response.data['media_files'][0]['image_url'], urls['thumbnail'])
+        response = self.client.get('/api/dispatch-media/', {'variant': 'medium'})
+        self.assertEqual(response.data[0]['image_url'], urls['medium'])
+
+    def bearer(self, user):
+        return f'Bearer {RefreshToken.for_user(user).access_token}'
+
+    def processed_media(self):
+        response, callbacks = self.upload(self.photo())
+        for callback in callbacks:
+            callback()
+        return DispatchMedia.objects.get(pk=response.data['images'][0]['id'])
+
+    def test_identical_uploads_share_one_blob(self):
+        first = self.processed_media()
+        response, callbacks = self.upload(self.photo())
+        self.assertEqual(response.data['images'][0]['processing_state'], 'ready')
+        with mock.patch('api.media.enqueue') as enqueue:
+            for callback in callbacks:
+                callback()
+        enqueue.assert_not_called()
+        second = DispatchMedia.objects.get(pk=response.data['images'][0]['id'])
+
+        blob = first.blob
+        self.assertEqual(second.blob, blob)
+        self.assertEqual(second.image.name, first.image.name)
+        blob.refresh_from_db()
+        self.assertEqual(blob.ref_count, 2)
+        self.assertEqual(len(os.listdir(os.path.dirname(blob.image.path))), 3)
+
+        first.delete()
+        blob.refresh_from_db()
+        self.assertEqual(blob.ref_count, 1)
+        self.assertTrue(os.path.exists(blob.image.path))
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.dispatch.delete()
+        self.assertFalse(MediaBlob.objects.exists())
+        self.assertFalse(os.path.exists(blob.image.path))
+        self.assertFalse(os.path.exists(blob.thumbnail.path))
+
+    def test_blob_acquired_while_released_is_kept(self):
+        first = self.processed_media()
+        blob = first.blob
+
+        def acquire_before_delete(execute, sql, params, many, context):
+            if sql.startswith('DELETE FROM "api_mediablob"'):
+                acquired.append(acquire_blob(blob.digest))
+            return execute(sql, params, many, context)
+
+        acquired = []
+        with connection.execute_wrapper(acquire_before_delete), self.captureOnCommitCallbacks(execute=True):
+            first.delete()
+
+        self.assertEqual(acquired, [blob])
+        blob.refresh_from_db()
+        self.assertEqual(blob.ref_count, 1)
+        self.assertTrue(os.path.exists(blob.image.path))
+
+    def test_signed_url_serves_file_with_validators(self):
+        media = self.processed_media()
+        self.client.force_authenticate(None)
+        url = signed_media_url(media.image.name)
+
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'image/jpeg')
+        self.assertEqual(response['Accept-Ranges'], 'bytes')
+        self.assertIn('immutable', response['Cache-Control'])
+        with media.image.open('rb') as original:
+            content = original.read()
+        self.assertEqual(b''.join(response.streaming_content), content)
+
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.status_code, 304)
+
+        response = self.client.get(url, HTTP_RANGE='bytes=10-19')
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response['Content-Range'], f'bytes 10-19/{len(content)}')
+        self.assertEqual(b''.join(response.streaming_content), content[10:20])
+
+        response = self.client.get(url, HTTP_RANGE=f'bytes={len(content)}-')
+        self.assertEqual(response.status_code, 416)
+
+        response = self.client.get(url, HTTP_RANGE='bytes=5-3')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(b''.join(response.streaming_content), content)
+
+    def test_unsigned_request_checks_dispatch_permission(self):
+        media = self.processed_media()
+        url = media.thumbnail.url
+        self.client.force_authenticate(None)
+
+        self.assertEqual(self.client.get(url).status_code, 401)
+        self.assertEqual(self.client.get(f'{url}?expires=9999999999&signature=forged').status_code, 401)
+        self.assertEqual(self.client.get(url, HTTP_AUTHORIZATION=self.bearer(self.operator)).status_code, 200)
+
+        other = User.objects.create_user('other_operator', password='x')
+        UserProfile.objects.create(user=other, role='operator')
+        self.assertEqual(self.client.get(url, HTTP_AUTHORIZATION=self.bearer(other)).status_code, 404)
+
+    def test_proxy_offload(self):
+        media = self.processed_media()
+        with override_settings(MEDIA_X_ACCEL_REDIRECT='/protected-media/'):
+            response = self.client.get(media.image.url, HTTP_AUTHORIZATION=self.bearer(self.operator))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['X-Accel-Redirect'], f'/protected-media/{media.image.name}')
+        self.assertEqual(response.content, b'')
+
+
+class QueryInstrumentationTests(APITestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.admin = User.objects.create_user('instrumented_admin', password='x')
+        UserProfile.objects.create(user=cls.admin, role='admin')
+        Material.objects.create(name='Coal', stock_quantity=100)
+        customer = Customer.objects.create(name='Acme', contact='123')
+        for i in range(4):
+            Truck.objects.create(number_plate=f'INST-{i}', capacity=20, driver_name='D')
+            Order.objects.create(customer=customer, material_type='Coal', quantity=5)
+        for dispatch in Dispatch.objects.all():
+            ExceptionLog.objects.create(dispatch=dispatch, description='Late')
+
+    def setUp(self):
+        self.client.force_authenticate(self.admin)
+
+    def test_server_timing_and_log_line(self):
+        with self.assertLogs('backend.requests', 'INFO') as logs, CaptureQueriesContext(connection) as ctx:
+            response = self.client.get('/api/exceptions/')
+        self.assertEqual(response.status_code, 200)
+        self.assertRegex(response['Server-Timing'],
+                         rf'^db;dur=[\d.]+;desc="{len(ctx.captured_queries)} queries", total;dur=[\d.]+$')
+
+        line = json.loads(logs.records[0].getMessage())
+        self.assertEqual(logs.records[0].levelname, 'INFO')
+        self.assertEqual((line['view'], line['status'], line['queries']),
+                         ('exceptionlog-list', 200, len(ctx.captured_queries)))
+        self.assertNotIn('repeated', line)
+
+    def test_n_plus_one_fails_the_budget(self):
+        # A serializer field the list can neither project nor join: every row
+        # loads its dispatch, truck and order on its own
+        with mock.patch.object(views.Projection, 'of', return_value=None), \
+                mock.patch.object(views.ExceptionLogViewSet, 'get_queryset', lambda self: ExceptionLog.objects.all()), \
+                self.assertLogs('backend.requests', 'WARNING') as logs:
+            with self.assertRaisesMessage(QueryBudgetExceeded, 'repeated per row (N+1)'):
+                self.client.get('/api/exceptions/')
+
+        line = json.loads(logs.records[0].getMessage())
+        self.assertIn('api_dispatch', line['repeated'][0]['sql'])
+        self.assertEqual(line['repeated'][0]['times'], 4)
+
+    def test_query_count_budget(self):
+        exception = ExceptionLog.objects.first()
+        with override_settings(REQUEST_QUERY_BUDGETS={'exceptionlog-list': 1, 'exceptionlog-detail': 1}):
+            with self.assertRaisesMessage(QueryBudgetExceeded, 'budget 1'):
+                self.client.get('/api/exceptions/')
+            # Only reads are budgeted
+            response = self.client.patch(f'/api/exceptions/{exception.pk}/', {'description': 'Very late'})
+        self.assertEqual(response.status_code, 200)
+
+    def test_async_requests_are_measured(self):
+        response = async_to_sync(AsyncClient(SERVER_NAME=settings.ALLOWED_HOSTS[0]).get)(
+            '/api/exceptions/', headers={'Authorization': f'Bearer {issue_tokens(self.admin).access_token}'}
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertRegex(response['Server-Timing'], r'^db;dur=[\d.]+;desc="[1-9]\d* queries"')
@@ -23,10 +23,17 @@ urlpatterns = [
     
     # KPI Dashboard
     path('dashboard/kpi/', views.kpi_dashboard, name='kpi_dashboard'),
+    path('dashboard/cache-stats/', views.cache_stats, name='cache_stats'),
     
     # Operators
     path('operators/', views.get_operators, name='get_operators'),
     
+    # Real-time change events (Server-Sent Events)
+    path('events/', views.event_stream, name='event_stream'),
+    
+    # Delta sync for offline clients
+    path('sync/', views.sync, name='sync'),
+    
     # Include router URLs
     path('', include(router.urls)),
 ]
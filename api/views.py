@@ -1,20 +1,45 @@
 from rest_framework import status, generics, viewsets, permissions
 from rest_framework.decorators import api_view, permission_classes, action
 from rest_framework.permissions import AllowAny, IsAuthenticated
+from rest_framework.parsers import JSONParser, MultiPartParser
+from rest_framework.exceptions import AuthenticationFailed
 from rest_framework.response import Response
-from rest_framework_simplejwt.tokens import RefreshToken
+from asgiref.sync import sync_to_async
 from django.contrib.auth import authenticate
 from django.contrib.auth.models import User
-from django.db.models import Q, Count, Avg
+from django.core.exceptions import ValidationError
+from django.db.models import Q, Count, Avg, Max
 from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+from django.conf import settings
+from django.core.handlers.asgi import ASGIRequest
+from django.http import Http404, HttpResponse, StreamingHttpResponse
+from django.views.decorators.http import require_safe
 from datetime import datetime, timedelta
-from .models import UserProfile, Truck, Customer, Order, Dispatch, Material, ExceptionLog, DispatchMedia
+from .models import (
+    UserProfile, Truck, Customer, Order, Dispatch, Material, ExceptionLog, DispatchMedia,
+    KPISnapshot, DailyOrderKPI, MODEL_SCOPES
+)
 from rest_framework import serializers
 from .serializers import (
     UserSerializer, UserRegistrationSerializer, TruckSerializer, CustomerSerializer,
     OrderSerializer, MaterialSerializer, DispatchSerializer, ExceptionLogSerializer,
-    KPIDashboardSerializer, OperatorSerializer, WorkflowStepSerializer, DispatchMediaSerializer
+    KPIDashboardSerializer, OperatorSerializer, WorkflowStepSerializer, DispatchMediaSerializer,
+    StockMovementSerializer, StockReceiptSerializer, StockCountSerializer, Projection, shape_queryset,
+    serializer_models
 )
+from .pagination import AdminTablePagination, CreatedAtCursorPagination, keyset_after
+from .authentication import ClaimsJWTAuthentication, RevocableRefreshToken, issue_tokens, user_role
+from .cache import CachedListMixin, cached_response, conditional, make_etag, response_cache, CACHE_SCOPES
+from .parsers import CSVParser, read_csv_rows
+from .renderers import CSVRenderer, NDJSONRenderer, json_array_chunks, streaming_content
+from .export import export_response
+from .events import Subscription, event_bus
+from .sync import read_token, sync_changes
+from .allocation import create_orders
+from . import stock
+from .media import check_media_signature, media_response, stage_upload
+from .workflow import ALLOWED_SOURCES, TransitionConflict, TransitionError, bulk_transition, transition
 
 
 class UserRegistrationView(generics.CreateAPIView):
@@ -42,8 +67,8 @@ class UserRegistrationView(generics.CreateAPIView):
             role=user_data.get('role', 'operator')
         )
         
-        # Generate tokens
-        refresh = RefreshToken.for_user(user)
+        # Generate tokens, with the role as a claim
+        refresh = issue_tokens(user)
         access_token = refresh.access_token
         
         return Response({
@@ -70,7 +95,7 @@ def login_view(request):
     user = authenticate(username=username, password=password)
     
     if user:
-        refresh = RefreshToken.for_user(user)
+        refresh = issue_tokens(user)
         access_token = refresh.access_token
         
         return Response({
@@ -90,7 +115,8 @@ def login_view(request):
 @api_view(['GET'])
 @permission_classes([IsAuthenticated])
 def user_profile(request):
-    serializer = UserSerializer(request.user)
+    # request.user only holds the token's claims
+    serializer = UserSerializer(User.objects.select_related('userprofile').get(pk=request.user.pk))
     return Response(serializer.data, status=status.HTTP_200_OK)
 
 @api_view(['POST'])
@@ -99,36 +125,145 @@ def logout_view(request):
     try:
         refresh_token = request.data.get('refresh_token')
         if refresh_token:
-            token = RefreshToken(refresh_token)
+            token = RevocableRefreshToken(refresh_token)
             token.blacklist()
         return Response({'message': 'Logout successful'}, status=status.HTTP_200_OK)
     except Exception as e:
         return Response({'error': 'Invalid token'}, status=status.HTTP_400_BAD_REQUEST)
 
-# Custom Permissions
+# Custom Permissions. The role comes with request.user, from the token's
+# claims (api/authentication.py), so checking it costs no query.
 class IsAdminOrReadOnly(permissions.BasePermission):
     def has_permission(self, request, view):
         if request.method in permissions.SAFE_METHODS:
             return request.user.is_authenticated
-        return request.user.is_authenticated and hasattr(request.user, 'userprofile') and request.user.userprofile.role == 'admin'
+        return request.user.is_authenticated and user_role(request.user) == 'admin'
 
 class IsAdminUser(permissions.BasePermission):
     def has_permission(self, request, view):
-        return request.user.is_authenticated and hasattr(request.user, 'userprofile') and request.user.userprofile.role == 'admin'
+        return request.user.is_authenticated and user_role(request.user) == 'admin'
 
 class IsOperatorOrAdmin(permissions.BasePermission):
     def has_permission(self, request, view):
-        if not request.user.is_authenticated:
-            return False
-        if hasattr(request.user, 'userprofile'):
-            return request.user.userprofile.role in ['admin', 'operator']
-        return False
+        return request.user.is_authenticated and user_role(request.user) in ['admin', 'operator']
+
+class ConditionalGetMixin:
+    """Answer ``list``/``retrieve`` with ``304 Not Modified`` when the client's copy is current.
+
+    The validators are worked out before anything is serialized: one
+    ``Count``/``Max('updated_at')`` query over the filtered queryset, plus the
+    scope versions (api/cache.py) of every model the serializer renders, so a
+    renamed customer changes the ETag of the orders showing the name.
+    """
+    def list(self, request, *args, **kwargs):
+        queryset = self.filter_queryset(self.get_queryset())
+        return self.conditional(queryset, lambda: super(ConditionalGetMixin, self).list(request, *args, **kwargs))
+
+    def retrieve(self, request, *args, **kwargs):
+        lookup = kwargs[self.lookup_url_kwarg or self.lookup_field]
+        queryset = self.filter_queryset(self.get_queryset()).filter(**{self.lookup_field: lookup})
+        return self.conditional(queryset, lambda: super(ConditionalGetMixin, self).retrieve(request, *args, **kwargs))
+
+    def conditional(self, queryset, respond):
+        model = queryset.model
+        aggregates = {'count': Count('pk')}
+        if any(field.name == 'updated_at' for field in model._meta.concrete_fields):
+            aggregates['latest'] = Max('updated_at')
+        summary = queryset.order_by().aggregate(**aggregates)
+        latest = summary.get('latest')
+
+        scopes = sorted({MODEL_SCOPES[related] for related in serializer_models(self.get_serializer())})
+        versions, changed = response_cache.state(scopes)
+        etag = make_etag(
+            summary['count'], latest and latest.isoformat(), versions,
+            self.request.get_full_path(), self.request.user.pk, self.request.accepted_media_type
+        )
+        last_modified = max(changed, latest.timestamp() if latest else 0)
+        return conditional(self.request, etag, last_modified, respond)
+
+class ShapedQuerysetMixin:
+    """Fetch what the serializer will render for this request (``?fields=``/``?expand=``).
+
+    Relations are always joined or prefetched; reads also skip unused columns.
+    Lists are rendered from ``values()`` rows by a ``Projection`` of the
+    serializer, with the same output, whenever every field allows it.
+    ``?stream=true`` returns the whole list, unpaginated, as a streamed array.
+    """
+    def ordering_columns(self):
+        ordering = getattr(self.paginator, 'ordering', None) or ()
+        if isinstance(ordering, str):
+            ordering = (ordering,)
+        return [field.lstrip('-') for field in ordering]
+
+    def filter_queryset(self, queryset):
+        # Lists come in the same order paginated or not
+        return super().filter_queryset(queryset).order_by(*self.list_ordering())
+
+    def shape(self, queryset):
+        return shape_queryset(
+            queryset, self.get_serializer(), extra_columns=self.ordering_columns(),
+            restrict=self.request.method in permissions.SAFE_METHODS
+        )
+
+    def list(self, request, *args, **kwargs):
+        if request.query_params.get('stream') in ('1', 'true'):
+            return self.stream(self.filter_queryset(self.get_queryset()))
+        projection = Projection.of(self.get_serializer())
+        if projection is None:
+            return super().list(request, *args, **kwargs)
+        queryset = projection.values(self.filter_queryset(self.get_queryset()), self.ordering_columns())
+        page = self.paginate_queryset(queryset)
+        if page is not None:
+            return self.get_paginated_response(projection.render(page))
+        return Response(projection.render(queryset))
+
+    def stream(self, queryset):
+        """The whole list as one JSON array, read and encoded a chunk at a time (``?stream=true``).
+
+        Each chunk is its own query, continuing after the ordering keys of the
+        last row sent (as the exports do): ``iterator()`` would have MySQL's
+        driver buffer the whole result.
+        """
+        chunk_size = settings.API_STREAM_CHUNK_SIZE
+        ordering = self.list_ordering()
+        projection = Projection.of(self.get_serializer())
+        if projection is not None:
+            rows = projection.values(queryset, [field.lstrip('-') for field in ordering])
+            chunks = (projection.render(chunk) for chunk in _keyset_chunks(rows, ordering, chunk_size, dict.get))
+        else:
+            chunks = (
+                self.get_serializer(chunk, many=True).data
+                for chunk in _keyset_chunks(queryset, ordering, chunk_size, getattr)
+            )
+        return StreamingHttpResponse(streaming_content(self.request, json_array_chunks(chunks)),
+                                     content_type='application/json')
+
+    def list_ordering(self):
+        """The paginator's ordering, ending with the primary key so that it is unique."""
+        ordering = getattr(self.paginator, 'ordering', None) or ()
+        ordering = (ordering,) if isinstance(ordering, str) else tuple(ordering)
+        if not ordering or ordering[-1].lstrip('-') not in ('id', 'pk'):
+            ordering += ('-id' if ordering and ordering[-1].startswith('-') else 'id',)
+        return ordering
+
+def _keyset_chunks(queryset, ordering, size, key):
+    """``queryset``, ordered by the non-null fields of ``ordering``, in lists of
+    ``size`` rows; ``key(row, field)`` reads the ordering fields of a row."""
+    chunk = list(queryset[:size])
+    while chunk:
+        yield chunk
+        if len(chunk) < size:
+            return
+        after = keyset_after(ordering, [key(chunk[-1], field.lstrip('-')) for field in ordering])
+        chunk = list(queryset.filter(after)[:size])
 
 # ViewSets
-class TruckViewSet(viewsets.ModelViewSet):
+class TruckViewSet(ConditionalGetMixin, CachedListMixin, viewsets.ModelViewSet):
     queryset = Truck.objects.all()
     serializer_class = TruckSerializer
     permission_classes = [IsAuthenticated, IsAdminOrReadOnly]
+    pagination_class = AdminTablePagination
+    cache_scope = 'trucks'
 
     def get_queryset(self):
         queryset = Truck.objects.all()
@@ -137,10 +272,11 @@ class TruckViewSet(viewsets.ModelViewSet):
             queryset = queryset.filter(status=status_filter)
         return queryset
 
-class CustomerViewSet(viewsets.ModelViewSet):
+class CustomerViewSet(ConditionalGetMixin, viewsets.ModelViewSet):
     queryset = Customer.objects.all()
     serializer_class = CustomerSerializer
     permission_classes = [IsAuthenticated, IsAdminOrReadOnly]
+    pagination_class = AdminTablePagination
 
     def get_queryset(self):
         queryset = Customer.objects.all()
@@ -151,13 +287,14 @@ class CustomerViewSet(viewsets.ModelViewSet):
             )
         return queryset
 
-class OrderViewSet(viewsets.ModelViewSet):
+class OrderViewSet(ConditionalGetMixin, ShapedQuerysetMixin, viewsets.ModelViewSet):
     queryset = Order.objects.select_related('customer').all()
     serializer_class = OrderSerializer
     permission_classes = [IsAuthenticated, IsAdminOrReadOnly]
+    pagination_class = CreatedAtCursorPagination
 
     def get_queryset(self):
-        queryset = Order.objects.select_related('customer').all()
+        queryset = self.shape(Order.objects.all())
         status_filter = self.request.query_params.get('status', None)
         customer_filter = self.request.query_params.get('customer', None)
         if status_filter:
@@ -166,10 +303,69 @@ class OrderViewSet(viewsets.ModelViewSet):
             queryset = queryset.filter(customer_id=customer_filter)
         return queryset
 
-class MaterialViewSet(viewsets.ModelViewSet):
+    @action(detail=False, methods=['get'], renderer_classes=[CSVRenderer, NDJSONRenderer])
+    def export(self, request):
+        """Stream every order matching the list filters as CSV or NDJSON (``?format=ndjson``)."""
+        return export_response(request, self.filter_queryset(self.get_queryset()), request.accepted_renderer.format,
+                               'orders')
+
+    # Largest order sheet accepted by the bulk endpoint
+    max_bulk_rows = 1000
+
+    @action(detail=False, methods=['post'], url_path='bulk',
+            parser_classes=[JSONParser, CSVParser, MultiPartParser])
+    def bulk(self, request):
+        """Create orders from a JSON array, a text/csv body or an uploaded CSV ``file``.
+
+        Rows are validated together and either all inserted or none are; trucks
+        are then assigned to the whole batch in one pass.
+        """
+        if 'file' in request.FILES:
+            rows = read_csv_rows(request.FILES['file'])
+        else:
+            rows = request.data
+        
+        if not isinstance(rows, list) or not rows:
+            return Response({'error': 'Expected a non-empty list of orders or a CSV file'},
+                          status=status.HTTP_400_BAD_REQUEST)
+        if len(rows) > self.max_bulk_rows:
+            return Response({'error': f'At most {self.max_bulk_rows} orders per request'},
+                          status=status.HTTP_400_BAD_REQUEST)
+        
+        serializer = OrderSerializer.for_bulk(rows, context=self.get_serializer_context())
+        if not serializer.is_valid():
+            errors = serializer.errors
+            if isinstance(errors, dict):
+                # DRF reports only the invalid rows, by index
+                errors = [errors.get(index, {}) for index in range(len(rows))]
+            return Response({
+                'created': 0,
+                'results': [
+                    {'row': number, 'status': 'invalid', 'errors': row_errors} if row_errors
+                    else {'row': number, 'status': 'valid'}
+                    for number, row_errors in enumerate(errors, start=1)
+                ]
+            }, status=status.HTTP_400_BAD_REQUEST)
+        
+        orders, dispatches = create_orders(serializer.validated_data)
+        results = []
+        for number, (order, data) in enumerate(zip(orders, self.get_serializer(orders, many=True).data), start=1):
+            dispatch = dispatches.get(order.pk)
+            results.append({
+                'row': number,
+                'status': 'created',
+                'order': data,
+                'dispatch': dispatch.pk if dispatch else None,
+                'truck': dispatch.truck_id if dispatch else None,
+            })
+        return Response({'created': len(orders), 'results': results}, status=status.HTTP_201_CREATED)
+
+class MaterialViewSet(ConditionalGetMixin, CachedListMixin, viewsets.ModelViewSet):
     queryset = Material.objects.all()
     serializer_class = MaterialSerializer
     permission_classes = [IsAuthenticated, IsAdminOrReadOnly]
+    pagination_class = AdminTablePagination
+    cache_scope = 'materials'
 
     def get_queryset(self):
         queryset = Material.objects.all()
@@ -178,16 +374,72 @@ class MaterialViewSet(viewsets.ModelViewSet):
             queryset = queryset.filter(stock_quantity__lt=10)  # Assuming 10 is low stock threshold
         return queryset
 
-class DispatchViewSet(viewsets.ModelViewSet):
+    def perform_update(self, serializer):
+        # Stock is corrected through the ledger rather than overwritten
+        stock_quantity = serializer.validated_data.pop('stock_quantity', None)
+        material = serializer.save()
+        if stock_quantity is not None:
+            stock.set_stock(material, stock_quantity, user=self.request.user, note='Edited')
+
+    @action(detail=True, methods=['post'])
+    def receive(self, request, pk=None):
+        """Add a delivery to stock."""
+        material = self.get_object()
+        serializer = StockReceiptSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        stock.receive(material, serializer.validated_data['quantity'], user=request.user,
+                      note=serializer.validated_data['note'])
+        return Response(self.get_serializer(material).data)
+
+    @action(detail=True, methods=['post'])
+    def adjust(self, request, pk=None):
+        """Correct stock to a counted quantity."""
+        material = self.get_object()
+        serializer = StockCountSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        stock.set_stock(material, serializer.validated_data['stock_quantity'], user=request.user,
+                        note=serializer.validated_data['note'])
+        return Response(self.get_serializer(material).data)
+
+    @action(detail=True, methods=['get'])
+    def movements(self, request, pk=None):
+        """Stock ledger of the material, newest first."""
+        material = self.get_object()
+        queryset = material.movements.select_related('created_by').order_by('-id')
+        page = self.paginate_queryset(queryset)
+        if page is None:
+            return Response(StockMovementSerializer(queryset, many=True).data)
+        return self.get_paginated_response(StockMovementSerializer(page, many=True).data)
+
+    @action(detail=True, methods=['get'], url_path='stock')
+    def stock_level(self, request, pk=None):
+        """Stock at ``?at=<ISO datetime>`` (default: now)."""
+        material = self.get_object()
+        at = timezone.now()
+        if request.query_params.get('at'):
+            at = parse_datetime(request.query_params['at'])
+            if at is None:
+                return Response({'error': 'at must be an ISO 8601 datetime'}, status=status.HTTP_400_BAD_REQUEST)
+            if timezone.is_naive(at):
+                at = timezone.make_aware(at)
+        return Response({
+            'material': material.name,
+            'at': at,
+            'stock_quantity': stock.stock_at(material, at),
+            'unit': material.unit,
+        })
+
+class DispatchViewSet(ConditionalGetMixin, ShapedQuerysetMixin, viewsets.ModelViewSet):
     queryset = Dispatch.objects.select_related('truck', 'order', 'operator').prefetch_related('media_files').all()
     serializer_class = DispatchSerializer
     permission_classes = [IsAuthenticated, IsOperatorOrAdmin]
+    pagination_class = CreatedAtCursorPagination
 
     def get_queryset(self):
-        queryset = Dispatch.objects.select_related('truck', 'order', 'operator').prefetch_related('media_files').all()
+        queryset = self.shape(Dispatch.objects.all())
         
         # Filter by operator if user is operator
-        if hasattr(self.request.user, 'userprofile') and self.request.user.userprofile.role == 'operator':
+        if user_role(self.request.user) == 'operator':
             queryset = queryset.filter(operator=self.request.user)
         
         status_filter = self.request.query_params.get('status', None)
@@ -200,36 +452,82 @@ class DispatchViewSet(viewsets.ModelViewSet):
             
         return queryset
 
+    @action(detail=False, methods=['get'], renderer_classes=[CSVRenderer, NDJSONRenderer])
+    def export(self, request):
+        """Stream every dispatch matching the list filters, with weights and net weight, as CSV or NDJSON."""
+        return export_response(request, self.filter_queryset(self.get_queryset()), request.accepted_renderer.format,
+                               'dispatches')
+
+    def _transition(self, request, new_status, media_type=None):
+        """Apply a ``Dispatch.TRANSITIONS`` transition with the fields it requires.
+
+        Responds 409 if the dispatch is not in a status the transition starts
+        from, including when a concurrent request moved it first.
+        """
+        dispatch = self.get_object()
+        fields = {}
+        for field_name in Dispatch.TRANSITIONS[new_status]['requires']:
+            field = Dispatch._meta.get_field(field_name)
+            value = request.data.get(field_name)
+            if not value:
+                return Response({'error': f'{field.verbose_name.capitalize()} is required'},
+                                status=status.HTTP_400_BAD_REQUEST)
+            try:
+                fields[field_name] = field.to_python(value)
+            except ValidationError:
+                return Response({'error': f'{field.verbose_name.capitalize()} must be a number'},
+                                status=status.HTTP_400_BAD_REQUEST)
+
+        try:
+            transition(dispatch, new_status, **fields)
+        except TransitionConflict as exc:
+            return Response({'error': str(exc), 'status': exc.current_status}, status=status.HTTP_409_CONFLICT)
+
+        # Images are staged and processed in the background (api/media.py)
+        if media_type and 'images' in request.FILES:
+            for image in request.FILES.getlist('images'):
+                stage_upload(
+                    image,
+                    dispatch=dispatch,
+                    media_type=media_type,
+                    uploaded_by=request.user,
+                    description=request.data.get('description', '')
+                )
+        
+        serializer = self.get_serializer(dispatch, context={'request': request})
+        return Response(serializer.data)
+
     @action(detail=True, methods=['post'])
     def update_status(self, request, pk=None):
-        dispatch = self.get_object()
         new_status = request.data.get('status')
-        
-        if new_status not in ['assigned', 'in_transit', 'weigh_in', 'unload', 'weigh_out', 'completed', 'cancelled']:
+        if new_status not in Dispatch.TRANSITIONS:
             return Response({'error': 'Invalid status'}, status=status.HTTP_400_BAD_REQUEST)
-        
-        dispatch.status = new_status
-        
-        if new_status == 'in_transit' and not dispatch.departure_time:
-            # This logic is better handled by signals or the specific action methods.
-            # For example, start_journey action sets start_journey_time.
-            # Departure time should be set when the journey actually starts.
-            dispatch.departure_time = timezone.now()
-        elif new_status == 'completed' and not dispatch.arrival_time:
-            dispatch.arrival_time = timezone.now()
-            
-        dispatch.save()
-        
-        # Update related order status
-        if new_status == 'completed':
-            dispatch.order.status = 'completed'
-            dispatch.order.save()
-        elif new_status == 'in_transit':
-            dispatch.order.status = 'in_progress'
-            dispatch.order.save()
-        
-        serializer = self.get_serializer(dispatch)
-        return Response(serializer.data)
+        return self._transition(request, new_status)
+
+    @action(detail=False, methods=['post'], permission_classes=[IsAuthenticated, IsAdminUser])
+    def bulk_status(self, request):
+        """Move a list of dispatches to one status, all or nothing.
+
+        Body: ``{"ids": [...], "status": "cancelled"}``. Responds 400 with the
+        offending ids if any dispatch cannot make the transition.
+        """
+        ids = request.data.get('ids')
+        new_status = request.data.get('status')
+        # bool is an int too: true would stand for dispatch 1
+        if not isinstance(ids, list) or not ids or not all(
+                isinstance(pk, int) and not isinstance(pk, bool) for pk in ids):
+            return Response({'error': 'ids must be a non-empty list of dispatch ids'},
+                            status=status.HTTP_400_BAD_REQUEST)
+        if new_status not in ALLOWED_SOURCES:
+            return Response({'error': f'Bulk transitions allowed to: {", ".join(ALLOWED_SOURCES)}'},
+                            status=status.HTTP_400_BAD_REQUEST)
+
+        try:
+            updated = bulk_transition(ids, new_status)
+        except TransitionError as exc:
+            return Response({'error': 'Some dispatches cannot make this transition', 'errors': exc.errors},
+                            status=status.HTTP_400_BAD_REQUEST)
+        return Response({'updated': updated, 'status': new_status})
 
     @action(detail=True, methods=['post'])
     def assign_operator(self, request, pk=None):
@@ -255,136 +553,39 @@ class DispatchViewSet(viewsets.ModelViewSet):
     @action(detail=True, methods=['post'])
     def start_journey(self, request, pk=None):
         """Start Journey → mark dispatch as "In Transit"."""
-        dispatch = self.get_object()
-        
-        if dispatch.status != 'assigned':
-            return Response({'error': 'Dispatch must be assigned to start journey'}, 
-                          status=status.HTTP_400_BAD_REQUEST)
-        
-        dispatch.status = 'in_transit'
-        dispatch.start_journey_time = timezone.now()
-        dispatch.save()
-        
-        serializer = self.get_serializer(dispatch)
-        return Response(serializer.data)
+        return self._transition(request, 'in_transit')
 
     @action(detail=True, methods=['post'])
     def weigh_in(self, request, pk=None):
         """Weigh-in → operator captures gross weight (optionally uploads slip/photo)."""
-        dispatch = self.get_object()
-        
-        if dispatch.status != 'in_transit':
-            return Response({'error': 'Dispatch must be in transit to weigh in'}, 
-                          status=status.HTTP_400_BAD_REQUEST)
-        
-        gross_weight = request.data.get('gross_weight')
-        
-        if not gross_weight:
-            return Response({'error': 'Gross weight is required'}, 
-                           status=status.HTTP_400_BAD_REQUEST)
-        
-        dispatch.status = 'weigh_in'
-        dispatch.weigh_in_time = timezone.now()
-        dispatch.gross_weight = float(gross_weight)
-        dispatch.save()
-        
-        # Handle image uploads
-        if 'images' in request.FILES:
-            for image in request.FILES.getlist('images'):
-                DispatchMedia.objects.create(
-                    dispatch=dispatch,
-                    media_type='weigh_in',
-                    image=image,
-                    uploaded_by=request.user,
-                    description=request.data.get('description', '')
-                )
-        
-        serializer = self.get_serializer(dispatch, context={'request': request})
-        return Response(serializer.data)
+        return self._transition(request, 'weigh_in', media_type='weigh_in')
 
     @action(detail=True, methods=['post'])
     def unload(self, request, pk=None):
         """Unload → operator confirms unloading (with media capture if needed)."""
-        dispatch = self.get_object()
-        
-        if dispatch.status != 'weigh_in':
-            return Response({'error': 'Dispatch must be weighed in to unload'}, 
-                          status=status.HTTP_400_BAD_REQUEST)
-        
-        dispatch.status = 'unload'
-        dispatch.unload_time = timezone.now()
-        dispatch.save()
-        
-        # Handle image uploads
-        if 'images' in request.FILES:
-            for image in request.FILES.getlist('images'):
-                DispatchMedia.objects.create(
-                    dispatch=dispatch,
-                    media_type='unload',
-                    image=image,
-                    uploaded_by=request.user,
-                    description=request.data.get('description', '')
-                )
-        
-        serializer = self.get_serializer(dispatch, context={'request': request})
-        return Response(serializer.data)
+        return self._transition(request, 'unload', media_type='unload')
 
     @action(detail=True, methods=['post'])
     def weigh_out(self, request, pk=None):
         """Weigh-out → operator records tare weight."""
-        dispatch = self.get_object()
-        
-        if dispatch.status != 'unload':
-            return Response({'error': 'Dispatch must be unloaded to weigh out'}, 
-                          status=status.HTTP_400_BAD_REQUEST)
-        
-        tare_weight = request.data.get('tare_weight')
-        
-        if not tare_weight:
-            return Response({'error': 'Tare weight is required'}, 
-                          status=status.HTTP_400_BAD_REQUEST)
-        
-        dispatch.status = 'weigh_out'
-        dispatch.weigh_out_time = timezone.now()
-        dispatch.tare_weight = float(tare_weight)
-        dispatch.save()
-        
-        # Handle image uploads
-        if 'images' in request.FILES:
-            for image in request.FILES.getlist('images'):
-                DispatchMedia.objects.create(
-                    dispatch=dispatch,
-                    media_type='weigh_out',
-                    image=image,
-                    uploaded_by=request.user,
-                    description=request.data.get('description', '')
-                )
-        
-        serializer = self.get_serializer(dispatch, context={'request': request})
-        return Response(serializer.data)
+        return self._transition(request, 'weigh_out', media_type='weigh_out')
 
     @action(detail=True, methods=['post'])
     def complete_job(self, request, pk=None):
-        """Complete Job → system marks dispatch as "Completed"."""
-        dispatch = self.get_object()
-        
-        if dispatch.status != 'weigh_out':
-            return Response({'error': 'Dispatch must be weighed out to complete'}, 
-                          status=status.HTTP_400_BAD_REQUEST)
-        
-        dispatch.status = 'completed'
-        dispatch.completion_time = timezone.now()
-        dispatch.arrival_time = timezone.now()
-        dispatch.save()
-        # The post_save signal on the Dispatch model will automatically handle
-        # updating the order status, material stock, and truck status.
-        
-        serializer = self.get_serializer(dispatch, context={'request': request})
-        return Response(serializer.data)
+        """Complete Job → system marks dispatch as "Completed".
+
+        The workflow service completes the order, takes the material out of
+        stock and returns the truck to idle in the same transaction.
+        """
+        return self._transition(request, 'completed')
 
     @action(detail=True, methods=['post'])
     def upload_images(self, request, pk=None):
-        """Upload images for a dispatch"""
+        """Upload images for a dispatch.
+
+        Images are acknowledged as soon as they are staged; poll each one's
+        ``processing_state`` until it is ``ready`` (or ``failed``).
+        """
         dispatch = self.get_object()
         media_type = request.data.get('media_type', 'other')
         description = request.data.get('description', '')
@@ -394,10 +595,10 @@ class DispatchViewSet(viewsets.ModelViewSet):
         
         uploaded_images = []
         for image in request.FILES.getlist('images'):
-            media_obj = DispatchMedia.objects.create(
+            media_obj = stage_upload(
+                image,
                 dispatch=dispatch,
                 media_type=media_type,
-                image=image,
                 uploaded_by=request.user,
                 description=description
             )
@@ -409,13 +610,14 @@ class DispatchViewSet(viewsets.ModelViewSet):
             'images': uploaded_images
         }, status=status.HTTP_201_CREATED)
 
-class DispatchMediaViewSet(viewsets.ModelViewSet):
+class DispatchMediaViewSet(ConditionalGetMixin, ShapedQuerysetMixin, viewsets.ModelViewSet):
     queryset = DispatchMedia.objects.select_related('dispatch', 'uploaded_by').all()
     serializer_class = DispatchMediaSerializer
     permission_classes = [IsAuthenticated, IsOperatorOrAdmin]
+    pagination_class = CreatedAtCursorPagination
 
     def get_queryset(self):
-        queryset = DispatchMedia.objects.select_related('dispatch', 'uploaded_by').all()
+        queryset = self.shape(DispatchMedia.objects.all())
         
         # Filter by dispatch if specified
         dispatch_id = self.request.query_params.get('dispatch', None)
@@ -432,13 +634,14 @@ class DispatchMediaViewSet(viewsets.ModelViewSet):
     def perform_create(self, serializer):
         serializer.save(uploaded_by=self.request.user)
 
-class ExceptionLogViewSet(viewsets.ModelViewSet):
+class ExceptionLogViewSet(ConditionalGetMixin, ShapedQuerysetMixin, viewsets.ModelViewSet):
     queryset = ExceptionLog.objects.select_related('dispatch', 'resolved_by').all()
     serializer_class = ExceptionLogSerializer
     permission_classes = [IsAuthenticated, IsOperatorOrAdmin]
+    pagination_class = CreatedAtCursorPagination
 
     def get_queryset(self):
-        queryset = ExceptionLog.objects.select_related('dispatch', 'resolved_by').all()
+        queryset = self.shape(ExceptionLog.objects.all())
         
         resolved_filter = self.request.query_params.get('resolved', None)
         dispatch_filter = self.request.query_params.get('dispatch', None)
@@ -451,6 +654,12 @@ class ExceptionLogViewSet(viewsets.ModelViewSet):
             
         return queryset
 
+    @action(detail=False, methods=['get'], renderer_classes=[CSVRenderer, NDJSONRenderer])
+    def export(self, request):
+        """Stream every exception matching the list filters as CSV or NDJSON (``?format=ndjson``)."""
+        return export_response(request, self.filter_queryset(self.get_queryset()), request.accepted_renderer.format,
+                               'exceptions')
+
     @action(detail=True, methods=['post'])
     def resolve(self, request, pk=None):
         exception = self.get_object()
@@ -464,6 +673,7 @@ class ExceptionLogViewSet(viewsets.ModelViewSet):
 
 @api_view(['GET'])
 @permission_classes([IsAuthenticated])
+@cached_response('operators')
 def get_operators(request):
     """Get list of all operators for assignment"""
     operators = User.objects.filter(userprofile__role='operator')
@@ -472,60 +682,124 @@ def get_operators(request):
 
 @api_view(['GET'])
 @permission_classes([IsAuthenticated, IsAdminUser])
+@cached_response('kpi')
 def kpi_dashboard(request):
     """Get KPI data for admin dashboard"""
-    today = timezone.now().date()
-    
-    # Basic counts
-    total_trucks = Truck.objects.count()
-    active_dispatches = Dispatch.objects.filter(status__in=['assigned', 'in_progress']).count()
-    completed_orders_today = Order.objects.filter(
-        status='completed',
-        updated_at__date=today
-    ).count()
-    pending_orders = Order.objects.filter(status='pending').count()
-    total_exceptions = ExceptionLog.objects.count()
-    unresolved_exceptions = ExceptionLog.objects.filter(resolved=False).count()
-    
-    # Average delivery time calculation
-    completed_dispatches = Dispatch.objects.filter(
-        status='completed',
-        departure_time__isnull=False,
-        arrival_time__isnull=False
-    )
-    
-    if completed_dispatches.exists():
-        delivery_times = []
-        for dispatch in completed_dispatches:
-            if dispatch.departure_time and dispatch.arrival_time:
-                delivery_time = (dispatch.arrival_time - dispatch.departure_time).total_seconds() / 3600  # hours
-                delivery_times.append(delivery_time)
-        
-        average_delivery_time = sum(delivery_times) / len(delivery_times) if delivery_times else 0
-    else:
-        average_delivery_time = 0
+    # Counters are maintained incrementally by the model signal handlers, so
+    # this is a constant-time read whatever the size of the history.
+    snapshot = KPISnapshot.current()
     
     # Material stock summary
-    materials = Material.objects.all()
     material_stock_summary = {
-        material.name: {
-            'quantity': material.stock_quantity,
-            'unit': material.unit,
-            'low_stock': material.stock_quantity < 10
+        name: {
+            'quantity': stock_quantity,
+            'unit': unit,
+            'low_stock': stock_quantity < 10
         }
-        for material in materials
+        for name, stock_quantity, unit in Material.objects.values_list('name', 'stock_quantity', 'unit')
     }
     
     kpi_data = {
-        'total_trucks': total_trucks,
-        'active_dispatches': active_dispatches,
-        'completed_orders_today': completed_orders_today,
-        'pending_orders': pending_orders,
-        'total_exceptions': total_exceptions,
-        'unresolved_exceptions': unresolved_exceptions,
-        'average_delivery_time': round(average_delivery_time, 2),
+        'total_trucks': snapshot.total_trucks,
+        'active_dispatches': snapshot.active_dispatches,
+        'completed_orders_today': DailyOrderKPI.completed_on(timezone.localdate()),
+        'pending_orders': snapshot.pending_orders,
+        'total_exceptions': snapshot.total_exceptions,
+        'unresolved_exceptions': snapshot.unresolved_exceptions,
+        'average_delivery_time': round(snapshot.average_delivery_hours, 2),
         'material_stock_summary': material_stock_summary
     }
     
     serializer = KPIDashboardSerializer(kpi_data)
     return Response(serializer.data)
+
+@api_view(['GET'])
+@permission_classes([IsAuthenticated, IsAdminUser])
+def cache_stats(request):
+    """Response cache hit/miss counters per endpoint"""
+    return Response(response_cache.stats(CACHE_SCOPES))
+
+@api_view(['GET'])
+@permission_classes([IsAuthenticated, IsOperatorOrAdmin])
+def sync(request):
+    """Dispatches, media and exceptions changed or removed since ``?since=<token>`` (see api/sync.py).
+
+    Operators get their own dispatches only. Without ``since`` every row is
+    returned with ``"reset": true``; each response carries the next token.
+    """
+    since = request.query_params.get('since')
+    if since:
+        since = read_token(since)
+        if since is None:
+            return Response({'error': 'Invalid sync token'}, status=status.HTTP_400_BAD_REQUEST)
+    operator = request.user if user_role(request.user) == 'operator' else None
+    return Response(sync_changes(request, since or None, operator))
+
+def _media_user(request):
+    """The user behind a JWT or session, or ``None``."""
+    try:
+        authenticated = ClaimsJWTAuthentication().authenticate(request)
+    except AuthenticationFailed:
+        authenticated = None
+    if authenticated:
+        return authenticated[0]
+    return request.user if request.user.is_authenticated else None
+
+@require_safe
+def serve_media(request, path):
+    """Serve an uploaded file to a user allowed to see its dispatch.
+
+    Links in API responses are signed and need no login. Unsigned requests
+    must carry a JWT (or a session): admins may fetch any dispatch media,
+    operators only media of dispatches assigned to them.
+    """
+    if not check_media_signature(path, request.GET.get('expires'), request.GET.get('signature')):
+        user = _media_user(request)
+        if user is None:
+            return HttpResponse(status=401)
+        media = DispatchMedia.objects.filter(Q(image=path) | Q(thumbnail=path) | Q(medium=path))
+        role = user_role(user)
+        if role == 'operator':
+            media = media.filter(dispatch__operator=user)
+        elif role != 'admin' and not user.is_superuser:
+            media = media.none()
+        if not media.exists():
+            raise Http404('No such media file')
+    return media_response(request, path)
+
+def _stream_user(request):
+    """The user behind the JWT of an event stream request and their role, or ``(None, None)``."""
+    authentication = ClaimsJWTAuthentication()
+    header = authentication.get_header(request)
+    raw_token = authentication.get_raw_token(header) if header else request.GET.get('token', '').encode()
+    if not raw_token:
+        return None, None
+    try:
+        user = authentication.get_user(authentication.get_validated_token(raw_token))
+    except AuthenticationFailed:
+        return None, None
+    return user, 'admin' if user.is_superuser else user_role(user)
+
+@require_safe
+async def event_stream(request):
+    """Server-Sent Events of dispatch, order, truck and exception changes (api/events.py).
+
+    ``EventSource`` cannot send an Authorization header, so the JWT may also
+    come as ``?token=``. Admins get every event, operators those of their
+    dispatches. Needs an ASGI server: a WSGI worker would be held forever.
+    """
+    if not isinstance(request, ASGIRequest):
+        return HttpResponse('The event stream needs an ASGI server', status=501, content_type='text/plain')
+    user, role = await sync_to_async(_stream_user)(request)
+    if user is None:
+        return HttpResponse(status=401)
+    if role not in ('admin', 'operator'):
+        return HttpResponse(status=403)
+
+    last_event_id = request.headers.get('Last-Event-ID') or request.GET.get('last_event_id')
+    subscription = Subscription(event_bus, user.pk, role == 'admin', last_event_id)
+    response = StreamingHttpResponse(subscription.frames(), content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    # Don't let nginx buffer the stream
+    response['X-Accel-Buffering'] = 'no'
+    return response
@@ -0,0 +1,234 @@
+"""
+Dispatch status transitions and their side effects.
+
+``transition`` moves one dispatch along ``Dispatch.TRANSITIONS`` with a single
+conditional ``UPDATE``, then ``apply_status_effects`` updates the order, truck,
+material stock and KPI counters with targeted ``UPDATE``s in the same
+transaction; nothing is saved twice.
+
+``bulk_transition`` moves many dispatches at once with the same side effects:
+the dispatch, order and truck rows are each changed with a single ``UPDATE``,
+and stock is taken out with one ``F()`` decrement per material (see
+``api/stock.py``).
+"""
+from django.db import connection, transaction
+from django.db.models import Value
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+
+from .models import (
+    Truck, Order, Dispatch, Material, KPISnapshot, DailyOrderKPI, invalidate_cached_responses
+)
+from .events import publish_changes
+from .stock import consume
+
+# Transitions that can be applied to many dispatches at once: those that
+# need no per-dispatch input such as a weight
+ALLOWED_SOURCES = {
+    new_status: rule['from'] for new_status, rule in Dispatch.TRANSITIONS.items() if not rule['requires']
+}
+
+
+class TransitionError(Exception):
+    """Some dispatches cannot make the requested transition.
+
+    ``errors`` maps each offending dispatch id to a message.
+    """
+    def __init__(self, errors):
+        super().__init__(errors)
+        self.errors = errors
+
+
+class TransitionConflict(Exception):
+    """The dispatch is not (or no longer) in a status the transition starts from."""
+    def __init__(self, dispatch_id, new_status, current_status):
+        super().__init__(f'Dispatch is {current_status}, cannot move to {new_status}')
+        self.dispatch_id = dispatch_id
+        self.current_status = current_status
+
+
+def _stamps(new_status, now):
+    """Timestamp columns ``new_status`` stamps, keeping values already set."""
+    return {field: Coalesce(field, Value(now)) for field in Dispatch.TRANSITIONS[new_status]['stamps']}
+
+
+def transition(dispatch, new_status, **fields):
+    """Move ``dispatch`` to ``new_status`` following ``Dispatch.TRANSITIONS``.
+
+    The status, timestamps and ``fields`` are written by one conditional
+    ``UPDATE ... WHERE id = ? AND status = ?`` on the status ``dispatch`` was
+    read with, so of two concurrent requests only one can win; the other gets
+    ``TransitionConflict``. The side effects follow in the same transaction.
+    """
+    rule = Dispatch.TRANSITIONS[new_status]
+    old_status = dispatch.status
+    if old_status not in rule['from']:
+        raise TransitionConflict(dispatch.pk, new_status, old_status)
+
+    now = timezone.now()
+    with transaction.atomic():
+        updated = Dispatch.objects.filter(pk=dispatch.pk, status=old_status).update(
+            status=new_status, updated_at=now, **_stamps(new_status, now), **fields
+        )
+        if not updated:
+            current = Dispatch.objects.filter(pk=dispatch.pk).values_list('status', flat=True).first()
+            raise TransitionConflict(dispatch.pk, new_status, current)
+
+        dispatch.status = dispatch._loaded_status = new_status
+        dispatch.updated_at = now
+        for field in rule['stamps']:
+            if getattr(dispatch, field) is None:
+                setattr(dispatch, field, now)
+        for field, value in fields.items():
+            setattr(dispatch, field, value)
+        invalidate_cached_responses(Dispatch)
+        publish_changes(Dispatch, [dispatch.pk])
+        apply_status_effects(dispatch, old_status)
+    return dispatch
+
+
+def apply_status_effects(dispatch, old_status):
+    """Apply the side effects of ``dispatch`` having moved from ``old_status``.
+
+    Called by ``transition`` and by the Dispatch post_save handler, for
+    status changes saved directly.
+    """
+    new_status = dispatch.status
+    active_delta = int(new_status in Dispatch.ACTIVE_STATUSES) - int(old_status in Dispatch.ACTIVE_STATUSES)
+    if new_status not in ('in_transit', 'completed', 'cancelled'):
+        KPISnapshot.adjust(active_dispatches=active_delta)
+        return
+
+    now = timezone.now()
+    with transaction.atomic():
+        # Plain saves may not have stamped the times
+        if new_status == 'in_transit' and not dispatch.departure_time:
+            dispatch.departure_time = now
+            Dispatch.objects.filter(pk=dispatch.pk).update(departure_time=now)
+        elif new_status == 'completed' and not dispatch.arrival_time:
+            dispatch.arrival_time = now
+            Dispatch.objects.filter(pk=dispatch.pk).update(arrival_time=now)
+
+        row = {
+            'id': dispatch.pk, 'status': old_status, 'truck_id': dispatch.truck_id,
+            'order_id': dispatch.order_id, 'departure_time': dispatch.departure_time,
+            'arrival_time': dispatch.arrival_time,
+        }
+        order = Order.objects.select_for_update().values('status', 'quantity', 'material_type').get(
+            pk=dispatch.order_id
+        )
+        row.update({f'order__{field}': value for field, value in order.items()})
+
+        _apply_side_effects([row], new_status, now)
+        _adjust_kpis([row], new_status, now, active_dispatches=active_delta)
+        for model in (Order, Truck, Material):
+            invalidate_cached_responses(model)
+
+    if new_status in ('completed', 'cancelled'):
+        from .allocation import drain_backlog
+        drain_backlog()
+
+
+def _locked_rows(dispatch_ids):
+    queryset = Dispatch.objects.filter(pk__in=dispatch_ids)
+    if connection.features.has_select_for_update_of:
+        queryset = queryset.select_for_update(of=('self', 'order'))
+    else:
+        queryset = queryset.select_for_update()
+    return list(queryset.values(
+        'id', 'status', 'truck_id', 'order_id', 'departure_time', 'arrival_time',
+        'order__status', 'order__quantity', 'order__material_type',
+    ))
+
+
+def bulk_transition(dispatch_ids, new_status):
+    """Move every dispatch in ``dispatch_ids`` to ``new_status`` atomically.
+
+    Either all of them make the transition or none do: ``TransitionError`` is
+    raised if any id is unknown or not in an allowed source status. Returns
+    the number of dispatches updated.
+    """
+    if new_status not in ALLOWED_SOURCES:
+        raise TransitionError({None: f'Cannot bulk-transition to {new_status!r}'})
+    invalid = [pk for pk in dispatch_ids if not isinstance(pk, int) or isinstance(pk, bool)]
+    if invalid:
+        raise TransitionError({pk: 'Not a dispatch id' for pk in invalid})
+    dispatch_ids = set(dispatch_ids)
+    sources = ALLOWED_SOURCES[new_status]
+
+    with transaction.atomic():
+        rows = _locked_rows(dispatch_ids)
+        errors = {pk: 'Dispatch not found' for pk in dispatch_ids - {row['id'] for row in rows}}
+        errors.update({
+            row['id']: f"Cannot move from {row['status']} to {new_status}"
+            for row in rows if row['status'] not in sources
+        })
+        if errors:
+            raise TransitionError(errors)
+        if not rows:
+            return 0
+
+        now = timezone.now()
+        Dispatch.objects.filter(pk__in=[row['id'] for row in rows]).update(
+            status=new_status, updated_at=now, **_stamps(new_status, now)
+        )
+
+        _apply_side_effects(rows, new_status, now)
+        is_active = new_status in Dispatch.ACTIVE_STATUSES
+        _adjust_kpis(rows, new_status, now, active_dispatches=sum(
+            int(is_active) - int(row['status'] in Dispatch.ACTIVE_STATUSES) for row in rows
+        ))
+        for model in (Dispatch, Order, Truck, Material):
+            invalidate_cached_responses(model)
+        publish_changes(Dispatch, [row['id'] for row in rows])
+
+    if new_status in ('completed', 'cancelled'):
+        from .allocation import drain_backlog
+        drain_backlog()
+    return len(rows)
+
+
+def _apply_side_effects(rows, new_status, now):
+    truck_ids = {row['truck_id'] for row in rows}
+    publish_changes(Truck, truck_ids)
+    if new_status == 'in_transit':
+        Truck.objects.filter(pk__in=truck_ids).update(status='in_transit', updated_at=now)
+        order_ids = {row['order_id'] for row in rows}
+        Order.objects.filter(pk__in=order_ids, status='pending').update(status='in_progress', updated_at=now)
+        publish_changes(Order, order_ids)
+
+    elif new_status == 'completed':
+        Truck.objects.filter(pk__in=truck_ids).update(status='idle', updated_at=now)
+        newly_completed = {row['order_id']: row for row in rows if row['order__status'] != 'completed'}
+        Order.objects.filter(pk__in=newly_completed).update(status='completed', updated_at=now)
+        publish_changes(Order, newly_completed)
+
+        # One decrement per material, never below zero, recorded in the ledger
+        consume([
+            (row['order__material_type'], row['order__quantity'], row['id']) for row in newly_completed.values()
+        ], now)
+
+    elif new_status == 'cancelled':
+        Truck.objects.filter(pk__in=truck_ids).update(status='idle', updated_at=now)
+        # The order goes with its dispatch; left pending, the backlog drained
+        # right after would dispatch it again
+        open_orders = {row['order_id'] for row in rows if row['order__status'] in ('pending', 'in_progress')}
+        Order.objects.filter(pk__in=open_orders).update(status='cancelled', updated_at=now)
+        publish_changes(Order, open_orders)
+
+
+def _adjust_kpis(rows, new_status, now, **deltas):
+    orders = {row['order_id']: row.get('order__status') for row in rows}
+
+    if new_status in ('in_transit', 'cancelled'):
+        deltas['pending_orders'] = -sum(status == 'pending' for status in orders.values())
+    elif new_status == 'completed':
+        deltas['pending_orders'] = -sum(status == 'pending' for status in orders.values())
+        deliveries = [
+            ((row['arrival_time'] or now) - row['departure_time']).total_seconds()
+            for row in rows if row['departure_time']
+        ]
+        deltas['delivery_seconds_total'] = sum(deliveries)
+        deltas['delivery_count'] = len(deliveries)
+        DailyOrderKPI.adjust(timezone.localdate(now), sum(status != 'completed' for status in orders.values()))
+    KPISnapshot.adjust(**deltas)
@@ -9,8 +9,26 @@ https://docs.djangoproject.com/en/5.2/howto/deployment/asgi/
 
 import os
 
+from asgiref.sync import ThreadSensitiveContext
 from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'backend.settings')
 
-application = get_asgi_application()
+django_application = get_asgi_application()
+
+from django.urls import reverse  # noqa: E402 (needs the apps loaded)
+
+EVENT_STREAM_PATH = reverse('event_stream')
+
+# Django gives every request its own thread for synchronous work, kept until
+# the response ends; an event stream (api/events.py) would hold one for hours.
+# Streams share this context instead, so their brief synchronous steps (the
+# request signals, authentication) run on one thread however many are open.
+_event_streams = ThreadSensitiveContext()
+
+
+async def application(scope, receive, send):
+    if scope['type'] == 'http' and scope['path'] == EVENT_STREAM_PATH:
+        # Outermost context wins; never exited, so the thread is kept
+        await _event_streams.__aenter__()
+    await django_application(scope, receive, send)
@@ -0,0 +1,148 @@
+"""
+Per-request query and latency instrumentation (``REQUEST_INSTRUMENTATION``).
+
+``QueryInstrumentationMiddleware`` times each request and, through
+``connection.execute_wrapper``, the SQL it runs: how many queries, how long
+the database took, and which SELECTs ran again and again with only their
+parameters changing, the shape of an N+1 (a serializer reading
+``dispatch.truck`` for every exception of a page). It reports them
+
+* in a ``Server-Timing`` header (``db``, ``repeated`` and ``total``), shown
+  next to the request in the browser's network panel, and
+* as one JSON log line per request on the ``backend.requests`` logger, a
+  warning when a query repeats or a budget is exceeded.
+
+``REQUEST_QUERY_BUDGETS`` caps the queries of reads (GET and HEAD) of views
+by URL name (``exceptionlog-list``); these may not repeat a SELECT
+``REQUEST_REPEATED_QUERY_LIMIT`` times either. Going over is logged, and
+raised as ``QueryBudgetExceeded`` with ``REQUEST_QUERY_BUDGETS_ENFORCED`` (on
+under ``manage.py test``), so a serializer that goes back to loading related
+rows one at a time fails the test suite.
+
+Only the default database is watched, up to the response being returned:
+rows a streamed response reads while it is sent are not counted.
+"""
+import json
+import logging
+import re
+import time
+from collections import Counter
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction, sync_to_async
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, connection, connections
+
+logger = logging.getLogger('backend.requests')
+
+# IN lists differ in length from one call to the next
+_IN_LIST = re.compile(r'IN \((?:%s, )*%s\)')
+# Repeated statements quoted in the log line are cut to this length
+SQL_PREVIEW = 200
+
+
+class QueryBudgetExceeded(AssertionError):
+    """A budgeted view ran more queries than allowed, or repeated one."""
+
+
+class QueryProbe:
+    """An execute wrapper counting and timing the queries run under it."""
+
+    def __init__(self):
+        self.count = 0
+        self.seconds = 0.0
+        self.selects = Counter()
+        self._connection = None
+
+    def __call__(self, execute, sql, params, many, context):
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.seconds += time.perf_counter() - started
+            self.count += 1
+            if sql.lstrip()[:6].upper() == 'SELECT':
+                self.selects[_IN_LIST.sub('IN (...)', sql)] += 1
+
+    def attach(self):
+        # Connections are per thread: remember the one the wrapper went on
+        self._connection = connections[DEFAULT_DB_ALIAS]
+        self._connection.execute_wrappers.append(self)
+
+    def detach(self):
+        self._connection.execute_wrappers.remove(self)
+
+    def repeated(self, limit):
+        """``{sql: times}`` of the SELECTs run at least ``limit`` times."""
+        return {sql: times for sql, times in self.selects.most_common() if times >= limit}
+
+
+class QueryInstrumentationMiddleware:
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.async_mode = iscoroutinefunction(get_response)
+        if self.async_mode:
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if self.async_mode:
+            return self.__acall__(request)
+        started = time.perf_counter()
+        probe = QueryProbe()
+        with connection.execute_wrapper(probe):
+            response = self.get_response(request)
+        return self.report(request, response, probe, started)
+
+    async def __acall__(self, request):
+        started = time.perf_counter()
+        probe = QueryProbe()
+        # Sync views, and so their queries, run on the request's thread-sensitive
+        # executor thread; put the wrapper on that thread's connection
+        await sync_to_async(probe.attach)()
+        try:
+            response = await self.get_response(request)
+        finally:
+            await sync_to_async(probe.detach)()
+        return self.report(request, response, probe, started)
+
+    def report(self, request, response, probe, started):
+        total_ms = (time.perf_counter() - started) * 1000
+        db_ms = probe.seconds * 1000
+        repeated = probe.repeated(settings.REQUEST_REPEATED_QUERY_LIMIT)
+        match = request.resolver_match
+        view = match.view_name if match else None
+
+        timings = [f'db;dur={db_ms:.1f};desc="{probe.count} queries"']
+        if repeated:
+            timings.append(f'repeated;desc="{len(repeated)} statements"')
+        timings.append(f'total;dur={total_ms:.1f}')
+        response['Server-Timing'] = ', '.join(timings)
+
+        line = {
+            'method': request.method, 'path': request.path, 'view': view, 'status': response.status_code,
+            'queries': probe.count, 'db_ms': round(db_ms, 1), 'total_ms': round(total_ms, 1),
+        }
+        if repeated:
+            line['repeated'] = [{'sql': sql[:SQL_PREVIEW], 'times': times} for sql, times in repeated.items()]
+        problem = self.over_budget(request, view, probe.count, repeated)
+        if problem:
+            line['over_budget'] = problem
+        logger.log(logging.WARNING if repeated or problem else logging.INFO, json.dumps(line))
+
+        if problem and settings.REQUEST_QUERY_BUDGETS_ENFORCED:
+            details = ''.join(f'\n  {times}x {sql}' for sql, times in repeated.items())
+            raise QueryBudgetExceeded(f'{request.method} {request.path} ({view}): {problem}{details}')
+        return response
+
+    def over_budget(self, request, view, count, repeated):
+        budget = settings.REQUEST_QUERY_BUDGETS.get(view)
+        if budget is None or request.method not in ('GET', 'HEAD'):
+            return None
+        problems = []
+        if count > budget:
+            problems.append(f'{count} queries, budget {budget}')
+        if repeated:
+            problems.append(f'{len(repeated)} statements repeated per row (N+1)')
+        return '; '.join(problems) or None
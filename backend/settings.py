@@ -12,6 +12,7 @@ https://docs.djangoproject.com/en/5.2/ref/settings/
 
 from pathlib import Path
 import os
+import sys
 from dotenv import load_dotenv
 
 # Load environment variables from .env file
@@ -98,6 +99,30 @@ DATABASES = {
 
 
 
+# Caches
+# Response cache (api/cache.py) entries default to per-process local memory;
+# their versions and hit/miss counters are database rows, so invalidation
+# reaches every worker either way. Point RESPONSE_CACHE_BACKEND at
+# django.core.cache.backends.filebased.FileBasedCache (with
+# RESPONSE_CACHE_LOCATION set to a directory) to also share the entries.
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    'responses': {
+        'BACKEND': os.getenv('RESPONSE_CACHE_BACKEND', 'django.core.cache.backends.locmem.LocMemCache'),
+        'LOCATION': os.getenv('RESPONSE_CACHE_LOCATION', 'mineflow-responses'),
+        'TIMEOUT': int(os.getenv('RESPONSE_CACHE_TIMEOUT', '300')),
+        'OPTIONS': {
+            'MAX_ENTRIES': int(os.getenv('RESPONSE_CACHE_MAX_ENTRIES', '1000')),
+        },
+    },
+}
+RESPONSE_CACHE_ALIAS = 'responses'
+# Size of the in-process LRU in front of the shared cache
+RESPONSE_CACHE_LOCAL_ENTRIES = int(os.getenv('RESPONSE_CACHE_LOCAL_ENTRIES', '256'))
+
+
 # Password validation
 # https://docs.djangoproject.com/en/5.2/ref/settings/#auth-password-validators
 
@@ -139,6 +164,25 @@ STATIC_ROOT = BASE_DIR / 'staticfiles'
 MEDIA_URL = os.getenv('MEDIA_URL', '/media/')
 MEDIA_ROOT = os.path.join(BASE_DIR, 'media')
 
+# Uploaded images are written here in chunks and acknowledged at once; a pool
+# of MEDIA_PROCESSING_WORKERS threads per process then validates, strips EXIF
+# and re-encodes them into MEDIA_ROOT (0 processes them inside the request).
+MEDIA_STAGING_ROOT = os.getenv('MEDIA_STAGING_ROOT', os.path.join(BASE_DIR, 'media_staging'))
+MEDIA_PROCESSING_WORKERS = int(os.getenv('MEDIA_PROCESSING_WORKERS', '2'))
+# Larger images are rejected (decompression bomb guard)
+MEDIA_MAX_PIXELS = int(os.getenv('MEDIA_MAX_PIXELS', '40000000'))
+
+# Media is served by api.views.serve_media after a permission check. Links in
+# API responses are signed and stay valid for one to two MEDIA_URL_MAX_AGE
+# windows. Set MEDIA_X_ACCEL_REDIRECT to an nginx `internal` location that
+# aliases MEDIA_ROOT (e.g. /protected-media/), or MEDIA_X_SENDFILE=True behind
+# Apache mod_xsendfile, to let the proxy send the bytes.
+MEDIA_URL_MAX_AGE = int(os.getenv('MEDIA_URL_MAX_AGE', str(6 * 3600)))
+MEDIA_X_ACCEL_REDIRECT = os.getenv('MEDIA_X_ACCEL_REDIRECT', '')
+MEDIA_X_SENDFILE = os.getenv('MEDIA_X_SENDFILE', 'False').lower() == 'true'
+# Stored files never change (new uploads get new names), so browsers may keep them
+MEDIA_CACHE_MAX_AGE = int(os.getenv('MEDIA_CACHE_MAX_AGE', str(365 * 24 * 3600)))
+
 # Default primary key field type
 # https://docs.djangoproject.com/en/5.2/ref/settings/#default-auto-field
 
@@ -150,13 +194,44 @@ DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 # Django REST Framework settings
 REST_FRAMEWORK = {
     'DEFAULT_AUTHENTICATION_CLASSES': [
-        'rest_framework_simplejwt.authentication.JWTAuthentication',
+        # Role and user claims read from the token, no query (api/authentication.py)
+        'api.authentication.ClaimsJWTAuthentication',
     ],
     'DEFAULT_PERMISSION_CLASSES': [
         'rest_framework.permissions.IsAuthenticated',
     ],
+    # orjson when installed, DRF's encoder otherwise (api/renderers.py)
+    'DEFAULT_RENDERER_CLASSES': [
+        'api.renderers.FastJSONRenderer',
+        'rest_framework.renderers.BrowsableAPIRenderer',
+    ],
 }
 
+# Lists are paginated only when asked to (?page_size=, ?cursor=, ?page=; see
+# api/pagination.py): pages of API_PAGE_SIZE rows, and at most API_MAX_PAGE_SIZE
+API_PAGE_SIZE = int(os.getenv('API_PAGE_SIZE', '50'))
+API_MAX_PAGE_SIZE = int(os.getenv('API_MAX_PAGE_SIZE', '500'))
+
+# Rows read and encoded at a time by ?stream=true list responses
+API_STREAM_CHUNK_SIZE = int(os.getenv('API_STREAM_CHUNK_SIZE', '500'))
+
+# Rows per keyset batch of the CSV/NDJSON exports (api/export.py)
+EXPORT_BATCH_SIZE = int(os.getenv('EXPORT_BATCH_SIZE', '2000'))
+
+# Server-Sent Events stream (api/events.py): events kept for clients resuming
+# with Last-Event-ID, events a slow client may fall behind before it is reset,
+# and the keep-alive and client reconnect intervals
+EVENT_REPLAY_SIZE = int(os.getenv('EVENT_REPLAY_SIZE', '1000'))
+EVENT_QUEUE_SIZE = int(os.getenv('EVENT_QUEUE_SIZE', '500'))
+EVENT_KEEPALIVE_SECONDS = int(os.getenv('EVENT_KEEPALIVE_SECONDS', '15'))
+EVENT_RETRY_SECONDS = int(os.getenv('EVENT_RETRY_SECONDS', '3'))
+
+# Delta sync (api/sync.py): how long tombstones of deleted rows are kept (older
+# tokens get a full reset), and how far back each token reaches to cover
+# transactions still open when it was issued
+SYNC_TOMBSTONE_DAYS = int(os.getenv('SYNC_TOMBSTONE_DAYS', '30'))
+SYNC_OVERLAP_SECONDS = int(os.getenv('SYNC_OVERLAP_SECONDS', '30'))
+
 # JWT Settings
 from datetime import timedelta
 SIMPLE_JWT = {
@@ -164,6 +239,60 @@ SIMPLE_JWT = {
     'REFRESH_TOKEN_LIFETIME': timedelta(days=int(os.getenv('JWT_REFRESH_TOKEN_LIFETIME_DAYS', '7'))),
     'ROTATE_REFRESH_TOKENS': True,
     'BLACKLIST_AFTER_ROTATION': True,
+    # Re-read the user's role and claims on refresh
+    'TOKEN_REFRESH_SERIALIZER': 'api.authentication.ClaimsTokenRefreshSerializer',
+}
+
+# Where the current token claims digest of each user is cached, and for how
+# long; with a per-process cache, other workers see role changes that late
+AUTH_CACHE_ALIAS = os.getenv('AUTH_CACHE_ALIAS', RESPONSE_CACHE_ALIAS)
+AUTH_CLAIMS_CACHE_SECONDS = int(os.getenv('AUTH_CLAIMS_CACHE_SECONDS', '60'))
+
+# Refresh-token blacklist (api/blacklist.py): ids the in-process Bloom filter
+# is sized for, how stale it may get when the cache is per-process, and how
+# expired entries are pruned (a batch every N revocations)
+TOKEN_BLACKLIST_BLOOM_CAPACITY = int(os.getenv('TOKEN_BLACKLIST_BLOOM_CAPACITY', '100000'))
+TOKEN_BLACKLIST_SYNC_SECONDS = int(os.getenv('TOKEN_BLACKLIST_SYNC_SECONDS', '5'))
+TOKEN_BLACKLIST_PRUNE_EVERY = int(os.getenv('TOKEN_BLACKLIST_PRUNE_EVERY', '500'))
+TOKEN_BLACKLIST_PRUNE_BATCH = int(os.getenv('TOKEN_BLACKLIST_PRUNE_BATCH', '1000'))
+
+# Per-request instrumentation (backend/middleware.py): query count, SQL time,
+# repeated queries (N+1) and wall time of every request, as a Server-Timing
+# header and a JSON line on the backend.requests logger. Reads of the views
+# named in REQUEST_QUERY_BUDGETS may run that many queries and repeat no SELECT
+# REQUEST_REPEATED_QUERY_LIMIT times; the test suite fails when one does.
+REQUEST_INSTRUMENTATION = os.getenv('REQUEST_INSTRUMENTATION', 'False').lower() == 'true'
+REQUEST_QUERY_BUDGETS_ENFORCED = sys.argv[1:2] == ['test']
+REQUEST_REPEATED_QUERY_LIMIT = int(os.getenv('REQUEST_REPEATED_QUERY_LIMIT', '3'))
+REQUEST_QUERY_BUDGETS = {
+    'truck-list': 5, 'truck-detail': 4,
+    'customer-list': 4, 'customer-detail': 4,
+    'material-list': 4, 'material-detail': 4,
+    'order-list': 4, 'order-detail': 4,
+    'dispatch-list': 4, 'dispatch-detail': 4,
+    'dispatchmedia-list': 4, 'dispatchmedia-detail': 4,
+    'exceptionlog-list': 4, 'exceptionlog-detail': 4,
+    'kpi_dashboard': 4,
+    'sync': 4,
+}
+if REQUEST_INSTRUMENTATION or REQUEST_QUERY_BUDGETS_ENFORCED:
+    # Outermost, so the wall time covers the other middleware too
+    MIDDLEWARE.insert(0, 'backend.middleware.QueryInstrumentationMiddleware')
+
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'handlers': {
+        'console': {'class': 'logging.StreamHandler'},
+        'null': {'class': 'logging.NullHandler'},
+    },
+    'loggers': {
+        'backend.requests': {
+            'handlers': ['console' if REQUEST_INSTRUMENTATION else 'null'],
+            'level': 'INFO',
+            'propagate': False,
+        },
+    },
 }
 
 # CORS settings